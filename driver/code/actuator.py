@@ -0,0 +1,258 @@
+import collections
+import logging
+import threading
+import time
+from spans import span
+
+
+class Actuator(object):
+    """
+    Owns the picar wheels and writes to them from its own thread, so the I2C/PWM
+    transactions never block the vision thread.
+
+    Commands that don't change the wheel state are dropped, a burst of commands is
+    coalesced into a single write of the latest value, and writes are sent at no more
+    than max_rate_hz.  The command-to-write latency of every write is recorded.
+
+    front_wheels and back_wheels are drop-in replacements for the picar wheels, e.g.
+        car.front_wheels = actuator.front_wheels
+    so the lane followers and object processor need no changes.
+
+    With a latency_trace.LatencyTracer, every command is tagged with the frame it was based on
+    (the tracer's current frame, unless given), and the tracer is told when it reaches the wheels.
+    """
+
+    def __init__(self, front_wheels, back_wheels, max_rate_hz=50, tracer=None, history=1000):
+        logging.info('Creating an Actuator, max rate %s Hz...' % max_rate_hz)
+        self.wheels_front = front_wheels
+        self.wheels_back = back_wheels
+        self.min_write_interval = 1.0 / max_rate_hz
+        self.tracer = tracer
+
+        self.condition = threading.Condition()
+        self.pending_angle = None
+        self.pending_angle_time = None
+        self.pending_angle_frame = None
+        self.pending_speed = None
+        self.pending_speed_time = None
+        self.pending_speed_frame = None
+        self.dispatched_angle = None  # last values handed to the writer thread, what the wheels end up at
+        self.dispatched_speed = None
+        self.angle = None  # last commanded values
+        self.speed = None
+
+        self.commands = 0
+        self.deduped = 0
+        self.coalesced = 0
+        self.writes = 0
+        self.latencies = collections.deque(maxlen=history)  # command to write of the last writes, in seconds
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self.front_wheels = ActuatorFrontWheels(self)
+        self.back_wheels = ActuatorBackWheels(self)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='actuator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def turn(self, angle, frame=None):
+        if frame is None and self.tracer is not None:
+            frame = self.tracer.current_frame()
+        with self.condition:
+            self.commands += 1
+            self.angle = angle
+            if self.pending_angle is None and angle == self.dispatched_angle:
+                self.deduped += 1
+                return
+            if self.pending_angle is not None:
+                self.coalesced += 1
+            self.pending_angle = angle
+            self.pending_angle_time = time.monotonic()
+            self.pending_angle_frame = frame
+            self.condition.notify()
+
+    def set_speed(self, speed, frame=None):
+        if self.tracer is not None:
+            speed = self.tracer.clamp_speed(speed)  # 0 once the latency watchdog braked
+            if frame is None:
+                frame = self.tracer.current_frame()
+        with self.condition:
+            self.commands += 1
+            self.speed = speed
+            if self.pending_speed is None and speed == self.dispatched_speed:
+                self.deduped += 1
+                return
+            if self.pending_speed is not None:
+                self.coalesced += 1
+            self.pending_speed = speed
+            self.pending_speed_time = time.monotonic()
+            self.pending_speed_frame = frame
+            self.condition.notify()
+
+    def run(self):
+        last_write_time = 0
+        while True:
+            with self.condition:
+                while self.running and self.pending_angle is None and self.pending_speed is None:
+                    self.condition.wait()
+                if self.pending_angle is None and self.pending_speed is None:
+                    return  # stopped, and everything has been flushed
+                # wait for the next write slot before taking the values, commands arriving until then replace them
+                wait = last_write_time + self.min_write_interval - time.monotonic()
+                while wait > 0:
+                    self.condition.wait(wait)
+                    wait = last_write_time + self.min_write_interval - time.monotonic()
+                angle, angle_time, angle_frame = self.pending_angle, self.pending_angle_time, self.pending_angle_frame
+                speed, speed_time, speed_frame = self.pending_speed, self.pending_speed_time, self.pending_speed_frame
+                self.pending_angle = None
+                self.pending_speed = None
+                # dedup against what is on its way to the wheels, not what was written before it
+                if angle is not None:
+                    self.dispatched_angle = angle
+                if speed is not None:
+                    self.dispatched_speed = speed
+
+            # write outside of the lock, so callers never wait on the hardware
+            if angle is not None:
+                self.write(self.wheels_front.turn, angle, angle_time, 'turn', angle_frame)
+            if speed is not None:
+                self.write(self.set_wheels_speed, speed, speed_time, 'speed', speed_frame)
+            last_write_time = time.monotonic()
+
+    def write(self, write_function, value, command_time, command=None, frame=None):
+        with span('actuation'):
+            write_function(value)
+        write_time = time.monotonic()
+        self.writes += 1
+        latency = write_time - command_time
+        self.latencies.append(latency)
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if self.tracer is not None:
+            self.tracer.actuated(frame, command, value, write_time)
+
+    def set_wheels_speed(self, speed):
+        self.wheels_back.speed = speed
+
+    def stop(self):
+        """ Flush pending commands and stop the writer thread """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        logging.info('Actuator stats: %s' % self.stats())
+
+    def stats(self):
+        return {
+            'commands': self.commands,
+            'writes': self.writes,
+            'deduped': self.deduped,
+            'coalesced': self.coalesced,
+            'latency_mean_ms': self.latency_total / self.writes * 1000 if self.writes else 0,
+            'latency_max_ms': self.latency_max * 1000,
+        }
+
+
+class ActuatorFrontWheels(object):
+    """ Same interface as picar.front_wheels.Front_Wheels, commands go through the Actuator """
+
+    def __init__(self, actuator):
+        self.actuator = actuator
+
+    def turn(self, angle, frame=None):
+        self.actuator.turn(angle, frame)
+
+
+class ActuatorBackWheels(object):
+    """ Same interface as picar.back_wheels.Back_Wheels, commands go through the Actuator """
+
+    def __init__(self, actuator):
+        self.actuator = actuator
+
+    @property
+    def speed(self):
+        return self.actuator.speed
+
+    @speed.setter
+    def speed(self, speed):
+        self.actuator.set_speed(speed)
+
+
+############################
+# Test Functions
+############################
+def test_actuator():
+    import fake_picar
+
+    front_wheels = fake_picar.FakeFrontWheels(write_delay=0.005)
+    back_wheels = fake_picar.FakeBackWheels(write_delay=0.005)
+    actuator = Actuator(front_wheels, back_wheels, max_rate_hz=20)
+
+    # unchanged commands are dropped
+    actuator.front_wheels.turn(90)
+    time.sleep(0.1)
+    actuator.front_wheels.turn(90)
+    actuator.front_wheels.turn(90)
+    time.sleep(0.1)
+    assert [angle for _, angle in front_wheels.writes] == [90], front_wheels.writes
+
+    # a burst is coalesced into one write of the latest value
+    for angle in range(91, 101):
+        actuator.front_wheels.turn(angle)
+    actuator.back_wheels.speed = 40
+    actuator.back_wheels.speed = 30
+    actuator.stop()
+    # the writer may take 91 before the rest of the burst arrives, never anything in between
+    assert [angle for _, angle in front_wheels.writes[1:]] in ([100], [91, 100]), front_wheels.writes
+    assert back_wheels.writes[-1][1] == 30, back_wheels.writes
+
+    # writes are spaced by at least 1 / max_rate_hz
+    write_times = [t for t, _ in front_wheels.writes]
+    assert all(t2 - t1 >= 0.05 for t1, t2 in zip(write_times, write_times[1:])), write_times
+
+    stats = actuator.stats()
+    logging.info('actuator stats: %s' % stats)
+    assert stats['deduped'] >= 2 and stats['coalesced'] >= 1, stats
+
+    # a command arriving while the writer waits for its slot replaces the one that was pending
+    front_wheels = fake_picar.FakeFrontWheels()
+    actuator = Actuator(front_wheels, fake_picar.FakeBackWheels(), max_rate_hz=10)
+    actuator.front_wheels.turn(90)
+    time.sleep(0.02)  # 90 is written, the next slot is 100ms after it
+    actuator.front_wheels.turn(91)
+    time.sleep(0.03)
+    actuator.front_wheels.turn(92)
+    actuator.stop()
+    assert [angle for _, angle in front_wheels.writes] == [90, 92], front_wheels.writes
+    assert front_wheels.writes[1][0] - front_wheels.writes[0][0] < 0.15, front_wheels.writes  # in the next slot
+
+    # once the latency tracer braked, speed commands are clamped to 0
+    import latency_trace
+    tracer = latency_trace.LatencyTracer()
+    back_wheels = fake_picar.FakeBackWheels()
+    actuator = Actuator(fake_picar.FakeFrontWheels(), back_wheels, max_rate_hz=100, tracer=tracer)
+    actuator.back_wheels.speed = 40
+    tracer.braked = True
+    actuator.back_wheels.speed = 0
+    actuator.back_wheels.speed = 40
+    actuator.stop()
+    assert back_wheels.speed == 0, back_wheels.writes
+
+    # a brake sent while a speed is being written is not deduped against the speed written before it
+    back_wheels = fake_picar.FakeBackWheels(write_delay=0.05)
+    actuator = Actuator(fake_picar.FakeFrontWheels(), back_wheels, max_rate_hz=100)
+    actuator.back_wheels.speed = 0
+    time.sleep(0.1)
+    actuator.back_wheels.speed = 40
+    time.sleep(0.02)  # 40 is being written
+    actuator.back_wheels.speed = 0
+    actuator.stop()
+    assert [speed for _, speed in back_wheels.writes] == [0, 40, 0], back_wheels.writes
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_actuator()
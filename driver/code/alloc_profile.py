@@ -0,0 +1,326 @@
+"""
+Allocation and GC profiling of the drive loop, to find what makes a long run on the Pi slow down.
+
+With the profiler started, tracemalloc traces every Python and NumPy allocation (OpenCV results are
+NumPy arrays too), and a gc callback times every collection.  The profiler then records
+    per stage  -- every span (see spans.py) of the drive loop thread: bytes still allocated at the end
+                  of the stage (net), the high water mark above the start of the stage (transient, e.g.
+                  np.zeros_like, addWeighted and copy() results freed before the stage ends), and the
+                  net number of Python object blocks allocated (sys.getallocatedblocks())
+    per frame  -- the same, between two end_frame() calls, plus the GC pauses during the frame
+    every N frames -- a snapshot of the allocations still alive, the top allocation sites by size,
+                  with their block counts, compared to the previous snapshot
+Stages running on other threads (the actuator, the controller) are not attributed, their allocations
+count towards whatever the drive loop thread is doing at the time.
+
+Tracing allocations slows the loop down, a lot, so compare profiles with each other, not with timings.
+
+The transient bytes need tracemalloc.reset_peak(), new in Python 3.9.  On older Pythons (the Pi's 3.5)
+they are not measured and reported as 0, net bytes, blocks, snapshots and GC pauses still are.
+
+Usage:
+# replay a recorded video through the drive loop, with profiling, and save the report
+python alloc_profile.py ../data/tmp/video01.avi --follower hand_coded --output /tmp/alloc.json
+
+# the same, from the replay harness
+python replay_harness.py ../data/tmp/video01.avi --follower hand_coded --memory /tmp/alloc.json
+"""
+import argparse
+import collections
+import gc
+import json
+import logging
+import sys
+import threading
+import tracemalloc
+import spans
+
+StageSample = collections.namedtuple('StageSample', ['net_bytes', 'transient_bytes', 'blocks'])
+FrameSample = collections.namedtuple('FrameSample', ['frame_id', 'net_bytes', 'transient_bytes', 'blocks',
+                                                     'traced_bytes', 'gc_collections', 'gc_pause_ms'])
+
+PER_STAGE_PEAKS = hasattr(tracemalloc, 'reset_peak')  # Python 3.9+
+
+
+class _OpenSpan(object):
+    __slots__ = ('stage', 'start_bytes', 'start_blocks', 'peak_bytes')
+
+    def __init__(self, stage, start_bytes, start_blocks):
+        self.stage = stage
+        self.start_bytes = start_bytes
+        self.start_blocks = start_blocks
+        self.peak_bytes = start_bytes
+
+
+class AllocationProfiler(object):
+
+    def __init__(self, trace_depth=1, snapshot_every=100, top=10, history=10000):
+        """
+        trace_depth -- stack frames kept per allocation, more shows callers but costs more
+        snapshot_every -- frames between snapshots of the allocation sites, 0 for none
+        top -- allocation sites per snapshot
+        history -- frames kept
+        """
+        self.trace_depth = trace_depth
+        self.snapshot_every = snapshot_every
+        self.top = top
+        self.frames = collections.deque(maxlen=history)
+        self.stages = {}  # stage -> deque of StageSample
+        self.history = history
+        self.snapshots = []  # (frame_id, [top allocation sites])
+        self.gc_pauses = spans.Histogram()  # ns, per collection
+        self.gc_collections = [0, 0, 0]  # per generation
+        self.gc_collected = 0
+        self.gc_start = None
+        self.open_spans = []  # the frame, then the stages of the drive loop thread, innermost last
+        self.frame_gc_collections = 0
+        self.frame_gc_pause_ns = 0
+        self.last_snapshot = None
+        self.thread_id = None
+        self.started_spans = False
+        self.running = False
+
+    def start(self):
+        """ Start tracing, from the drive loop thread, the first frame starts now """
+        self.thread_id = threading.get_ident()
+        tracemalloc.start(self.trace_depth)
+        gc.callbacks.append(self.on_gc)
+        if not spans.is_enabled():
+            spans.enable(report_at_exit=False)
+            self.started_spans = True
+        spans.add_listener(self)
+        self.running = True
+        self.open_spans = [self.open_span('frame')]
+        logging.info('Allocation profiling started, tracing %d frame(s) per allocation' % self.trace_depth)
+        if not PER_STAGE_PEAKS:
+            logging.warning('tracemalloc.reset_peak() needs Python 3.9, this is %d.%d: transient bytes are not '
+                            'measured' % sys.version_info[:2])
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        spans.remove_listener(self)
+        if self.started_spans:
+            spans.disable()
+        gc.callbacks.remove(self.on_gc)
+        tracemalloc.stop()
+        self.last_snapshot = None
+        logging.info('Allocations:\n%s' % self.report())
+
+    ############################
+    # Spans and frames
+    ############################
+    def open_span(self, stage):
+        current, peak = tracemalloc.get_traced_memory()
+        if PER_STAGE_PEAKS:
+            # the peak is global, hand the peak so far to every open span before it is reset for this one
+            for open_span in self.open_spans:
+                open_span.peak_bytes = max(open_span.peak_bytes, peak)
+            tracemalloc.reset_peak()
+        return _OpenSpan(stage, current, sys.getallocatedblocks())
+
+    def close_span(self, open_span):
+        current, peak = tracemalloc.get_traced_memory()
+        if not PER_STAGE_PEAKS:
+            # without a reset the peak is the high water mark of the whole run, transient is not known
+            return StageSample(current - open_span.start_bytes, 0, sys.getallocatedblocks() - open_span.start_blocks)
+        peak_bytes = max(open_span.peak_bytes, peak)
+        for outer in self.open_spans:
+            outer.peak_bytes = max(outer.peak_bytes, peak_bytes)
+        return StageSample(current - open_span.start_bytes, peak_bytes - open_span.start_bytes,
+                           sys.getallocatedblocks() - open_span.start_blocks)
+
+    def span_enter(self, stage):
+        if not self.running or threading.get_ident() != self.thread_id:
+            return
+        self.open_spans.append(self.open_span(stage))
+
+    def span_exit(self, stage):
+        if not self.running or threading.get_ident() != self.thread_id or len(self.open_spans) < 2:
+            return
+        open_span = self.open_spans.pop()
+        sample = self.close_span(open_span)
+        samples = self.stages.get(open_span.stage)
+        if samples is None:
+            samples = self.stages[open_span.stage] = collections.deque(maxlen=self.history)
+        samples.append(sample)
+
+    def end_frame(self, frame_id):
+        """ Called by the drive loop after every frame, the next frame starts now """
+        if not self.running:
+            return
+        frame_span = self.open_spans[0]
+        self.open_spans = self.open_spans[:1]  # spans left open by an exception do not leak into the next frame
+        sample = self.close_span(frame_span)
+        self.frames.append(FrameSample(frame_id, sample.net_bytes, sample.transient_bytes, sample.blocks,
+                                       tracemalloc.get_traced_memory()[0], self.frame_gc_collections,
+                                       self.frame_gc_pause_ns / 1e6))
+        self.frame_gc_collections = 0
+        self.frame_gc_pause_ns = 0
+        if self.snapshot_every and len(self.frames) % self.snapshot_every == 0:
+            self.take_snapshot(frame_id)
+        self.open_spans = [self.open_span('frame')]
+
+    def take_snapshot(self, frame_id):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        if self.last_snapshot is None:
+            statistics = snapshot.statistics('lineno')[:self.top]
+            sites = [{'site': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count}
+                     for stat in statistics]
+        else:
+            statistics = snapshot.compare_to(self.last_snapshot, 'lineno')[:self.top]
+            sites = [{'site': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count,
+                      'bytes_change': stat.size_diff, 'blocks_change': stat.count_diff} for stat in statistics]
+        self.snapshots.append((frame_id, sites))
+        self.last_snapshot = snapshot
+
+    ############################
+    # GC
+    ############################
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = spans.perf_counter_ns()
+        elif self.gc_start is not None:
+            pause_ns = spans.perf_counter_ns() - self.gc_start
+            self.gc_start = None
+            self.gc_pauses.add(pause_ns)
+            self.gc_collections[info['generation']] += 1
+            self.gc_collected += info['collected']
+            self.frame_gc_collections += 1
+            self.frame_gc_pause_ns += pause_ns
+
+    ############################
+    # Reports
+    ############################
+    def summary(self):
+        stages = {}
+        for stage, samples in self.stages.items():
+            stages[stage] = summarize(samples)
+        frames = summarize(self.frames)
+        if self.frames:
+            frames['traced_bytes_first'] = self.frames[0].traced_bytes
+            frames['traced_bytes_last'] = self.frames[-1].traced_bytes
+            frames['frames_with_gc'] = sum(1 for frame in self.frames if frame.gc_collections)
+        return {
+            'frames': frames,
+            'stages': stages,
+            'gc': dict(self.gc_pauses.summary(), collections=self.gc_collections, collected=self.gc_collected),
+            'snapshots': [{'frame_id': frame_id, 'sites': sites} for frame_id, sites in self.snapshots],
+            'per_stage_peaks': PER_STAGE_PEAKS,
+        }
+
+    def report(self):
+        summary = self.summary()
+        lines = ['%-24s %8s %12s %14s %14s %10s' % ('stage', 'count', 'net B/call', 'transient KB', 'p95 trans KB',
+                                                    'blocks')]
+        rows = sorted(summary['stages'].items())
+        if summary['frames']['count']:
+            rows.append(('(frame)', summary['frames']))
+        for stage, stats in rows:
+            lines.append('%-24s %8d %12.0f %14.1f %14.1f %10.1f' % (
+                stage, stats['count'], stats['net_bytes_mean'], stats['transient_bytes_mean'] / 1024.0,
+                stats['transient_bytes_p95'] / 1024.0, stats['blocks_mean']))
+        if not PER_STAGE_PEAKS:
+            lines.append('transient bytes not measured, tracemalloc.reset_peak() needs Python 3.9')
+        frames = summary['frames']
+        if frames['count']:
+            lines.append('traced memory %.1fKB after the first frame, %.1fKB after the last' %
+                         (frames['traced_bytes_first'] / 1024.0, frames['traced_bytes_last'] / 1024.0))
+        gc_summary = summary['gc']
+        lines.append('gc: %d collections (gen0 %d, gen1 %d, gen2 %d), %d objects collected, '
+                     'pause p50 %.3fms p99 %.3fms max %.3fms, in %d frames' % (
+                         gc_summary['count'], gc_summary['collections'][0], gc_summary['collections'][1],
+                         gc_summary['collections'][2], gc_summary['collected'], gc_summary['p50_ms'],
+                         gc_summary['p99_ms'], gc_summary['max_ms'], frames.get('frames_with_gc', 0)))
+        if self.snapshots:
+            frame_id, sites = self.snapshots[-1]
+            lines.append('top allocation sites at frame %d:' % frame_id)
+            for site in sites:
+                lines.append('    %-60s %10.1fKB %8d blocks  %+10.1fKB' % (
+                    site['site'], site['bytes'] / 1024.0, site['blocks'], site.get('bytes_change', 0) / 1024.0))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        report = self.summary()
+        report['frame_samples'] = [sample._asdict() for sample in self.frames]
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logging.info('Saved the allocation profile to %s' % path)
+        return path
+
+
+############################
+# Utility Functions
+############################
+def summarize(samples):
+    """ count, mean and p95 of every field of StageSample or FrameSample """
+    if not samples:
+        return {'count': 0, 'net_bytes_mean': 0, 'transient_bytes_mean': 0, 'transient_bytes_p95': 0,
+                'blocks_mean': 0}
+    summary = {'count': len(samples)}
+    for field in ('net_bytes', 'transient_bytes', 'blocks'):
+        values = sorted(getattr(sample, field) for sample in samples)
+        summary[field + '_mean'] = sum(values) / float(len(values))
+        summary[field + '_p95'] = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return summary
+
+
+############################
+# Test Functions
+############################
+def test_allocation_profiler():
+    profiler = AllocationProfiler(snapshot_every=5)
+    profiler.start()
+    kept = []
+    try:
+        for i in range(10):
+            with spans.span('transient'):
+                scratch = bytearray(1 << 20)  # freed before the stage ends
+                del scratch
+            with spans.span('leak'):
+                kept.append(bytearray(1 << 16))
+                with spans.span('nested'):
+                    scratch = bytearray(1 << 18)
+                    del scratch
+            gc.collect(0)
+            profiler.end_frame(i)
+        summary = profiler.summary()
+    finally:
+        profiler.stop()
+    stages = summary['stages']
+    assert abs(stages['transient']['net_bytes_mean']) < 1 << 12, stages['transient']
+    assert stages['leak']['net_bytes_mean'] >= 1 << 16, stages['leak']
+    if PER_STAGE_PEAKS:
+        assert stages['transient']['transient_bytes_mean'] >= 1 << 20, stages['transient']
+        assert stages['leak']['transient_bytes_mean'] >= 1 << 18, stages['leak']  # includes the nested stage
+    else:
+        assert stages['transient']['transient_bytes_mean'] == 0, stages['transient']
+    assert summary['frames']['count'] == 10 and summary['gc']['count'] >= 10, summary['gc']
+    assert len(summary['snapshots']) == 2, summary['snapshots']
+
+
+def main():
+    from replay_harness import lane_follower_class_by_name, replay
+
+    parser = argparse.ArgumentParser(description='Profile the allocations of the drive loop over a recorded video')
+    parser.add_argument('video')
+    parser.add_argument('--follower', choices=['end_to_end', 'hand_coded'], default='end_to_end')
+    parser.add_argument('--trace_depth', type=int, default=1, help='stack frames kept per allocation')
+    parser.add_argument('--snapshot_every', type=int, default=100, help='frames between allocation site snapshots')
+    parser.add_argument('--output', help='save the profile as JSON')
+    args = parser.parse_args()
+
+    profiler = AllocationProfiler(args.trace_depth, args.snapshot_every)
+    replay(args.video, lane_follower_class_by_name(args.follower), memory_profiler=profiler)
+    if args.output:
+        profiler.dump(args.output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
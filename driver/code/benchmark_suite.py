@@ -0,0 +1,287 @@
+"""
+Benchmarks of the driver pipelines, on synthetic and recorded frames, with regression checks.
+
+Every case is timed over --iterations runs after a warmup, and reported as median, p95 and mean ms.
+Lane following is measured at several resolutions and lane segment densities: the same road with
+solid lane lines (few Hough segments) or dashed, noisy ones (many segments).  Cases that need
+something that is not installed or not found (keras, the Edge TPU, a model file) are skipped.
+
+Usage:
+# run everything, save the results
+python benchmark_suite.py --output ../data/benchmark.json
+
+# also time recorded frames
+python benchmark_suite.py --video ../data/car_video190601_120000.avi --output ../data/benchmark.json
+
+# compare with a stored baseline, exit code 1 if any case got more than 10% slower
+python benchmark_suite.py --baseline ../data/benchmark_baseline.json --threshold 0.10
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import hand_coded_lane_follower as hand_coded
+from road_scene import RoadScene
+
+_MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../models')
+LANE_MODEL = os.path.join(_MODELS_DIR, 'lane_navigation/data/model_result/lane_navigation.h5')
+OBJECTS_MODEL = os.path.join(_MODELS_DIR, 'object_detection/data/model_result/road_signs_quantized_edgetpu.tflite')
+OBJECTS_LABELS = os.path.join(_MODELS_DIR, 'object_detection/data/model_result/road_sign_labels.txt')
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720)]
+DENSITIES = ['solid', 'dashed']
+
+
+class SkipCase(Exception):
+    pass
+
+
+############################
+# Inputs
+############################
+def synthetic_frames(width, height, density='solid', count=5):
+    """
+    Frames of a curving road from road_scene, with solid tape, or dashed tape with noise and clutter
+    for the 'dashed' density
+    """
+    if density == 'solid':
+        scene = RoadScene(width, height, seed=0)
+    else:
+        scene = RoadScene(width, height, dash_length=max(4, height // 16), noise=20, clutter=10, seed=0)
+    return [frame for frame, _ in scene.stream(count, period=count * 4)]
+
+
+def recorded_frames(video_file, count=20):
+    cap = cv2.VideoCapture(video_file)
+    frames = []
+    try:
+        while len(frames) < count:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+    finally:
+        cap.release()
+    if not frames:
+        raise IOError('No frames in %s' % video_file)
+    return frames
+
+
+############################
+# Timing
+############################
+def measure(function, iterations, warmup=3):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        'iterations': iterations,
+        'median_ms': times[len(times) // 2],
+        'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'mean_ms': sum(times) / len(times),
+    }
+
+
+def cycle(items):
+    """ Endless round-robin over items, so recorded cases see a different frame on every call """
+    state = {'i': 0}
+
+    def next_item():
+        item = items[state['i'] % len(items)]
+        state['i'] += 1
+        return item
+    return next_item
+
+
+############################
+# Cases
+############################
+def lane_cases(name, frames):
+    """ (case name, function) of the hand coded lane follower, and its stages, on the given frames """
+    next_frame = cycle(frames)
+    frame = frames[0]
+    edges = hand_coded.detect_edges(frame)
+    cropped = hand_coded.region_of_interest(edges)
+    segments = hand_coded.detect_line_segments(cropped)
+    lane_lines = hand_coded.average_slope_intercept(frame, segments)
+    steering_angle = hand_coded.compute_steering_angle(frame, lane_lines) if lane_lines else 90
+    follower = hand_coded.HandCodedLaneFollower()
+    num_segments = 0 if segments is None else len(segments)
+
+    def draw():
+        image = hand_coded.display_lines(frame, lane_lines)
+        hand_coded.display_heading_line(image, steering_angle)
+
+    return [
+        ('%s/follow_lane' % name, lambda: follower.follow_lane(next_frame())),
+        ('%s/detect_edges' % name, lambda: hand_coded.detect_edges(frame)),
+        ('%s/region_of_interest' % name, lambda: hand_coded.region_of_interest(edges)),
+        ('%s/detect_line_segments' % name, lambda: hand_coded.detect_line_segments(cropped)),
+        ('%s/average_slope_intercept' % name, lambda: hand_coded.average_slope_intercept(frame, segments)),
+        ('%s/draw_overlay' % name, draw),
+    ], num_segments
+
+
+def end_to_end_cases(name, frames, model_path):
+    try:
+        import end_to_end_lane_follower as end_to_end
+    except ImportError as e:
+        raise SkipCase('keras is not installed: %s' % e)
+    next_frame = cycle(frames)
+    cases = [('%s/img_preprocess' % name, lambda: end_to_end.img_preprocess(next_frame()))]
+    if os.path.exists(model_path):
+        from keras.models import load_model
+        model = load_model(model_path)
+        X = np.asarray([end_to_end.img_preprocess(frames[0])])
+        cases.append(('%s/steering_model_predict' % name, lambda: model.predict(X)))
+    else:
+        logging.info('Skipping the steering model, %s not found' % model_path)
+    return cases
+
+
+def control_car_case(model_path, labels_path):
+    try:
+        from objects_on_road_processor import ObjectsOnRoadProcessor
+    except ImportError as e:
+        raise SkipCase('the Edge TPU library is not installed: %s' % e)
+    if not os.path.exists(model_path):
+        raise SkipCase('%s not found' % model_path)
+    processor = ObjectsOnRoadProcessor(model=model_path, label=labels_path)
+    DetectedObject = collections.namedtuple('DetectedObject', ['label_id', 'score', 'bounding_box'])
+    # a speed limit sign close by and a green light far away, nothing that makes control_car sleep
+    objects = [DetectedObject(3, 0.9, [[100, 100], [160, 200]]),
+               DetectedObject(0, 0.8, [[300, 50], [305, 55]])]
+    return [('objects/control_car', lambda: processor.control_car(objects))]
+
+
+def run_suite(iterations=50, video_file=None, resolutions=RESOLUTIONS, lane_model=LANE_MODEL,
+              objects_model=OBJECTS_MODEL, objects_labels=OBJECTS_LABELS):
+    results = {}
+    skipped = {}
+
+    def run(cases, extra=None):
+        for case_name, function in cases:
+            results[case_name] = measure(function, iterations)
+            if extra:
+                results[case_name].update(extra)
+            logging.info('%-48s median %8.3fms  p95 %8.3fms' %
+                         (case_name, results[case_name]['median_ms'], results[case_name]['p95_ms']))
+
+    inputs = []
+    for width, height in resolutions:
+        for density in DENSITIES:
+            inputs.append(('synthetic_%dx%d_%s' % (width, height, density),
+                           synthetic_frames(width, height, density)))
+    if video_file:
+        inputs.append(('recorded_%s' % os.path.splitext(os.path.basename(video_file))[0],
+                       recorded_frames(video_file)))
+
+    for name, frames in inputs:
+        cases, num_segments = lane_cases(name, frames)
+        run(cases, {'line_segments': num_segments})
+
+    # the model input is always resized to 200x66, one synthetic and the recorded input are enough
+    model_inputs = inputs[:1] + (inputs[-1:] if video_file else [])
+    for name, frames in model_inputs:
+        try:
+            run(end_to_end_cases(name, frames, lane_model))
+        except SkipCase as e:
+            skipped['%s/end_to_end' % name] = str(e)
+
+    try:
+        run(control_car_case(objects_model, objects_labels))
+    except SkipCase as e:
+        skipped['objects/control_car'] = str(e)
+
+    for case_name, reason in skipped.items():
+        logging.info('Skipped %s: %s' % (case_name, reason))
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'iterations': iterations,
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+############################
+# Baseline comparison
+############################
+def compare(report, baseline, threshold=0.10):
+    """ Returns the cases whose median got slower than the baseline by more than threshold (a fraction) """
+    regressions = []
+    print('%-48s %10s %10s %8s' % ('case', 'base ms', 'now ms', 'change'))
+    for case_name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(case_name)
+        if base is None:
+            print('%-48s %10s %10.3f %8s' % (case_name, '-', result['median_ms'], 'new'))
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(case_name)
+            flag = '  REGRESSION'
+        print('%-48s %10.3f %10.3f %+7.1f%%%s' % (case_name, base['median_ms'], result['median_ms'],
+                                                  change * 100, flag))
+    if baseline['meta'].get('machine') != report['meta'].get('machine'):
+        print('Warning: the baseline was measured on %s, this run on %s' %
+              (baseline['meta'].get('machine'), report['meta'].get('machine')))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the driver pipelines')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--video', help='also benchmark the first frames of this recorded video')
+    parser.add_argument('--resolutions', default=','.join('%dx%d' % r for r in RESOLUTIONS),
+                        help='comma separated WIDTHxHEIGHT list of synthetic frame sizes')
+    parser.add_argument('--lane_model', default=LANE_MODEL)
+    parser.add_argument('--objects_model', default=OBJECTS_MODEL)
+    parser.add_argument('--objects_labels', default=OBJECTS_LABELS)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown of the median, as a fraction, that counts as a regression')
+    args = parser.parse_args()
+
+    resolutions = [tuple(int(x) for x in r.split('x')) for r in args.resolutions.split(',')]
+    report = run_suite(args.iterations, args.video, resolutions, args.lane_model, args.objects_model,
+                       args.objects_labels)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logging.info('Saved the results to %s' % args.output)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print('%d regressions over %.0f%%: %s' % (len(regressions), args.threshold * 100, ', '.join(regressions)))
+            sys.exit(1)
+        print('No regressions over %.0f%%' % (args.threshold * 100))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-5s:%(asctime)s: %(message)s')
+
+    main()
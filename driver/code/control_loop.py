@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from hand_coded_lane_follower import stabilize_steering_angle_rate
+
+
+class SteeringController(object):
+    """
+    Fixed-rate steering control, decoupled from the vision frame rate.
+
+    The lane follower calls update() with every new steering estimate and the capture time
+    of its frame.  A control thread runs at rate_hz, and on every tick
+    1) interpolates from the previous estimate to the latest one, over one vision interval
+    2) rate-limits the result in degrees per second (see stabilize_steering_angle_rate)
+    3) turns the front wheels
+    so the handling stays the same when the vision pipeline gets slower or jitters.
+
+    With a latency_trace.LatencyTracer, every tick's write is tagged with the frame of the latest estimate,
+    front_wheels must then accept turn(angle, frame), as the Actuator and TracedFrontWheels do.
+    """
+
+    def __init__(self, front_wheels, rate_hz=50, max_rate_two_lines=100, max_rate_one_lane=20,
+                 initial_angle=90, tracer=None):
+        logging.info('Creating a SteeringController at %s Hz...' % rate_hz)
+        self.front_wheels = front_wheels
+        self.period = 1.0 / rate_hz
+        self.max_rate_two_lines = max_rate_two_lines
+        self.max_rate_one_lane = max_rate_one_lane
+        self.tracer = tracer
+        self.last_frame = None  # FrameTrace of the latest estimate
+
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        self.prev_estimate = (now, initial_angle)
+        self.last_estimate = (now, initial_angle)
+        self.num_of_lane_lines = 2
+        self.angle = float(initial_angle)  # angle the wheels are turned to
+
+        self.ticks = 0
+        self.overruns = 0  # ticks that started late by more than one period
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='steering_controller')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, steering_angle, num_of_lane_lines, timestamp=None):
+        """ New vision estimate, timestamp is time.monotonic() when its frame was captured """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            if timestamp <= self.last_estimate[0]:
+                logging.debug('Ignoring out of order steering estimate')
+                return
+            # interpolate from where we are heading now, so a new estimate never makes the target jump
+            self.prev_estimate = (self.last_estimate[0], self.target_angle(timestamp))
+            self.last_estimate = (timestamp, steering_angle)
+            self.num_of_lane_lines = num_of_lane_lines
+            if self.tracer is not None:
+                self.last_frame = self.tracer.current_frame()
+
+    def target_angle(self, now):
+        """ Linear interpolation from the previous to the latest estimate, over the last vision interval """
+        prev_time, prev_angle = self.prev_estimate
+        last_time, last_angle = self.last_estimate
+        interval = last_time - prev_time
+        if interval <= 0:
+            return last_angle
+        progress = min(1.0, max(0.0, (now - last_time) / interval))
+        return prev_angle + (last_angle - prev_angle) * progress
+
+    def steering_angle(self):
+        return int(round(self.angle))
+
+    def run(self):
+        next_tick = time.monotonic()
+        last_tick = next_tick
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                target = self.target_angle(now)
+                num_of_lane_lines = self.num_of_lane_lines
+                frame = self.last_frame
+            self.angle = stabilize_steering_angle_rate(self.angle, target, num_of_lane_lines, now - last_tick,
+                                                       self.max_rate_two_lines, self.max_rate_one_lane)
+            last_tick = now
+            if self.tracer is not None:
+                self.front_wheels.turn(self.steering_angle(), frame)
+            else:
+                self.front_wheels.turn(self.steering_angle())
+            self.ticks += 1
+
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.period:
+                # fell behind, don't try to catch up with a burst of ticks
+                self.overruns += 1
+                next_tick = time.monotonic()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        logging.info('SteeringController: %d ticks, %d overruns' % (self.ticks, self.overruns))
+
+
+############################
+# Test Functions
+############################
+def test_steering_controller():
+    import fake_picar
+
+    front_wheels = fake_picar.FakeFrontWheels()
+    controller = SteeringController(front_wheels, rate_hz=50)
+
+    # vision at 5 frames per second, asking for a hard right turn
+    start = time.monotonic()
+    for i in range(5):
+        controller.update(130, 2, time.monotonic())
+        time.sleep(0.2)
+    controller.stop()
+    elapsed = time.monotonic() - start
+
+    times = [t for t, _ in front_wheels.writes]
+    angles = [angle for _, angle in front_wheels.writes]
+    logging.info('%d writes in %.2fs, angles %s' % (len(angles), elapsed, angles))
+
+    # steady control rate, independent of the vision rate
+    assert len(angles) >= 40 * elapsed, len(angles)
+    # never faster than 100 degrees per second (plus rounding)
+    for (t1, a1), (t2, a2) in zip(front_wheels.writes, front_wheels.writes[1:]):
+        assert abs(a2 - a1) <= 100 * (t2 - t1) + 1.5, (t1, a1, t2, a2)
+    assert angles[-1] == 130, angles
+    assert times == sorted(times)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_steering_controller()
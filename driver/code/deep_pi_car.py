@@ -1,11 +1,28 @@
+import argparse
 import logging
-import picar
 import cv2
 import datetime
-from end_to_end_lane_follower import EndToEndLaneFollower
+import os
+import signal
+import time
+from actuator import Actuator
+from control_loop import SteeringController
+from frame_budget import FrameBudget
+from latency_trace import LatencyTracer, TracedBackWheels, TracedFrontWheels, ACTION_LOG
+from raw_capture import RawCaptureRecorder
+from spans import span
+from telemetry import TelemetryRing
+try:
+    import picar
+except ImportError:
+    picar = None  # not on the car, pass picar_backend=fake_picar, see replay_harness.py
 #from objects_on_road_processor import ObjectsOnRoadProcessor
 
-_SHOW_IMAGE = True
+_SHOW_IMAGE = True  # show the lane lines in a window, when a display is attached
+
+# Recording modes
+RECORD_OVERLAY = 'overlay'  # encode lane and object overlay videos live, on the car
+RECORD_RAW = 'raw'  # record original frames plus telemetry, render overlays offline with render_overlays.py
 
 
 class DeepPiCar(object):
@@ -14,42 +31,117 @@ class DeepPiCar(object):
     __SCREEN_WIDTH = 320
     __SCREEN_HEIGHT = 240
 
-    def __init__(self):
-        """ Init camera and wheels"""
+    def __init__(self, record_mode=RECORD_OVERLAY, actuator_rate_hz=50, control_rate_hz=None,
+                 picar_backend=None, camera=None, lane_follower_class=None, data_dir='../data',
+                 display=None, latency_budget_ms=None, latency_action=ACTION_LOG, telemetry_frames=36000,
+                 memory_profiler=None, governor=None, frame_budget_ms=None):
+        """ Init camera and wheels
+
+        Keyword arguments:
+        record_mode -- RECORD_OVERLAY or RECORD_RAW
+        actuator_rate_hz -- max rate of wheel writes, None to write to the wheels directly from the vision thread
+        control_rate_hz -- steer from a fixed-rate control thread, None to steer once per processed frame
+        picar_backend -- module with the picar API, defaults to picar, fake_picar simulates the car
+        camera -- object with the cv2.VideoCapture API, defaults to the car camera
+        lane_follower_class -- class of the lane follower, defaults to EndToEndLaneFollower
+        data_dir -- directory of the recorded videos
+        display -- display sink, e.g. display_sink.HighGuiDisplay(), None to run headless
+        latency_budget_ms -- capture to wheel write budget, checked by the latency watchdog, None for no watchdog
+        latency_action -- latency_trace.ACTION_LOG or ACTION_BRAKE, what the watchdog does over budget
+        telemetry_frames -- size of the telemetry ring buffer, dumped to data_dir on exit, see telemetry.py
+        memory_profiler -- alloc_profile.AllocationProfiler, profiles the allocations of drive(), None for no profiling
+        governor -- quality_governor.QualityGovernor, lowers the workload when the Pi is hot, throttled or slow
+        frame_budget_ms -- capture to end of frame budget, optional work is skipped or done cheaper to keep it,
+                           see frame_budget.py, None for no budget
+        """
         logging.info('Creating a DeepPiCar...')
 
-        picar.setup()
+        if picar_backend is None:
+            picar_backend = picar
+        picar_backend.setup()
 
         logging.debug('Set up camera')
-        self.camera = cv2.VideoCapture(-1)
+        self.camera = camera if camera is not None else cv2.VideoCapture(-1)
         self.camera.set(3, self.__SCREEN_WIDTH)
         self.camera.set(4, self.__SCREEN_HEIGHT)
 
-        self.pan_servo = picar.Servo.Servo(1)
+        self.pan_servo = picar_backend.Servo.Servo(1)
         self.pan_servo.offset = -30  # calibrate servo to center
         self.pan_servo.write(90)
 
-        self.tilt_servo = picar.Servo.Servo(2)
+        self.tilt_servo = picar_backend.Servo.Servo(2)
         self.tilt_servo.offset = 20  # calibrate servo to center
         self.tilt_servo.write(90)
 
         logging.debug('Set up back wheels')
-        self.back_wheels = picar.back_wheels.Back_Wheels()
+        self.back_wheels = picar_backend.back_wheels.Back_Wheels()
         self.back_wheels.speed = 0  # Speed Range is 0 (stop) - 100 (fastest)
 
         logging.debug('Set up front wheels')
-        self.front_wheels = picar.front_wheels.Front_Wheels()
+        self.front_wheels = picar_backend.front_wheels.Front_Wheels()
         self.front_wheels.turning_offset = 15  # calibrate servo to center
         self.front_wheels.turn(90)  # Steering Range is 45 (left) - 90 (center) - 135 (right)
 
-        self.lane_follower = EndToEndLaneFollower(self)
+        # every frame gets an id and a capture time, traced to the wheel writes based on it
+        self.tracer = LatencyTracer(latency_budget_ms, latency_action, on_brake=self.brake)
+        self.actuator = None
+        if actuator_rate_hz is not None:
+            # from here on, wheel commands are deduped, coalesced and written by the actuator thread
+            self.actuator = Actuator(self.front_wheels, self.back_wheels, actuator_rate_hz, self.tracer)
+            self.front_wheels = self.actuator.front_wheels
+            self.back_wheels = self.actuator.back_wheels
+        else:
+            self.front_wheels = TracedFrontWheels(self.front_wheels, self.tracer)
+            self.back_wheels = TracedBackWheels(self.back_wheels, self.tracer)
+
+        if lane_follower_class is None:
+            from end_to_end_lane_follower import EndToEndLaneFollower
+            lane_follower_class = EndToEndLaneFollower
+        self.lane_follower = lane_follower_class(self)
         # self.lane_follower = ManualDriveLaneFollower(self)
         # self.traffic_sign_processor = ObjectsOnRoadProcessor(self)
 
+        self.frame_budget = None
+        if frame_budget_ms is not None:
+            self.frame_budget = FrameBudget(frame_budget_ms)
+            self.lane_follower.frame_budget = self.frame_budget
+
+        self.steering_controller = None
+        if control_rate_hz is not None:
+            self.steering_controller = SteeringController(self.front_wheels, control_rate_hz, tracer=self.tracer)
+            self.lane_follower.steering_controller = self.steering_controller
+
         self.fourcc = cv2.VideoWriter_fourcc(*'XVID')
         datestr = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-        self.video_lane = self.create_video_recorder('../data/car_video_lane%s.avi' % datestr)
-        self.video_objs = self.create_video_recorder('../data//car_video_objs%s.avi' % datestr)
+        self.display = display
+        self.running = False
+        self.drive_speed = 0  # the speed given to drive(), restored when the latency brake is released
+        self.brake_release_requested = False
+        self.record_mode = record_mode
+        self.video_orig = None
+        self.video_lane = None
+        self.video_objs = None
+        self.raw_recorder = None
+        self.telemetry = TelemetryRing(telemetry_frames)
+        self.telemetry_path = os.path.join(data_dir, 'car_telemetry%s.npy' % datestr)
+        self.lane_ms = 0.0  # stage times of the current frame, for the telemetry
+        self.objects_ms = 0.0
+        self.record_ms = 0.0
+        self.recorded = False  # the current frame was written to the videos, see TELEMETRY_DTYPE
+        self.memory_profiler = memory_profiler
+        self.governor = governor
+        self.record_enabled = True  # off at the lowest quality level, see apply_quality()
+        if record_mode == RECORD_RAW:
+            # no overlays are drawn on the car, render_overlays.py rebuilds them from the telemetry
+            self.lane_follower.draw_overlay = False
+            self.raw_recorder = RawCaptureRecorder(os.path.join(data_dir, 'car_video%s.avi' % datestr),
+                                                   os.path.join(data_dir, 'car_telemetry%s.jsonl' % datestr),
+                                                   self.fourcc, 20.0, (self.__SCREEN_WIDTH, self.__SCREEN_HEIGHT))
+        else:
+            self.video_orig_path = os.path.join(data_dir, 'car_video%s.avi' % datestr)
+            self.video_orig = self.create_video_recorder(self.video_orig_path)
+            self.video_lane = self.create_video_recorder(os.path.join(data_dir, 'car_video_lane%s.avi' % datestr))
+            self.video_objs = self.create_video_recorder(os.path.join(data_dir, 'car_video_objs%s.avi' % datestr))
 
         logging.info('Created a DeepPiCar')
 
@@ -71,15 +163,28 @@ class DeepPiCar(object):
     def cleanup(self):
         """ Reset the hardware"""
         logging.info('Stopping the car, resetting hardware.')
+        self.tracer.stop()
+        if self.frame_budget is not None:
+            logging.info('Frame budget: %s' % self.frame_budget.stats())
+        if self.memory_profiler is not None:
+            self.memory_profiler.stop()
+        if self.steering_controller is not None:
+            self.steering_controller.stop()
         self.back_wheels.speed = 0
         self.front_wheels.turn(90)
+        if self.actuator is not None:
+            self.actuator.stop()
         self.camera.release()
-        self.video_lane.release()
-        self.video_objs.release()
-        cv2.destroyAllWindows()
+        for recorder in (self.video_orig, self.video_lane, self.video_objs, self.raw_recorder):
+            if recorder is not None:
+                recorder.release()
+        if self.display is not None:
+            self.display.close()
+        if len(self.telemetry):
+            self.dump_telemetry()
 
     def drive(self, speed=__INITIAL_SPEED):
-        """ Main entry point of the car, and put it in drive mode
+        """ Main entry point of the car, and put it in drive mode, until stop() is called
 
         Keyword arguments:
         speed -- speed of back wheel, range is 0 (stop) - 100 (fastest)
@@ -87,45 +192,236 @@ class DeepPiCar(object):
 
         logging.info('Starting to drive at speed %s...' % speed)
         self.back_wheels.speed = speed
-        i = 0
-        while self.camera.isOpened():
-            _, image_lane = self.camera.read()
-            image_objs = image_lane.copy()
-            i += 1
-            self.video_orig.write(image_lane)
-
-            #image_objs = self.process_objects_on_road(image_objs)
-            #self.video_objs.write(image_objs)
-            #show_image('Detected Objects', image_objs)
-
-            image_lane = self.follow_lane(image_lane)
-            self.video_lane.write(image_lane)
-            show_image('Lane Lines', image_lane)
-
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                self.cleanup()
+        self.drive_speed = speed
+        self.running = True
+        self.tracer.start_watchdog()
+        if self.memory_profiler is not None:
+            self.memory_profiler.start()
+        frame_start = time.perf_counter()
+        while self.running and self.camera.isOpened():
+            with span('capture'):
+                ret, image_lane = self.camera.read()
+            if not ret:
+                if getattr(self.camera, 'end_of_stream', False):
+                    logging.info('End of the replayed video, stopping.')  # replay_harness.ReplayCamera
+                else:
+                    logging.error('Can not read from camera, stopping.')
+                break
+            capture_time = time.monotonic()
+            timestamp = time.time()
+            capture_ms = (time.perf_counter() - frame_start) * 1000
+            frame = self.tracer.begin_frame(capture_time)
+            if self.brake_release_requested:
+                # on a fresh frame, so the speed command is not late by the time the brake was on
+                self.brake_release_requested = False
+                self.tracer.reset_brake()
+                self.back_wheels.speed = self.drive_speed
+            if self.frame_budget is not None:
+                self.frame_budget.start()
+            self.lane_ms = self.objects_ms = self.record_ms = 0.0
+            self.recorded = False
+            record = self.record_enabled
+            if self.record_mode == RECORD_RAW:
+                self.drive_raw_capture(image_lane, timestamp, capture_time, record)
+            else:
+                image_orig = image_lane
+
+                # steer first, the original frame is recorded after, the followers do not draw on it
+                image_lane = self.follow_lane(image_lane, capture_time)
+
+                #image_objs = self.process_objects_on_road(image_orig.copy())
+                #self.video_objs.write(image_objs)
+                #self.show('Detected Objects', image_objs)
+
+                # both videos get the frame, or neither, so they stay aligned with each other and the telemetry
+                if record and self.within_budget('record'):
+                    record_start = time.perf_counter()
+                    with span('encoding'):
+                        self.video_orig.write(image_orig)
+                        self.video_lane.write(image_lane)
+                    self.observe_record(record_start)
+                self.show('Lane Lines', image_lane)
+
+            if self.frame_budget is not None:
+                self.frame_budget.end()
+            now = time.perf_counter()
+            frame_ms = (now - frame_start) * 1000
+            self.record_telemetry(timestamp, frame.frame_id, capture_ms, frame_ms)
+            if self.governor is not None:
+                level = self.governor.update(frame_ms - capture_ms)  # processing time, without the camera wait
+                if level is not None:
+                    self.apply_quality(level)
+            if self.memory_profiler is not None:
+                self.memory_profiler.end_frame(frame.frame_id)
+            frame_start = now
+            if self.display is not None and self.display.poll_quit():
                 break
+        self.running = False
+
+    def stop(self):
+        """ Ask the drive loop to exit after the current frame, safe to call from a signal handler """
+        logging.info('Stop requested.')
+        self.running = False
+
+    def brake(self):
+        """ Stop the back wheels, called by the latency watchdog with ACTION_BRAKE """
+        self.back_wheels.speed = 0
+
+    def release_brake(self):
+        """ Ask the drive loop to release the latency brake and drive on at its speed from the next frame,
+            safe to call from a signal handler """
+        logging.info('Brake release requested.')
+        self.brake_release_requested = True
+
+    def apply_quality(self, level):
+        """ Set the workload knobs to a quality_governor.QualityLevel """
+        follower = self.lane_follower
+        if hasattr(follower, 'lane_scale'):
+            follower.lane_scale = level.lane_scale  # the end to end model always resizes to its input size
+        processor = getattr(self, 'traffic_sign_processor', None)
+        if processor is not None:
+            processor.detect_every = level.objects_every
+            processor.draw_overlay = level.draw_overlay
+        if self.record_mode != RECORD_RAW:
+            # in raw mode nothing is drawn anyway
+            follower.draw_overlay = level.draw_overlay
+        self.record_enabled = level.record
+
+    def show(self, title, image):
+        if self.display is not None:
+            self.display.show(title, image)
+
+    def drive_multiprocess(self, speed=__INITIAL_SPEED, lane_follower='end_to_end', detect_objects=False):
+        """ Same as drive(), but lane following, object detection and recording run in their own processes
+
+        Keyword arguments:
+        speed -- speed of back wheel, range is 0 (stop) - 100 (fastest)
+        lane_follower -- 'end_to_end' or 'hand_coded'
+        detect_objects -- also run the ObjectsOnRoadProcessor, which then controls the speed
+        """
+        from multiprocess_runtime import MultiProcessRuntime
+
+        logging.info('Starting to drive at speed %s, multi-process...' % speed)
+        record_path = None
+        if self.video_orig is not None:
+            # the recorder worker takes over the (still empty) original video
+            self.video_orig.release()
+            self.video_orig = None
+            record_path = self.video_orig_path
+        runtime = MultiProcessRuntime(self.camera, self.front_wheels, self.back_wheels,
+                                      lane_follower=lane_follower, detect_objects=detect_objects,
+                                      record_path=record_path)
+        # stop() and the signal handlers clear self.running, the runtime checks it before every frame
+        self.running = True
+        runtime.run(speed, running=lambda: self.running)
+
+    def drive_raw_capture(self, image, timestamp, capture_time=None, record=True):
+        """ Process one frame without drawing anything, record the original frame and its telemetry """
+        objects = None
+        #self.process_objects_on_road(image)
+        #objects = self.traffic_sign_processor.objects
+
+        self.follow_lane(image, capture_time)
+        if not record or not self.within_budget('record'):
+            return
+        record_start = time.perf_counter()
+        with span('encoding'):
+            self.raw_recorder.record(image, timestamp, self.lane_follower.curr_steering_angle, self.back_wheels.speed,
+                                     getattr(self.lane_follower, 'lane_lines', None), objects)
+        self.observe_record(record_start)
+
+    def observe_record(self, record_start):
+        """ The current frame was recorded, starting at record_start """
+        record_ms = (time.perf_counter() - record_start) * 1000
+        self.recorded = True
+        self.record_ms += record_ms
+        if self.frame_budget is not None:
+            self.frame_budget.observe('record', record_ms)
+
+    def within_budget(self, stage):
+        """ True if there is no frame budget, or stage fits in what is left of it, else counts stage as skipped """
+        if self.frame_budget is None or self.frame_budget.allows(stage):
+            return True
+        self.frame_budget.skip(stage)
+        return False
 
     def process_objects_on_road(self, image):
+        if not self.within_budget('objects'):
+            return image  # the objects and the speed from the last detection still hold
+        start = time.perf_counter()
         image = self.traffic_sign_processor.process_objects_on_road(image)
+        self.objects_ms = (time.perf_counter() - start) * 1000
+        if self.frame_budget is not None:
+            self.frame_budget.observe('objects', self.objects_ms)
         return image
 
-    def follow_lane(self, image):
-        image = self.lane_follower.follow_lane(image)
+    def follow_lane(self, image, capture_time=None):
+        start = time.perf_counter()
+        image = self.lane_follower.follow_lane(image, capture_time)
+        self.lane_ms = (time.perf_counter() - start) * 1000
         return image
 
+    def record_telemetry(self, timestamp, frame_id, capture_ms, frame_ms):
+        follower = self.lane_follower
+        if self.steering_controller is not None:
+            steering_angle = self.steering_controller.steering_angle()
+        else:
+            steering_angle = follower.curr_steering_angle
+        lane_lines = getattr(follower, 'lane_lines', None)  # the end to end model has no lane lines, -1
+        processor = getattr(self, 'traffic_sign_processor', None)
+        self.telemetry.record(timestamp, frame_id, getattr(follower, 'proposed_steering_angle', steering_angle),
+                              steering_angle, -1 if lane_lines is None else len(lane_lines),
+                              getattr(follower, 'num_line_segments', -1),
+                              len(processor.objects) if processor is not None else 0,
+                              self.back_wheels.speed or 0,
+                              capture_ms, self.lane_ms, self.objects_ms, self.record_ms, frame_ms,
+                              self.recorded)
+
+    def dump_telemetry(self, path=None):
+        """ Write the telemetry ring buffer to path, by default car_telemetry<date>.npy in the data directory """
+        return self.telemetry.dump(path or self.telemetry_path)
+
 
 ############################
 # Utility Functions
 ############################
-def show_image(title, frame, show=_SHOW_IMAGE):
-    if show:
-        cv2.imshow(title, frame)
+def handle_signals(car):
+    """ SIGINT (Ctrl-C) and SIGTERM stop the drive loop, so the with statement still runs cleanup()
+        SIGUSR1 dumps the telemetry collected so far, without stopping
+        SIGUSR2 releases the latency brake (latency_action='brake'), the car drives on """
+    def stop_car(signum, _frame):
+        logging.info('Received signal %s' % signum)
+        car.stop()
+
+    def dump_telemetry(_signum, _frame):
+        car.dump_telemetry()
+
+    signal.signal(signal.SIGINT, stop_car)
+    signal.signal(signal.SIGTERM, stop_car)
+    signal.signal(signal.SIGUSR1, dump_telemetry)
+    signal.signal(signal.SIGUSR2, lambda _signum, _frame: car.release_brake())
 
 
 def main():
-    with DeepPiCar() as car:
-        car.drive(40)
+    parser = argparse.ArgumentParser(description='Drive the DeepPiCar')
+    parser.add_argument('--speed', type=int, default=40)
+    parser.add_argument('--frame_budget', type=float, help='per-frame budget (ms), skip or degrade work to keep it')
+    parser.add_argument('--governor', action='store_true',
+                        help='lower the workload when the cpu is hot, throttled or the loop is slow')
+    args = parser.parse_args()
+
+    display = None
+    if _SHOW_IMAGE and os.environ.get('DISPLAY'):
+        from display_sink import HighGuiDisplay
+        display = HighGuiDisplay()
+    governor = None
+    if args.governor:
+        from quality_governor import QualityGovernor
+        governor = QualityGovernor()
+
+    with DeepPiCar(display=display, governor=governor, frame_budget_ms=args.frame_budget) as car:
+        handle_signals(car)
+        car.drive(args.speed)
 
 
 if __name__ == '__main__':
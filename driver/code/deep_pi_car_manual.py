@@ -2,7 +2,9 @@ import logging
 import picar
 import cv2
 import datetime
-import getch
+import time
+from frame_writer import FrameWriter, ENCODING_PNG
+from keyboard_input import KeyboardInput
 from manual_drive_follower import ManualDriveLaneFollower
 #from objects_on_road_processor import ObjectsOnRoadProcessor
 
@@ -15,8 +17,14 @@ class DeepPiCar(object):
     __SCREEN_WIDTH = 320
     __SCREEN_HEIGHT = 240
 
-    def __init__(self):
-        """ Init camera and wheels"""
+    def __init__(self, frame_encoding=ENCODING_PNG, frame_dir='.', dedup_threshold=None):
+        """ Init camera and wheels
+
+        Keyword arguments:
+        frame_encoding -- encoding of the saved training frames, ENCODING_PNG, ENCODING_JPEG or ENCODING_RAW
+        frame_dir -- directory of the saved training frames
+        dedup_threshold -- skip saving near-duplicate frames, see frame_dedup.py, None saves every frame
+        """
         logging.info('Creating a DeepPiCar...')
 
         picar.setup()
@@ -52,6 +60,8 @@ class DeepPiCar(object):
         self.video_orig = self.create_video_recorder('../data/car_video%s.avi' % datestr)
         self.video_lane = self.create_video_recorder('../data/car_video_lane%s.avi' % datestr)
         self.video_objs = self.create_video_recorder('../data//car_video_objs%s.avi' % datestr)
+        # training frames are encoded and written in the background, off the capture thread
+        self.frame_writer = FrameWriter(frame_dir, 'd9', frame_encoding, dedup_threshold=dedup_threshold)
 
         logging.info('Created a DeepPiCar')
 
@@ -79,6 +89,7 @@ class DeepPiCar(object):
         self.video_orig.release()
         self.video_lane.release()
         self.video_objs.release()
+        self.frame_writer.close()
         cv2.destroyAllWindows()
 
     def drive(self, speed=__INITIAL_SPEED):
@@ -90,6 +101,8 @@ class DeepPiCar(object):
         datestring = datetime.datetime.now().strftime("%y/%m/%d %H:%M:%S.%f")
         logging.info('Starting to drive at speed %s...' % speed)
         self.back_wheels.speed = speed
+        # keys are read on a background thread, so frames are captured at camera rate, not at keypress rate
+        keyboard = KeyboardInput()
         i = 0
         while self.camera.isOpened():
             _, image_lane = self.camera.read()
@@ -100,19 +113,18 @@ class DeepPiCar(object):
             #image_objs = self.process_objects_on_road(image_objs)
             #self.video_objs.write(image_objs)
             #show_image('Detected Objects', image_objs)
-            
-            image_lane = self.manual_drive(image_lane, 'n')
-            #self.video_lane.write(image_lane)
-            show_image('Lane Lines', image_lane)           
 
-            if cv2.waitKey(1):
-                input = getch.getch()
-                if input == 'q':
-                    self.cleanup()
-                    break
-                image_lane = self.manual_drive(image_lane, input)
+            keys = keyboard.keys()
+            if 'q' in keys:
+                self.cleanup()
+                break
+            image_lane = self.manual_drive(image_lane, keys)
+            #self.video_lane.write(image_lane)
+            show_image('Lane Lines', image_lane)
+            if _SHOW_IMAGE:
+                cv2.waitKey(1)  # let HighGUI draw the window
 
-            cv2.imwrite("%s_%03d_%03d.png" % ('d9', i, self.lane_follower.curr_steering_angle), image_lane)
+            self.frame_writer.submit(image_lane, self.lane_follower.curr_steering_angle, time.time())
             i += 1
 
     def process_objects_on_road(self, image):
@@ -123,8 +135,8 @@ class DeepPiCar(object):
         image = self.lane_follower.follow_lane(image)
         return image
         
-    def manual_drive(self, image, input):
-        image = self.lane_follower.manual_drive(image, input)
+    def manual_drive(self, image, keys):
+        image = self.lane_follower.manual_drive(image, keys)
         return image
 
 ############################
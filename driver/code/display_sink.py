@@ -0,0 +1,78 @@
+"""
+Optional display sinks for the drive loop.
+
+On the car we run headless over SSH, so DeepPiCar takes no display by default and the
+drive loop makes no HighGUI calls at all.  A sink is any object with
+
+    show(title, frame)  -- called with every processed frame
+    poll_quit()         -- True if the user asked to quit
+    close()
+
+Pass HighGuiDisplay() when a screen is attached, or SnapshotPreview() to peek at the
+camera over SSH without a window system.  Shutdown in headless mode comes from SIGINT/SIGTERM,
+see handle_signals in deep_pi_car.py.
+"""
+import cv2
+import logging
+import threading
+
+
+class HighGuiDisplay(object):
+    """ Shows frames in OpenCV windows, pressing 'q' in a window quits """
+
+    def show(self, title, frame):
+        cv2.imshow(title, frame)
+
+    def poll_quit(self):
+        return cv2.waitKey(1) & 0xFF == ord('q')
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class SnapshotPreview(object):
+    """
+    Headless preview: every `every_n_frames` frames, the latest frame is written as a JPEG
+    to `path` by a background thread, e.g. to be viewed with `feh --reload 1` over ssh -X,
+    or served by any static web server.  show() never blocks on encoding.
+    """
+
+    def __init__(self, path='/tmp/deep_pi_car_preview.jpg', every_n_frames=10, jpeg_quality=70):
+        logging.info('Writing preview snapshots to %s' % path)
+        self.path = path
+        self.every_n_frames = every_n_frames
+        self.jpeg_quality = jpeg_quality
+        self.frame_count = 0
+        self.latest = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='snapshot_preview')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def show(self, title, frame):
+        self.frame_count += 1
+        if self.frame_count % self.every_n_frames != 0:
+            return
+        with self.condition:
+            self.latest = frame
+            self.condition.notify()
+
+    def poll_quit(self):
+        return False
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.latest is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                frame, self.latest = self.latest, None
+            cv2.imwrite(self.path, frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
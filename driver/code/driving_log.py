@@ -0,0 +1,208 @@
+"""
+Compact, memory-mappable driving log for training data.
+
+A log is a directory with
+    frames_00000.npy, frames_00001.npy, ...  fixed-size chunks of frames, shape (chunk_size, H, W, 3), uint8
+    index.npy                                structured array, one record per frame, see INDEX_DTYPE
+    meta.json                                frame shape, chunk size and the list of source videos
+
+Chunks are plain .npy files, so the reader maps them with np.load(mmap_mode='r') and a frame is a
+view into the page cache: no per-file open, no PNG decode, no file name parsing.
+
+The writer rewrites index.npy and meta.json whenever a chunk is full (and on flush() and close()), each
+replaced in one rename, so a crash or a power cut loses at most the frames of the last chunk.
+
+Usage:
+python driving_log.py convert ../../models/lane_navigation/data/images ../data/driving_log
+python driving_log.py info ../data/driving_log
+"""
+import argparse
+import csv
+import cv2
+import glob
+import json
+import logging
+import numpy as np
+import os
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('steering_angle', 'i2'),
+    ('speed', 'i2'),
+    ('source', 'i2'),  # index into meta['sources'], the video the frame came from
+    ('chunk', 'i4'),
+    ('offset', 'i4'),  # position of the frame in its chunk
+])
+
+
+class DrivingLogWriter(object):
+
+    def __init__(self, log_dir, frame_shape=(240, 320, 3), chunk_size=1024):
+        logging.info('Creating a DrivingLogWriter in %s' % log_dir)
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_dir = log_dir
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_size = chunk_size
+        self.sources = []
+        self.records = []
+        self.chunk = None
+        self.chunk_count = 0
+        self.offset = chunk_size  # start a new chunk on the first append
+
+    def append(self, frame, steering_angle, timestamp=0.0, speed=0, source=''):
+        if frame.shape != self.frame_shape:
+            raise ValueError('frame shape %s does not match the log frame shape %s' % (frame.shape, self.frame_shape))
+        if self.offset == self.chunk_size:
+            self.new_chunk()
+        if source not in self.sources:
+            self.sources.append(source)
+        self.chunk[self.offset] = frame
+        self.records.append((timestamp, steering_angle, speed, self.sources.index(source),
+                             self.chunk_count - 1, self.offset))
+        self.offset += 1
+
+    def new_chunk(self):
+        if self.chunk is not None:
+            self.flush()
+        path = chunk_path(self.log_dir, self.chunk_count)
+        self.chunk = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                               shape=(self.chunk_size,) + self.frame_shape)
+        self.chunk_count += 1
+        self.offset = 0
+
+    def flush(self):
+        """ Write out the current chunk, the index and the meta data, the log is readable up to here """
+        if self.chunk is not None:
+            self.chunk.flush()
+        index_path = os.path.join(self.log_dir, 'index.npy')
+        with open(index_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(self.records, dtype=INDEX_DTYPE))
+        os.replace(index_path + '.tmp', index_path)
+        meta_path = os.path.join(self.log_dir, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'frame_shape': self.frame_shape, 'chunk_size': self.chunk_size,
+                       'chunks': self.chunk_count, 'sources': self.sources}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def close(self):
+        self.flush()
+        self.chunk = None
+        logging.info('Wrote %d frames in %d chunks to %s' % (len(self.records), self.chunk_count, self.log_dir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
+
+
+class DrivingLogReader(object):
+
+    def __init__(self, log_dir):
+        with open(os.path.join(log_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.log_dir = log_dir
+        self.frame_shape = tuple(meta['frame_shape'])
+        self.sources = meta['sources']
+        self.index = np.load(os.path.join(log_dir, 'index.npy'))
+        self.chunks = [np.load(chunk_path(log_dir, i), mmap_mode='r') for i in range(meta['chunks'])]
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i):
+        """ Read-only view of frame i, no copy """
+        record = self.index[i]
+        return self.chunks[record['chunk']][record['offset']]
+
+    def frames(self, indices):
+        """ Frames at the given indices, as one (N, H, W, 3) array """
+        batch = np.empty((len(indices),) + self.frame_shape, dtype=np.uint8)
+        records = self.index[indices]
+        for chunk in np.unique(records['chunk']):
+            selected = records['chunk'] == chunk
+            batch[selected] = self.chunks[chunk][records['offset'][selected]]
+        return batch
+
+    def random_batch(self, batch_size, rng=np.random):
+        """ (frames, steering angles) of batch_size random frames """
+        indices = np.sort(rng.randint(0, len(self.index), batch_size))  # sorted for locality in the chunks
+        return self.frames(indices), self.index['steering_angle'][indices]
+
+
+############################
+# Utility Functions
+############################
+def chunk_path(log_dir, chunk):
+    return os.path.join(log_dir, 'frames_%05d.npy' % chunk)
+
+
+def parse_png_name(path):
+    """ <video>_<frame>_<angle>.png, as written by save_training_data and the manual driver """
+    video, frame, angle = os.path.splitext(os.path.basename(path))[0].rsplit('_', 2)
+    return video, int(frame), int(angle)
+
+
+def convert_png_directory(png_dir, log_dir, chunk_size=1024):
+    """ Convert a directory of labeled PNGs (steering angle in the file name) to a driving log """
+    labeled = []
+    for path in glob.glob(os.path.join(png_dir, '*.png')):
+        try:
+            labeled.append(parse_png_name(path) + (path,))
+        except ValueError:
+            logging.debug('Skipping %s, not a labeled frame' % path)
+    labeled.sort()
+    if not labeled:
+        logging.warning('No labeled frames in %s' % png_dir)
+        return 0
+
+    # timestamps are only known for frames written by frame_writer.FrameWriter
+    timestamps = {}
+    for index_path in glob.glob(os.path.join(png_dir, '*_index.csv')):
+        with open(index_path, 'r') as f:
+            for row in csv.DictReader(f):
+                timestamps[row['filename']] = float(row['timestamp'])
+
+    frame_shape = cv2.imread(labeled[0][3]).shape
+    count = 0
+    with DrivingLogWriter(log_dir, frame_shape, chunk_size) as writer:
+        for video, _, angle, path in labeled:
+            frame = cv2.imread(path)
+            if frame is None or frame.shape != frame_shape:
+                logging.warning('Skipping %s, unreadable or not %s' % (path, frame_shape))
+                continue
+            writer.append(frame, angle, timestamps.get(os.path.basename(path), 0.0), source=video)
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Driving log tools')
+    subparsers = parser.add_subparsers(dest='command')
+    convert = subparsers.add_parser('convert', help='convert a directory of labeled PNGs')
+    convert.add_argument('png_dir')
+    convert.add_argument('log_dir')
+    convert.add_argument('--chunk_size', type=int, default=1024)
+    info = subparsers.add_parser('info', help='summarize a driving log')
+    info.add_argument('log_dir')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        count = convert_png_directory(args.png_dir, args.log_dir, args.chunk_size)
+        print('Converted %d frames' % count)
+    elif args.command == 'info':
+        reader = DrivingLogReader(args.log_dir)
+        if len(reader) == 0:
+            print('No frames in %s' % args.log_dir)
+            return
+        angles = reader.index['steering_angle']
+        print('%d frames of %s from %d sources, steering angle %d - %d, mean %.1f' %
+              (len(reader), reader.frame_shape, len(reader.sources), angles.min(), angles.max(), angles.mean()))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -2,10 +2,14 @@ import cv2
 import numpy as np
 import logging
 import math
+import time
 from keras.models import load_model
 from hand_coded_lane_follower import HandCodedLaneFollower
+from log_limits import RateLimitedLogger
+from spans import span, timed
 
 _SHOW_IMAGE = False
+_log = RateLimitedLogger(__name__)  # for the per-frame code, see log_limits.py
 
 
 class EndToEndLaneFollower(object):
@@ -17,17 +21,39 @@ class EndToEndLaneFollower(object):
 
         self.car = car
         self.curr_steering_angle = 90
+        self.proposed_steering_angle = 90  # model output, before the steering controller
+        self.draw_overlay = True  # set to False when overlays are rendered offline, see render_overlays.py
+        self.steering_controller = None  # see control_loop.SteeringController
+        self.frame_budget = None  # see frame_budget.FrameBudget
         self.model = load_model(model_path)
 
-    def follow_lane(self, frame):
+    def follow_lane(self, frame, timestamp=None):
         # Main entry point of the lane follower
+        # timestamp: time.monotonic() when the frame was captured, used by the steering controller
         show_image("orig", frame)
 
+        budget = self.frame_budget
+        if budget is not None and not budget.allows('lane'):
+            budget.fallback('lane', 'last_angle')
+            return frame  # the wheels keep the last steering angle
+        start = time.perf_counter()
         self.curr_steering_angle = self.compute_steering_angle(frame)
-        logging.debug("curr_steering_angle = %d" % self.curr_steering_angle)
-
-        if self.car is not None:
-            self.car.front_wheels.turn(self.curr_steering_angle)
+        if budget is not None:
+            budget.observe('lane', (time.perf_counter() - start) * 1000)
+        self.proposed_steering_angle = self.curr_steering_angle
+        _log.debug("curr_steering_angle = %d", self.curr_steering_angle)
+
+        if self.steering_controller is not None:
+            # the model sees both lane lines, so use the two lane rate limit
+            self.steering_controller.update(self.curr_steering_angle, 2, timestamp)
+        elif self.car is not None:
+            with span('actuation'):
+                self.car.front_wheels.turn(self.curr_steering_angle)
+        if not self.draw_overlay:
+            return frame
+        if budget is not None and not budget.allows('draw'):
+            budget.skip('draw')
+            return frame
         final_frame = display_heading_line(frame, self.curr_steering_angle)
 
         return final_frame
@@ -38,12 +64,14 @@ class EndToEndLaneFollower(object):
         """
         preprocessed = img_preprocess(frame)
         X = np.asarray([preprocessed])
-        steering_angle = self.model.predict(X)[0]
+        with span('predict'):
+            steering_angle = self.model.predict(X)[0]
 
-        logging.debug('new steering angle: %s' % steering_angle)
+        _log.debug('new steering angle: %s', steering_angle)
         return int(steering_angle + 0.5) # round the nearest integer
 
 
+@timed('img_preprocess')
 def img_preprocess(image):
     height, _, _ = image.shape
     #image = image[int(height/2):,:,:]  # remove top half of the image, as it is not relevant for lane following
@@ -53,6 +81,7 @@ def img_preprocess(image):
     image = image / 255 # normalizing, the processed image becomes black for some reason.  do we need this?
     return image
 
+@timed('draw')
 def display_heading_line(frame, steering_angle, line_color=(0, 0, 255), line_width=5, ):
     heading_image = np.zeros_like(frame)
     height, width, _ = frame.shape
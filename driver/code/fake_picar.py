@@ -0,0 +1,89 @@
+"""
+Stand-in for the SunFounder picar package, so the driver code can run and be tested
+without a car.  It mirrors the parts of the picar API that DeepPiCar uses:
+
+    picar.setup()
+    picar.Servo.Servo(channel)
+    picar.front_wheels.Front_Wheels()
+    picar.back_wheels.Back_Wheels()
+
+Every write is recorded with its time, per device in .writes, and for all devices in command_log.
+write_delay simulates the blocking I2C/PWM transaction.
+"""
+import logging
+import time
+from types import SimpleNamespace
+
+command_log = []  # (time, command, value) of every write to any fake device
+
+
+def reset_command_log():
+    del command_log[:]
+
+
+class FakeServo(object):
+
+    def __init__(self, channel, write_delay=0.0):
+        self.channel = channel
+        self.offset = 0
+        self.angle = 90
+        self.write_delay = write_delay
+        self.writes = []  # (time, angle)
+
+    def write(self, angle):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        self.angle = angle
+        now = time.monotonic()
+        self.writes.append((now, angle))
+        command_log.append((now, 'servo%d.write' % self.channel, angle))
+
+
+class FakeFrontWheels(object):
+
+    def __init__(self, write_delay=0.0):
+        self.turning_offset = 0
+        self.angle = 90
+        self.write_delay = write_delay
+        self.writes = []  # (time, angle)
+
+    def turn(self, angle):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        logging.debug('fake front wheels: turn %s' % angle)
+        self.angle = angle
+        now = time.monotonic()
+        self.writes.append((now, angle))
+        command_log.append((now, 'front_wheels.turn', angle))
+
+
+class FakeBackWheels(object):
+
+    def __init__(self, write_delay=0.0):
+        self._speed = 0
+        self.write_delay = write_delay
+        self.writes = []  # (time, speed)
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, speed):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        logging.debug('fake back wheels: speed %s' % speed)
+        self._speed = speed
+        now = time.monotonic()
+        self.writes.append((now, speed))
+        command_log.append((now, 'back_wheels.speed', speed))
+
+
+def setup():
+    logging.info('Using the fake picar backend, no hardware will be touched')
+
+
+# Same attribute layout as the picar package, so this module can be passed in its place
+Servo = SimpleNamespace(Servo=FakeServo)
+front_wheels = SimpleNamespace(Front_Wheels=FakeFrontWheels)
+back_wheels = SimpleNamespace(Back_Wheels=FakeBackWheels)
@@ -0,0 +1,152 @@
+"""
+Per-frame deadline budget, so a slow frame degrades gracefully instead of steering late.
+
+Some frames take much longer than others: many Hough segments, a stalled detector or video encoder.
+A late steering command is worse than a slightly less accurate one on time, so the drive loop gives
+every frame a budget from its capture, and the stages check what is left before doing their work:
+    budget.start()                     # the camera returned a frame
+    if budget.allows('draw'):          # enough left for what this stage took recently?
+        start = time.perf_counter()
+        ... draw the overlays ...
+        budget.observe('draw', (time.perf_counter() - start) * 1000)
+    else:
+        budget.skip('draw')            # optional work, just not done this frame
+    ...
+    budget.fallback('lane', 'scaled')  # or a cheaper path, e.g. lane lines from a downscaled frame
+    budget.end()                       # counts a deadline miss if the frame went over
+
+Every stage keeps a moving average of what it took, its estimate.  A skipped stage or one that fell
+back is not measured, so its estimate decays a little every time, to try it again after a few frames
+instead of never.
+"""
+import collections
+import logging
+import time
+from log_limits import RateLimitedLogger
+
+_log = RateLimitedLogger(__name__, max_per_second=1)
+
+
+class FrameBudget(object):
+
+    def __init__(self, budget_ms=50.0, reserve_ms=2.0, smoothing=0.2, decay=0.8):
+        """
+        budget_ms -- capture to end of frame, 50ms keeps up with the camera's 20 fps
+        reserve_ms -- kept back for the steering command, an optional stage only runs if it leaves this much
+        smoothing -- weight of a new measurement in a stage's estimate
+        decay -- a skipped stage's estimate is multiplied by this
+        """
+        self.budget_ms = budget_ms
+        self.reserve_ms = reserve_ms
+        self.smoothing = smoothing
+        self.decay = decay
+
+        self.start_time = None
+        self.estimates_ms = {}  # stage -> moving average of its duration
+        self.frames = 0
+        self.misses = 0
+        self.worst_ms = 0.0
+        self.skips = collections.Counter()  # stage -> frames it was skipped
+        self.fallbacks = collections.Counter()  # (stage, fallback) -> frames
+
+    def start(self, now=None):
+        """ A frame was captured, its budget starts now (time.perf_counter()) """
+        self.start_time = time.perf_counter() if now is None else now
+
+    def elapsed_ms(self, now=None):
+        if self.start_time is None:
+            return 0.0
+        return ((time.perf_counter() if now is None else now) - self.start_time) * 1000
+
+    def remaining_ms(self, now=None):
+        return self.budget_ms - self.elapsed_ms(now)
+
+    def estimate_ms(self, stage):
+        return self.estimates_ms.get(stage, 0.0)
+
+    def allows(self, stage, now=None):
+        """ True if stage, at its estimate, fits in what is left of the frame's budget """
+        return self.remaining_ms(now) - self.estimate_ms(stage) >= self.reserve_ms
+
+    def observe(self, stage, duration_ms):
+        estimate = self.estimates_ms.get(stage)
+        if estimate is None:
+            self.estimates_ms[stage] = duration_ms
+        else:
+            self.estimates_ms[stage] = estimate + self.smoothing * (duration_ms - estimate)
+
+    def skip(self, stage):
+        self.skips[stage] += 1
+        self.decay_estimate(stage)
+
+    def fallback(self, stage, fallback):
+        """ stage was replaced by the cheaper fallback this frame """
+        self.fallbacks[(stage, fallback)] += 1
+        self.decay_estimate(stage)
+
+    def decay_estimate(self, stage):
+        if stage in self.estimates_ms:
+            self.estimates_ms[stage] *= self.decay
+
+    def end(self, now=None):
+        """ The frame is done, returns True if it missed its deadline """
+        elapsed_ms = self.elapsed_ms(now)
+        self.frames += 1
+        self.worst_ms = max(self.worst_ms, elapsed_ms)
+        missed = elapsed_ms > self.budget_ms
+        if missed:
+            self.misses += 1
+            _log.warning('Frame took %.1fms, over its %.0fms budget, %d misses in %d frames',
+                         elapsed_ms, self.budget_ms, self.misses, self.frames)
+        self.start_time = None
+        return missed
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'deadline_misses': self.misses,
+            'worst_ms': self.worst_ms,
+            'skips': dict(self.skips),
+            'fallbacks': dict(('%s->%s' % key, count) for key, count in self.fallbacks.items()),
+            'estimates_ms': dict(self.estimates_ms),
+        }
+
+
+############################
+# Test Functions
+############################
+def test_frame_budget():
+    budget = FrameBudget(budget_ms=50, reserve_ms=2)
+
+    # plenty of time: everything runs, and is measured
+    budget.start(now=0.0)
+    assert budget.allows('lane', now=0.0)
+    budget.observe('lane', 20)
+    budget.observe('draw', 10)
+    assert budget.allows('draw', now=0.020)
+    assert not budget.end(now=0.035)
+
+    # a slow frame: 40ms in, the 10ms overlays do not fit, the frame still misses its deadline
+    budget.start(now=1.0)
+    assert not budget.allows('draw', now=1.040)
+    budget.skip('draw')
+    assert budget.end(now=1.055)
+    assert budget.estimate_ms('draw') == 8.0  # decayed, so it is tried again
+
+    # the lane detection estimate went up, the frame falls back to the cheap path
+    budget.observe('lane', 240)  # estimate 20 + 0.2 * 220 = 64ms
+    budget.start(now=2.0)
+    assert not budget.allows('lane', now=2.001)
+    budget.fallback('lane', 'scaled')
+    assert not budget.end(now=2.010)
+
+    stats = budget.stats()
+    assert stats['frames'] == 3 and stats['deadline_misses'] == 1, stats
+    assert stats['skips'] == {'draw': 1} and stats['fallbacks'] == {'lane->scaled': 1}, stats
+    logging.info('frame budget stats: %s' % stats)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_frame_budget()
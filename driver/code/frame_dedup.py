@@ -0,0 +1,195 @@
+"""
+Drop near-duplicate training frames.
+
+When the car is slow or stopped, consecutive frames are almost identical and carry the same steering
+angle, so they add storage and training time but no information.  A frame is a near-duplicate when
+its steering angle equals the last kept frame's and their perceptual hashes differ in at most
+`threshold` bits.
+
+The hash is a difference hash: the frame shrunk to (hash_size + 1) x hash_size grayscale pixels, one bit
+per horizontal neighbor pair, set when brightness increases.  It ignores noise and small exposure changes,
+and costs one cv2.resize of the frame.
+
+Usage:
+# report only
+python frame_dedup.py ../../models/lane_navigation/data/images --dry_run
+
+# move near-duplicates into <png_dir>/duplicates
+python frame_dedup.py ../../models/lane_navigation/data/images --threshold 4
+
+# delete them instead, to free the disk space
+python frame_dedup.py ../../models/lane_navigation/data/images --delete
+
+# write a deduplicated copy of a driving log
+python frame_dedup.py ../data/driving_log --output_dir ../data/driving_log_dedup
+"""
+import argparse
+import cv2
+import glob
+import logging
+import numpy as np
+import os
+from driving_log import DrivingLogReader, DrivingLogWriter, parse_png_name
+
+_DUPLICATES_DIR = 'duplicates'
+
+
+class DuplicateFilter(object):
+    """
+    Online near-duplicate filter, feed it frames in capture order.
+    A threshold of 0 only drops frames whose hashes are identical.
+    """
+
+    def __init__(self, threshold=4, hash_size=8):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.last_hash = None
+        self.last_angle = None
+        self.seen = 0
+        self.dropped = 0
+
+    def is_duplicate(self, frame, steering_angle):
+        """ True if the frame is a near-duplicate of the last kept frame, otherwise it becomes the last kept frame """
+        self.seen += 1
+        frame_hash = difference_hash(frame, self.hash_size)
+        if (self.last_hash is not None and steering_angle == self.last_angle
+                and hamming_distance(frame_hash, self.last_hash) <= self.threshold):
+            self.dropped += 1
+            return True
+        self.last_hash = frame_hash
+        self.last_angle = steering_angle
+        return False
+
+    def reset(self):
+        """ Start over, e.g. at the start of a new video, so its first frame is always kept """
+        self.last_hash = None
+        self.last_angle = None
+
+    def report(self):
+        kept = self.seen - self.dropped
+        shrinkage = 100.0 * self.dropped / self.seen if self.seen else 0.0
+        return '%d frames, kept %d, dropped %d near-duplicates (%.1f%% smaller)' % (
+            self.seen, kept, self.dropped, shrinkage)
+
+
+############################
+# Utility Functions
+############################
+def difference_hash(frame, hash_size=8):
+    """ hash_size * hash_size bit perceptual hash of a BGR or grayscale frame, as an int """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(frame, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).tobytes().hex(), 16)
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+
+def dedup_png_directory(png_dir, threshold=4, dry_run=False, delete=False):
+    """
+    Move near-duplicate labeled PNGs into png_dir/duplicates, or with delete, delete them, video by video
+    in frame order.  Returns (frames, duplicates, bytes of the duplicates).
+    """
+    labeled = []
+    for path in glob.glob(os.path.join(png_dir, '*.png')):
+        try:
+            labeled.append(parse_png_name(path) + (path,))
+        except ValueError:
+            logging.debug('Skipping %s, not a labeled frame' % path)
+    labeled.sort()
+
+    duplicates_dir = os.path.join(png_dir, _DUPLICATES_DIR)
+    if not dry_run and not delete:
+        os.makedirs(duplicates_dir, exist_ok=True)
+    duplicate_filter = DuplicateFilter(threshold)
+    duplicate_bytes = 0
+    video = None
+    for frame_video, _, angle, path in labeled:
+        if frame_video != video:
+            video = frame_video
+            duplicate_filter.reset()
+        frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if frame is None:
+            logging.warning('Skipping %s, unreadable' % path)
+            continue
+        if duplicate_filter.is_duplicate(frame, angle):
+            duplicate_bytes += os.path.getsize(path)
+            if dry_run:
+                continue
+            if delete:
+                os.remove(path)
+            else:
+                os.rename(path, os.path.join(duplicates_dir, os.path.basename(path)))
+    logging.info(duplicate_filter.report())
+    return duplicate_filter.seen, duplicate_filter.dropped, duplicate_bytes
+
+
+def dedup_driving_log(log_dir, output_dir, threshold=4, dry_run=False):
+    """
+    Copy a driving log to output_dir without its near-duplicate frames.
+    Returns (frames, duplicates, bytes of the duplicates).
+    """
+    reader = DrivingLogReader(log_dir)
+    duplicate_filter = DuplicateFilter(threshold)
+    keep = []
+    source = None
+    for i, record in enumerate(reader.index):
+        if record['source'] != source:
+            source = record['source']
+            duplicate_filter.reset()
+        if not duplicate_filter.is_duplicate(reader.frame(i), record['steering_angle']):
+            keep.append(i)
+    logging.info(duplicate_filter.report())
+
+    if not dry_run:
+        chunk_size = len(reader.chunks[0]) if reader.chunks else 1024
+        with DrivingLogWriter(output_dir, reader.frame_shape, chunk_size) as writer:
+            for i in keep:
+                record = reader.index[i]
+                writer.append(reader.frame(i), record['steering_angle'], record['timestamp'], record['speed'],
+                              reader.sources[record['source']])
+    frame_bytes = int(np.prod(reader.frame_shape))
+    return duplicate_filter.seen, duplicate_filter.dropped, duplicate_filter.dropped * frame_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop near-duplicate training frames')
+    parser.add_argument('data', help='directory of labeled PNGs, or a driving log directory')
+    parser.add_argument('--threshold', type=int, default=4,
+                        help='max differing hash bits (of 64) for two frames with the same angle to be duplicates')
+    parser.add_argument('--output_dir', help='where the deduplicated driving log goes, required for driving logs')
+    parser.add_argument('--dry_run', action='store_true', help='only report, change nothing')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete duplicate PNGs, instead of moving them into <data>/duplicates')
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.join(args.data, 'meta.json')):
+        if args.output_dir is None and not args.dry_run:
+            parser.error('--output_dir is required to deduplicate a driving log')
+        frames, duplicates, duplicate_bytes = dedup_driving_log(args.data, args.output_dir, args.threshold,
+                                                                args.dry_run)
+        # the source log is left as it is, only the copy is smaller
+        if args.dry_run:
+            outcome = 'less in a deduplicated copy'
+        else:
+            outcome = 'less in the copy in %s, %s is unchanged' % (args.output_dir, args.data)
+    else:
+        frames, duplicates, duplicate_bytes = dedup_png_directory(args.data, args.threshold, args.dry_run,
+                                                                  args.delete)
+        duplicates_dir = os.path.join(args.data, _DUPLICATES_DIR)
+        if args.delete:
+            outcome = 'to free' if args.dry_run else 'freed'
+        else:
+            outcome = '%s to %s' % ('to move' if args.dry_run else 'moved', duplicates_dir)
+    shrinkage = 100.0 * duplicates / frames if frames else 0.0
+    print('%d frames, %d near-duplicates (%.1f%%), %.1f MB %s' %
+          (frames, duplicates, shrinkage, duplicate_bytes / 1e6, outcome))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -0,0 +1,185 @@
+import csv
+import cv2
+import logging
+import numpy as np
+import os
+import queue
+import threading
+import time
+from frame_dedup import DuplicateFilter
+from spans import timed
+
+# Encodings for FrameWriter, fastest last
+ENCODING_PNG = 'png'  # lossless, tens of milliseconds per frame on the Pi
+ENCODING_JPEG = 'jpeg'  # lossy, a few milliseconds per frame
+ENCODING_RAW = 'raw'  # uncompressed .npy, no encoding at all, largest files
+
+
+class FrameWriter(object):
+    """
+    Writes training frames from a pool of background threads, so encoding never stalls the capture loop.
+    cv2.imencode releases the GIL, so the threads encode in parallel.
+
+    Frames are queued with their steering angle and timestamp, in a bounded queue.  When the queue
+    is full, submit() drops the frame (or waits, with block=True) and the drop is counted.
+    The caller must not modify a frame after submitting it.
+
+    Files are named <prefix>_<frame index:06d>_<steering angle:03d>.<ext>, the same scheme as the
+    hand coded lane follower uses, and every written frame is listed in <prefix>_index.csv
+    with its index, angle, timestamp and file name.  A writer opened on an existing index appends to it,
+    and continues the frame index after the last frame listed, so a second session never overwrites
+    the first one's files.
+
+    With dedup_threshold set, near-duplicates of the last kept frame with the same steering angle
+    (see frame_dedup.DuplicateFilter) are skipped in submit(), before they are queued.
+    """
+
+    def __init__(self, directory, prefix, encoding=ENCODING_PNG, jpeg_quality=90, png_compression=1,
+                 workers=2, max_queue=64, block=False, dedup_threshold=None):
+        logging.info('Creating a FrameWriter in %s, encoding=%s, %d workers' % (directory, encoding, workers))
+        if encoding == ENCODING_PNG:
+            self.extension = '.png'
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        elif encoding == ENCODING_JPEG:
+            self.extension = '.jpg'
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        elif encoding == ENCODING_RAW:
+            self.extension = '.npy'
+            self.params = None
+        else:
+            raise ValueError('Unknown encoding: %s' % encoding)
+        self.encoding = encoding
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.block = block
+        self.duplicate_filter = None if dedup_threshold is None else DuplicateFilter(dedup_threshold)
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.index_lock = threading.Lock()
+        index_path = os.path.join(directory, '%s_index.csv' % prefix)
+        self.frame_index = self.next_frame_index(index_path)
+        if self.frame_index:
+            logging.info('Appending to %s, from frame %d' % (index_path, self.frame_index))
+        self.index_file = open(index_path, 'a')
+        self.index = csv.writer(self.index_file)
+        if self.index_file.tell() == 0:
+            self.index.writerow(['frame', 'steering_angle', 'timestamp', 'filename'])
+
+        self.written = 0
+        self.dropped = 0
+        self.max_backlog = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name='frame_writer_%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @staticmethod
+    def next_frame_index(index_path):
+        """ One past the highest frame in an existing index, 0 without one """
+        if not os.path.exists(index_path):
+            return 0
+        last = -1
+        with open(index_path, 'r') as f:
+            for row in csv.DictReader(f):
+                try:
+                    last = max(last, int(row['frame']))
+                except (KeyError, TypeError, ValueError):
+                    continue  # a line cut short by a crash
+        return last + 1
+
+    def submit(self, frame, steering_angle, timestamp=None):
+        """ Queue a frame for writing, returns False if it was dropped as a near-duplicate or because the writers are behind """
+        if timestamp is None:
+            timestamp = time.time()
+        item = (self.frame_index, frame, steering_angle, timestamp)
+        self.frame_index += 1
+        if self.duplicate_filter is not None and self.duplicate_filter.is_duplicate(frame, steering_angle):
+            return False
+        try:
+            self.queue.put(item, block=self.block)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning('FrameWriter is %d frames behind, dropped frame %d' % (self.backlog(), item[0]))
+            return False
+        self.max_backlog = max(self.max_backlog, self.backlog())
+        return True
+
+    def backlog(self):
+        """ Number of frames waiting to be written """
+        return self.queue.qsize()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame_index, frame, steering_angle, timestamp = item
+            filename = '%s_%06d_%03d%s' % (self.prefix, frame_index, steering_angle, self.extension)
+            try:
+                self.write(os.path.join(self.directory, filename), frame)
+            except (IOError, OSError, cv2.error) as e:
+                logging.error('Failed to write %s: %s' % (filename, e))
+                continue
+            with self.index_lock:
+                self.index.writerow([frame_index, steering_angle, '%.4f' % timestamp, filename])
+                self.written += 1
+
+    @timed('encoding')
+    def write(self, path, frame):
+        if self.encoding == ENCODING_RAW:
+            np.save(path, frame)
+            return
+        ret, encoded = cv2.imencode(self.extension, frame, self.params)
+        if not ret:
+            raise IOError('can not encode frame')
+        with open(path, 'wb') as f:
+            f.write(encoded.tobytes())
+
+    def close(self):
+        """ Write out everything that is queued, then stop the writer threads """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if not self.index_file.closed:
+            self.index_file.close()
+        logging.info('FrameWriter wrote %d frames, dropped %d, max backlog %d' %
+                     (self.written, self.dropped, self.max_backlog))
+        if self.duplicate_filter is not None:
+            logging.info('FrameWriter dedup: %s' % self.duplicate_filter.report())
+
+
+############################
+# Test Functions
+############################
+def test_frame_writer_resume():
+    """ A second session with the same prefix continues the frame index, and overwrites nothing """
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix='frame_writer_')
+    try:
+        frame = np.zeros((24, 32, 3), dtype=np.uint8)
+        for session in range(2):
+            writer = FrameWriter(directory, 'd9', ENCODING_RAW, workers=1, block=True)
+            for angle in (80, 90, 100):
+                writer.submit(frame, angle)
+            writer.close()
+
+        with open(os.path.join(directory, 'd9_index.csv'), 'r') as f:
+            rows = list(csv.DictReader(f))
+        assert [int(row['frame']) for row in rows] == list(range(6)), rows
+        assert len(set(row['filename'] for row in rows)) == 6, rows
+        assert len([name for name in os.listdir(directory) if name.endswith('.npy')]) == 6
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_frame_writer_resume()
@@ -0,0 +1,273 @@
+"""
+Golden traces of a lane follower, to check that an optimization did not change how the car steers.
+
+A trace is the follower's per-frame outputs over a recorded video: the number of line segments, the
+lane lines, the proposed steering angle and the stabilized one, and for the end to end follower a
+summary (mean, std) of the img_preprocess output.  The follower runs without a car, a steering
+controller or overlays, so a trace only depends on the video and the code.
+
+Record a golden trace before a rewrite of detect_lane, compute_steering_angle or img_preprocess,
+then diff the rewritten code against it.  The diff reports the first frame outside the tolerances,
+with what differs, and the drift over the whole video.
+
+Traces are JSON lines, a header with the video and follower first, then one line per frame.
+
+Usage:
+python golden_trace.py record ../data/tmp/video01.avi ../data/golden/video01_hand_coded.jsonl --follower hand_coded
+
+# runs the follower over the video in the golden trace's header, exit code 1 if any frame is outside the tolerances
+python golden_trace.py diff ../data/golden/video01_hand_coded.jsonl --angle_tolerance 1 --lane_tolerance 3
+
+# compare two traces, without running the follower
+python golden_trace.py diff ../data/golden/video01_hand_coded.jsonl --trace /tmp/video01_new.jsonl
+"""
+import argparse
+import datetime
+import json
+import logging
+import sys
+import cv2
+import numpy as np
+
+
+############################
+# Recording
+############################
+def read_video(video_file, max_frames=None):
+    cap = cv2.VideoCapture(video_file)
+    try:
+        count = 0
+        while max_frames is None or count < max_frames:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            count += 1
+            yield frame
+    finally:
+        cap.release()
+
+
+def create_follower(name, model_path=None):
+    if name == 'hand_coded':
+        from hand_coded_lane_follower import HandCodedLaneFollower
+        follower = HandCodedLaneFollower()
+    else:
+        from end_to_end_lane_follower import EndToEndLaneFollower
+        follower = EndToEndLaneFollower(model_path=model_path) if model_path else EndToEndLaneFollower()
+    follower.draw_overlay = False
+    return follower
+
+
+def trace_frames(frames, follower):
+    """ Yields the per-frame record of follower over frames """
+    end_to_end = not hasattr(follower, 'num_line_segments')  # the hand coded follower detects segments
+    if end_to_end:
+        from end_to_end_lane_follower import img_preprocess
+    for i, frame in enumerate(frames):
+        follower.follow_lane(frame)
+        record = {
+            'frame': i,
+            'proposed_angle': int(follower.proposed_steering_angle),
+            'steering_angle': int(follower.curr_steering_angle),
+        }
+        if end_to_end:
+            preprocessed = img_preprocess(frame)
+            record['preprocess_mean'] = float(preprocessed.mean())
+            record['preprocess_std'] = float(preprocessed.std())
+        else:
+            record['line_segments'] = int(follower.num_line_segments)
+            record['lane_lines'] = [[int(v) for v in line[0]] for line in follower.lane_lines]
+        yield record
+
+
+def record(video_file, path, follower_name='hand_coded', model_path=None, max_frames=None):
+    follower = create_follower(follower_name, model_path)
+    header = {
+        'video': video_file,
+        'follower': follower_name,
+        'model_path': model_path,
+        'max_frames': max_frames,
+        'date': datetime.datetime.now().isoformat(),
+    }
+    count = 0
+    with open(path, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for frame_record in trace_frames(read_video(video_file, max_frames), follower):
+            f.write(json.dumps(frame_record, separators=(',', ':')) + '\n')
+            count += 1
+    logging.info('Recorded a trace of %d frames of %s with the %s follower to %s' %
+                 (count, video_file, follower_name, path))
+    return path
+
+
+def load(path):
+    """ (header, frame records) of a trace """
+    with open(path, 'r') as f:
+        header = json.loads(f.readline())
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+############################
+# Diffing
+############################
+def diff_frame(golden, new, angle_tolerance=0, lane_tolerance=0, segment_tolerance=0.0, preprocess_tolerance=1e-6):
+    """
+    What differs between two records of the same frame, beyond the tolerances, as a list of strings.
+    angle_tolerance -- degrees, lane_tolerance -- pixels of a lane line end point,
+    segment_tolerance -- fraction of the golden line segment count
+    """
+    differences = []
+    for key in ('proposed_angle', 'steering_angle'):
+        if abs(new[key] - golden[key]) > angle_tolerance:
+            differences.append('%s %d, golden %d' % (key, new[key], golden[key]))
+    if 'line_segments' in golden:
+        if abs(new['line_segments'] - golden['line_segments']) > segment_tolerance * golden['line_segments']:
+            differences.append('line_segments %d, golden %d' % (new['line_segments'], golden['line_segments']))
+        if len(new['lane_lines']) != len(golden['lane_lines']):
+            differences.append('%d lane lines, golden %d' % (len(new['lane_lines']), len(golden['lane_lines'])))
+        else:
+            for new_line, golden_line in zip(new['lane_lines'], golden['lane_lines']):
+                if max(abs(a - b) for a, b in zip(new_line, golden_line)) > lane_tolerance:
+                    differences.append('lane line %s, golden %s' % (new_line, golden_line))
+    for key in ('preprocess_mean', 'preprocess_std'):
+        if key in golden and abs(new[key] - golden[key]) > preprocess_tolerance:
+            differences.append('%s %.6f, golden %.6f' % (key, new[key], golden[key]))
+    return differences
+
+
+def lane_drift(golden, new):
+    """ Largest end point distance between the lane lines of two records, None if the lane line counts differ """
+    if len(new['lane_lines']) != len(golden['lane_lines']):
+        return None
+    return max([abs(a - b) for new_line, golden_line in zip(new['lane_lines'], golden['lane_lines'])
+                for a, b in zip(new_line, golden_line)] or [0])
+
+
+def diff(golden_records, new_records, **tolerances):
+    """ Compares two traces frame by frame, returns a report dict, 'ok' is False if any frame diverged """
+    first_divergence = None
+    diverged = 0
+    proposed_drift = []
+    steering_drift = []
+    segment_drift = []
+    lane_drifts = []
+    lane_count_mismatches = 0
+    for golden, new in zip(golden_records, new_records):
+        differences = diff_frame(golden, new, **tolerances)
+        if differences:
+            diverged += 1
+            if first_divergence is None:
+                first_divergence = {'frame': golden['frame'], 'differences': differences}
+        proposed_drift.append(new['proposed_angle'] - golden['proposed_angle'])
+        steering_drift.append(new['steering_angle'] - golden['steering_angle'])
+        if 'line_segments' in golden:
+            segment_drift.append(new['line_segments'] - golden['line_segments'])
+            drift = lane_drift(golden, new)
+            if drift is None:
+                lane_count_mismatches += 1
+            else:
+                lane_drifts.append(drift)
+
+    frames = min(len(golden_records), len(new_records))
+    report = {
+        'ok': diverged == 0 and len(golden_records) == len(new_records),
+        'frames': frames,
+        'golden_frames': len(golden_records),
+        'new_frames': len(new_records),
+        'diverged_frames': diverged,
+        'first_divergence': first_divergence,
+    }
+    if frames:
+        report.update({
+            'proposed_angle_mean_abs_drift': float(np.mean(np.abs(proposed_drift))),
+            'proposed_angle_max_abs_drift': int(np.max(np.abs(proposed_drift))),
+            'steering_angle_mean_drift': float(np.mean(steering_drift)),  # signed, a bias to one side shows
+            'steering_angle_max_abs_drift': int(np.max(np.abs(steering_drift))),
+        })
+    if segment_drift:
+        report.update({
+            'line_segments_mean_drift': float(np.mean(segment_drift)),
+            'lane_line_max_drift_px': max(lane_drifts) if lane_drifts else 0,
+            'lane_line_count_mismatches': lane_count_mismatches,
+        })
+    return report
+
+
+def print_report(report):
+    if report['golden_frames'] != report['new_frames']:
+        print('Frame count differs: golden %d, new %d' % (report['golden_frames'], report['new_frames']))
+    if report['first_divergence']:
+        print('First diverging frame: %d' % report['first_divergence']['frame'])
+        for difference in report['first_divergence']['differences']:
+            print('    %s' % difference)
+    print('%d of %d frames diverged' % (report['diverged_frames'], report['frames']))
+    for key in sorted(report):
+        if 'drift' in key or key.endswith('mismatches'):
+            print('%-36s %s' % (key, report[key]))
+    print('OK' if report['ok'] else 'DIVERGED')
+
+
+############################
+# Test Functions
+############################
+def test_golden_trace():
+    """ A rerun matches its own trace, a shifted road does not """
+    from road_scene import RoadScene
+
+    def frames(offset=0.0):
+        scene = RoadScene(320, 240, offset=offset, seed=0)
+        return [frame for frame, _ in scene.stream(60)]
+
+    golden = list(trace_frames(frames(), create_follower('hand_coded')))
+    same = list(trace_frames(frames(), create_follower('hand_coded')))
+    report = diff(golden, same)
+    assert report['ok'], report
+
+    shifted = list(trace_frames(frames(offset=0.3), create_follower('hand_coded')))
+    report = diff(golden, shifted, angle_tolerance=1, lane_tolerance=3)
+    assert not report['ok'] and report['first_divergence'] is not None, report
+    print_report(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record and diff golden traces of a lane follower')
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help='record a trace of a follower over a video')
+    record_parser.add_argument('video')
+    record_parser.add_argument('path', help='trace to write, .jsonl')
+    record_parser.add_argument('--follower', choices=['end_to_end', 'hand_coded'], default='hand_coded')
+    record_parser.add_argument('--model', help='model of the end to end follower')
+    record_parser.add_argument('--max_frames', type=int)
+    diff_parser = subparsers.add_parser('diff', help='compare the current code, or a trace, with a golden trace')
+    diff_parser.add_argument('golden')
+    diff_parser.add_argument('--trace', help='trace to compare, instead of running the follower again')
+    diff_parser.add_argument('--angle_tolerance', type=int, default=0, help='degrees')
+    diff_parser.add_argument('--lane_tolerance', type=int, default=0, help='pixels')
+    diff_parser.add_argument('--segment_tolerance', type=float, default=0.0,
+                             help='fraction of the golden line segment count')
+    diff_parser.add_argument('--preprocess_tolerance', type=float, default=1e-6)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.video, args.path, args.follower, args.model, args.max_frames)
+    elif args.command == 'diff':
+        header, golden_records = load(args.golden)
+        if args.trace:
+            _, new_records = load(args.trace)
+        else:
+            follower = create_follower(header['follower'], header.get('model_path'))
+            new_records = list(trace_frames(read_video(header['video'], header.get('max_frames')), follower))
+        report = diff(golden_records, new_records, angle_tolerance=args.angle_tolerance,
+                      lane_tolerance=args.lane_tolerance, segment_tolerance=args.segment_tolerance,
+                      preprocess_tolerance=args.preprocess_tolerance)
+        print_report(report)
+        if not report['ok']:
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
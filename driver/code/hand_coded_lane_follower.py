@@ -4,8 +4,12 @@ import logging
 import math
 import datetime
 import sys
+import time
+from log_limits import RateLimitedLogger
+from spans import span, timed
 
 _SHOW_IMAGE = False
+_log = RateLimitedLogger(__name__)  # for the per-frame code, see log_limits.py
 
 
 class HandCodedLaneFollower(object):
@@ -14,27 +18,80 @@ class HandCodedLaneFollower(object):
         logging.info('Creating a HandCodedLaneFollower...')
         self.car = car
         self.curr_steering_angle = 90
-
-    def follow_lane(self, frame):
+        self.lane_lines = []
+        self.proposed_steering_angle = 90  # before stabilization
+        self.num_line_segments = 0
+        self.draw_overlay = True  # set to False when overlays are rendered offline, see render_overlays.py
+        self.steering_controller = None  # see control_loop.SteeringController
+        self.lane_scale = 1.0  # detect lane lines on the frame scaled by this, see quality_governor.py
+        self.frame_budget = None  # see frame_budget.FrameBudget
+
+    def follow_lane(self, frame, timestamp=None):
         # Main entry point of the lane follower
+        # timestamp: time.monotonic() when the frame was captured, used by the steering controller
         show_image("orig", frame)
+        if self.frame_budget is not None:
+            return self.follow_lane_on_budget(frame, timestamp, self.frame_budget)
+
+        if self.lane_scale < 1.0:
+            lane_lines, frame, self.num_line_segments = detect_lane_scaled(frame, self.lane_scale, self.draw_overlay)
+        else:
+            lane_lines, frame, self.num_line_segments = detect_lane_with_segment_count(frame, self.draw_overlay)
+        self.lane_lines = lane_lines
+        final_frame = self.steer(frame, lane_lines, timestamp)
 
-        lane_lines, frame = detect_lane(frame)
-        final_frame = self.steer(frame, lane_lines)
+        return final_frame
 
+    def follow_lane_on_budget(self, frame, timestamp, budget):
+        # follow_lane, within what is left of the frame's budget: when the lane detection does not fit,
+        # detect on a frame downscaled once more, or keep the last steering angle; overlays only if they fit
+        start = time.perf_counter()
+        if budget.allows('lane'):
+            if self.lane_scale < 1.0:
+                lane_lines, _, self.num_line_segments = detect_lane_scaled(frame, self.lane_scale, False)
+            else:
+                lane_lines, _, self.num_line_segments = detect_lane_with_segment_count(frame, False)
+            budget.observe('lane', (time.perf_counter() - start) * 1000)
+        elif budget.allows('lane_scaled'):
+            budget.fallback('lane', 'scaled')
+            lane_lines, _, self.num_line_segments = detect_lane_scaled(frame, self.lane_scale * 0.5, False)
+            budget.observe('lane_scaled', (time.perf_counter() - start) * 1000)
+        else:
+            budget.fallback('lane', 'last_angle')
+            return frame  # the wheels keep the last steering angle
+        self.lane_lines = lane_lines
+        self.steer(frame, lane_lines, timestamp, draw_overlay=False)
+
+        if not self.draw_overlay or len(lane_lines) == 0:
+            return frame
+        if not budget.allows('draw'):
+            budget.skip('draw')
+            return frame
+        start = time.perf_counter()
+        final_frame = display_heading_line(display_lines(frame, lane_lines), self.curr_steering_angle)
+        budget.observe('draw', (time.perf_counter() - start) * 1000)
         return final_frame
 
-    def steer(self, frame, lane_lines):
-        logging.debug('steering...')
+    def steer(self, frame, lane_lines, timestamp=None, draw_overlay=None):
+        # draw_overlay: draw the heading line, defaults to self.draw_overlay
+        _log.debug('steering...')
         if len(lane_lines) == 0:
-            logging.error('No lane lines detected, nothing to do.')
+            _log.error('No lane lines detected, nothing to do.')
             return frame
 
         new_steering_angle = compute_steering_angle(frame, lane_lines)
-        self.curr_steering_angle = stabilize_steering_angle(self.curr_steering_angle, new_steering_angle, len(lane_lines))
-
-        if self.car is not None:
-            self.car.front_wheels.turn(self.curr_steering_angle)
+        self.proposed_steering_angle = new_steering_angle
+        if self.steering_controller is not None:
+            # the controller stabilizes (per second instead of per frame) and turns the wheels at its own rate
+            self.steering_controller.update(new_steering_angle, len(lane_lines), timestamp)
+            self.curr_steering_angle = self.steering_controller.steering_angle()
+        else:
+            self.curr_steering_angle = stabilize_steering_angle(self.curr_steering_angle, new_steering_angle, len(lane_lines))
+            if self.car is not None:
+                with span('actuation'):
+                    self.car.front_wheels.turn(self.curr_steering_angle)
+        if not (self.draw_overlay if draw_overlay is None else draw_overlay):
+            return frame
         curr_heading_image = display_heading_line(frame, self.curr_steering_angle)
         show_image("heading", curr_heading_image)
 
@@ -44,8 +101,15 @@ class HandCodedLaneFollower(object):
 ############################
 # Frame processing steps
 ############################
-def detect_lane(frame):
-    logging.debug('detecting lane lines...')
+def detect_lane(frame, draw_overlay=True):
+    # returns lane_lines, frame (with the overlay drawn)
+    lane_lines, frame, _ = detect_lane_with_segment_count(frame, draw_overlay)
+    return lane_lines, frame
+
+
+def detect_lane_with_segment_count(frame, draw_overlay=True):
+    # detect_lane, returns lane_lines, frame (with the overlay drawn), and the number of line segments
+    _log.debug('detecting lane lines...')
 
     edges = detect_edges(frame)
     show_image('edges', edges)
@@ -54,16 +118,29 @@ def detect_lane(frame):
     show_image('edges cropped', cropped_edges)
 
     line_segments = detect_line_segments(cropped_edges)
-    line_segment_image = display_lines(frame, line_segments)
-    show_image("line segments", line_segment_image)
+    if _SHOW_IMAGE:
+        line_segment_image = display_lines(frame, line_segments)
+        show_image("line segments", line_segment_image)
 
     lane_lines = average_slope_intercept(frame, line_segments)
-    lane_lines_image = display_lines(frame, lane_lines)
-    show_image("lane lines", lane_lines_image)
+    if draw_overlay:
+        frame = display_lines(frame, lane_lines)
+        show_image("lane lines", frame)
 
-    return lane_lines, lane_lines_image
+    return lane_lines, frame, 0 if line_segments is None else len(line_segments)
 
 
+def detect_lane_scaled(frame, scale, draw_overlay=True):
+    # detect_lane on the frame shrunk by scale, cheaper, returns lane_lines in frame coordinates, frame, segment count
+    small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    lane_lines, _, num_line_segments = detect_lane_with_segment_count(small, draw_overlay=False)
+    lane_lines = [[[int(v / scale) for v in line[0]]] for line in lane_lines]
+    if draw_overlay:
+        frame = display_lines(frame, lane_lines)
+    return lane_lines, frame, num_line_segments
+
+
+@timed('detect_edges')
 def detect_edges(frame):
     # filter for blue lane lines
     hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
@@ -101,6 +178,7 @@ def detect_edges_old(frame):
     return edges
 
 
+@timed('region_of_interest')
 def region_of_interest(canny):
     height, width = canny.shape
     mask = np.zeros_like(canny)
@@ -120,6 +198,7 @@ def region_of_interest(canny):
     return masked_image
 
 
+@timed('detect_line_segments')
 def detect_line_segments(cropped_edges):
     # tuning min_threshold, minLineLength, maxLineGap is a trial and error process by hand
     rho = 1  # precision in pixel, i.e. 1 pixel
@@ -128,14 +207,14 @@ def detect_line_segments(cropped_edges):
     line_segments = cv2.HoughLinesP(cropped_edges, rho, angle, min_threshold, np.array([]), minLineLength=8,
                                     maxLineGap=4)
 
-    if line_segments is not None:
+    if line_segments is not None and _log.isEnabledFor(logging.DEBUG):
         for line_segment in line_segments:
-            logging.debug('detected line_segment:')
-            logging.debug("%s of length %s" % (line_segment, length_of_line_segment(line_segment[0])))
+            _log.debug('detected line_segment: %s of length %s', line_segment, length_of_line_segment(line_segment[0]))
 
     return line_segments
 
 
+@timed('average_slope_intercept')
 def average_slope_intercept(frame, line_segments):
     """
     This function combines line segments into one or two lane lines
@@ -144,7 +223,7 @@ def average_slope_intercept(frame, line_segments):
     """
     lane_lines = []
     if line_segments is None:
-        logging.info('No line_segment segments detected')
+        _log.info('No line_segment segments detected')
         return lane_lines
 
     height, width, _ = frame.shape
@@ -158,7 +237,7 @@ def average_slope_intercept(frame, line_segments):
     for line_segment in line_segments:
         for x1, y1, x2, y2 in line_segment:
             if x1 == x2:
-                logging.info('skipping vertical line segment (slope=inf): %s' % line_segment)
+                _log.info('skipping vertical line segment (slope=inf): %s', line_segment)
                 continue
             fit = np.polyfit((x1, x2), (y1, y2), 1)
             slope = fit[0]
@@ -178,7 +257,7 @@ def average_slope_intercept(frame, line_segments):
     if len(right_fit) > 0:
         lane_lines.append(make_points(frame, right_fit_average))
 
-    logging.debug('lane lines: %s' % lane_lines)  # [[[316, 720, 484, 432]], [[1009, 720, 718, 432]]]
+    _log.debug('lane lines: %s', lane_lines)  # [[[316, 720, 484, 432]], [[1009, 720, 718, 432]]]
 
     return lane_lines
 
@@ -188,12 +267,12 @@ def compute_steering_angle(frame, lane_lines):
         We assume that camera is calibrated to point to dead center
     """
     if len(lane_lines) == 0:
-        logging.info('No lane lines detected, do nothing')
+        _log.info('No lane lines detected, do nothing')
         return -90
 
     height, width, _ = frame.shape
     if len(lane_lines) == 1:
-        logging.debug('Only detected one lane line, just follow it. %s' % lane_lines[0])
+        _log.debug('Only detected one lane line, just follow it. %s', lane_lines[0])
         x1, _, x2, _ = lane_lines[0][0]
         x_offset = x2 - x1
     else:
@@ -210,7 +289,7 @@ def compute_steering_angle(frame, lane_lines):
     angle_to_mid_deg = int(angle_to_mid_radian * 180.0 / math.pi)  # angle (in degrees) to center vertical line
     steering_angle = angle_to_mid_deg + 90  # this is the steering angle needed by picar front wheel
 
-    logging.debug('new steering angle: %s' % steering_angle)
+    _log.debug('new steering angle: %s', steering_angle)
     return steering_angle
 
 
@@ -233,13 +312,33 @@ def stabilize_steering_angle(curr_steering_angle, new_steering_angle, num_of_lan
                                         + max_angle_deviation * angle_deviation / abs(angle_deviation))
     else:
         stabilized_steering_angle = new_steering_angle
-    logging.info('Proposed angle: %s, stabilized angle: %s' % (new_steering_angle, stabilized_steering_angle))
+    # every frame, so only every 20th is logged, about once a second
+    _log.info('Proposed angle: %s, stabilized angle: %s', new_steering_angle, stabilized_steering_angle, every_n=20)
     return stabilized_steering_angle
 
 
+def stabilize_steering_angle_rate(curr_steering_angle, new_steering_angle, num_of_lane_lines, elapsed_sec,
+                                  max_rate_two_lines=100, max_rate_one_lane=20):
+    """
+    Same as stabilize_steering_angle, but the max deviation is in degrees per second instead of per frame,
+    so it does not depend on the frame rate.  The defaults match the per frame limits at 20 frames per second.
+    Returns a float, the caller rounds when writing to the wheels.
+    """
+    if num_of_lane_lines == 2:
+        max_angle_deviation = max_rate_two_lines * elapsed_sec
+    else:
+        max_angle_deviation = max_rate_one_lane * elapsed_sec
+
+    angle_deviation = new_steering_angle - curr_steering_angle
+    if abs(angle_deviation) > max_angle_deviation:
+        return curr_steering_angle + math.copysign(max_angle_deviation, angle_deviation)
+    return float(new_steering_angle)
+
+
 ############################
 # Utility Functions
 ############################
+@timed('draw')
 def display_lines(frame, lines, line_color=(0, 255, 0), line_width=10):
     line_image = np.zeros_like(frame)
     if lines is not None:
@@ -250,6 +349,7 @@ def display_lines(frame, lines, line_color=(0, 255, 0), line_width=10):
     return line_image
 
 
+@timed('draw')
 def display_heading_line(frame, steering_angle, line_color=(0, 0, 255), line_width=5, ):
     heading_image = np.zeros_like(frame)
     height, width, _ = frame.shape
@@ -0,0 +1,66 @@
+import collections
+import logging
+import threading
+import time
+
+
+class KeyboardInput(object):
+    """
+    Reads keys on a background thread, so the capture loop never blocks waiting for a keypress.
+
+    source is a blocking callable that returns the next key, getch.getch by default.
+    It may return None to signal the end of input (see ScriptedKeys).
+    The capture loop calls keys() once per frame, to get every key pressed since the last frame.
+    """
+
+    def __init__(self, source=None, max_pending=32):
+        if source is None:
+            import getch
+            source = getch.getch
+        self.source = source
+        self.lock = threading.Lock()
+        self.pending = collections.deque(maxlen=max_pending)  # drop the oldest keys if nobody reads them
+        self.latest_key = None
+        self.latest_key_time = None
+        self.key_count = 0
+        self.thread = threading.Thread(target=self.run, name='keyboard_input')
+        self.thread.daemon = True  # getch can't be interrupted, don't let it keep the process alive
+        self.thread.start()
+
+    def run(self):
+        while True:
+            key = self.source()
+            if key is None:
+                logging.debug('keyboard input: end of input')
+                return
+            with self.lock:
+                self.pending.append(key)
+                self.latest_key = key
+                self.latest_key_time = time.monotonic()
+                self.key_count += 1
+
+    def keys(self):
+        """ Keys pressed since the last call, oldest first """
+        with self.lock:
+            keys = list(self.pending)
+            self.pending.clear()
+        return keys
+
+    def latest(self):
+        """ (key, time.monotonic() of the press) of the most recent key, (None, None) before the first key """
+        with self.lock:
+            return self.latest_key, self.latest_key_time
+
+
+class ScriptedKeys(object):
+    """ A key source that plays back a fixed list of keys, one every `interval` seconds, for tests """
+
+    def __init__(self, keys, interval=0.01):
+        self.keys = list(keys)
+        self.interval = interval
+
+    def __call__(self):
+        if not self.keys:
+            return None
+        time.sleep(self.interval)
+        return self.keys.pop(0)
@@ -0,0 +1,256 @@
+import collections
+import logging
+import threading
+import time
+import spans
+
+# What the watchdog does when the latency budget is exceeded
+ACTION_LOG = 'log'  # log a warning, rate-limited
+ACTION_BRAKE = 'brake'  # log, and stop the back wheels, once
+
+FrameTrace = collections.namedtuple('FrameTrace', ['frame_id', 'capture_time'])
+
+
+class LatencyTracer(object):
+    """
+    Traces every frame from capture to the wheel write that acts on it.
+
+    The drive loop calls begin_frame() right after the camera returns a frame, which gives the frame an id
+    and records its capture time (time.monotonic()).  Whatever writes to the wheels, the Actuator thread,
+    the SteeringController or a direct write, reports the write with actuated() and the frame the command
+    was based on.  From that the tracer records
+        glass to actuator -- capture to the first wheel write based on the frame, once per frame
+        command age       -- capture to write, for every write, e.g. controller ticks steering on an old frame
+    both in ms, and as 'glass_to_actuator' and 'command_age' spans when spans are enabled.
+    The capture time is taken when camera.read() returns, so the sensor exposure and readout before
+    that are not included.
+
+    With budget_ms set, a write older than the budget, or no new frame for longer than the budget
+    (a stalled camera or vision loop, checked by the watchdog thread) is a violation, see ACTION_LOG, ACTION_BRAKE.
+    Once braked, the car stays braked: every later speed command is clamped to 0 (see clamp_speed(),
+    used by the traced back wheels and the Actuator) until reset_brake(), which DeepPiCar calls on SIGUSR2.
+    """
+
+    def __init__(self, budget_ms=None, action=ACTION_LOG, on_brake=None, history=1000):
+        self.budget = budget_ms / 1000.0 if budget_ms is not None else None
+        self.action = action
+        self.on_brake = on_brake
+
+        self.lock = threading.Lock()
+        self.frame_id = 0
+        self.current = None  # FrameTrace of the frame the vision thread is working on
+        self.last_actuated_frame_id = -1
+        self.glass_to_actuator = collections.deque(maxlen=history)  # (frame_id, ms)
+        self.command_ages = collections.deque(maxlen=history)  # (frame_id, command, ms)
+        self.actuations = 0
+        self.violations = 0
+        self.braked = False
+        self.last_violation_log = 0
+
+        self.running = True
+        self.watchdog = None
+
+    def begin_frame(self, capture_time=None):
+        """ Called by the vision thread for every captured frame, returns its FrameTrace """
+        if capture_time is None:
+            capture_time = time.monotonic()
+        with self.lock:
+            self.frame_id += 1
+            self.current = FrameTrace(self.frame_id, capture_time)
+            return self.current
+
+    def current_frame(self):
+        """ FrameTrace of the frame being processed, None before the first frame """
+        return self.current
+
+    def actuated(self, frame, command, value, write_time=None):
+        """ A wheel write of value ('turn' or 'speed') based on frame has completed """
+        if frame is None or not self.running:
+            return
+        if write_time is None:
+            write_time = time.monotonic()
+        age = write_time - frame.capture_time
+        with self.lock:
+            self.actuations += 1
+            self.command_ages.append((frame.frame_id, command, age * 1000))
+            first_write = frame.frame_id > self.last_actuated_frame_id
+            if first_write:
+                self.last_actuated_frame_id = frame.frame_id
+                self.glass_to_actuator.append((frame.frame_id, age * 1000))
+        if spans.is_enabled():
+            spans.record('command_age', int(age * 1e9))
+            if first_write:
+                spans.record('glass_to_actuator', int(age * 1e9))
+        if self.budget is not None and age > self.budget:
+            self.violation('%s %s based on frame %d, %.0fms after capture' %
+                           (command, value, frame.frame_id, age * 1000))
+
+    def check(self, now=None):
+        """ Watchdog check, a violation if no frame was captured within the budget """
+        if now is None:
+            now = time.monotonic()
+        frame = self.current
+        if frame is not None and now - frame.capture_time > self.budget:
+            self.violation('no new frame for %.0fms, last frame %d' % ((now - frame.capture_time) * 1000,
+                                                                      frame.frame_id))
+
+    def violation(self, message):
+        with self.lock:
+            self.violations += 1
+            brake = self.action == ACTION_BRAKE and not self.braked
+            if brake:
+                self.braked = True
+            now = time.monotonic()
+            log = brake or now - self.last_violation_log >= 1.0
+            if log:
+                self.last_violation_log = now
+        if log:
+            logging.warning('Latency budget of %.0fms exceeded (%d times so far): %s' %
+                            (self.budget * 1000, self.violations, message))
+        if brake:
+            logging.error('Braking, latency budget exceeded')
+            if self.on_brake is not None:
+                self.on_brake()
+
+    def clamp_speed(self, speed):
+        """ The speed to write for a speed command, 0 while braked """
+        if self.braked and speed:
+            logging.debug('Braked, speed %s ignored' % speed)
+            return 0
+        return speed
+
+    def reset_brake(self):
+        """ Let speed commands through again after a brake """
+        with self.lock:
+            self.braked = False
+        logging.info('Brake released')
+
+    def start_watchdog(self):
+        if self.budget is None or self.watchdog is not None:
+            return
+        self.watchdog = threading.Thread(target=self.run_watchdog, name='latency_watchdog')
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def run_watchdog(self):
+        while self.running:
+            time.sleep(self.budget / 4)
+            if self.running:
+                self.check()
+
+    def stop(self):
+        """ Stop tracing, writes after this (e.g. resetting the wheels) are not traced """
+        self.running = False
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+        logging.info('Latency: %s' % self.stats())
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(ms for _, ms in self.glass_to_actuator)
+            ages = sorted(ms for _, _, ms in self.command_ages)
+        return {
+            'frames': self.frame_id,
+            'actuations': self.actuations,
+            'violations': self.violations,
+            'glass_to_actuator_p50_ms': percentile(latencies, 50),
+            'glass_to_actuator_max_ms': latencies[-1] if latencies else 0,
+            'command_age_p50_ms': percentile(ages, 50),
+            'command_age_max_ms': ages[-1] if ages else 0,
+        }
+
+
+class TracedFrontWheels(object):
+    """ Same interface as picar.front_wheels.Front_Wheels, reports every write to the tracer """
+
+    def __init__(self, front_wheels, tracer):
+        self.wheels = front_wheels
+        self.tracer = tracer
+
+    def turn(self, angle, frame=None):
+        self.wheels.turn(angle)
+        self.tracer.actuated(frame or self.tracer.current_frame(), 'turn', angle)
+
+
+class TracedBackWheels(object):
+    """ Same interface as picar.back_wheels.Back_Wheels, reports every write to the tracer """
+
+    def __init__(self, back_wheels, tracer):
+        self.wheels = back_wheels
+        self.tracer = tracer
+
+    @property
+    def speed(self):
+        return self.wheels.speed
+
+    @speed.setter
+    def speed(self, speed):
+        speed = self.tracer.clamp_speed(speed)
+        self.wheels.speed = speed
+        self.tracer.actuated(self.tracer.current_frame(), 'speed', speed)
+
+
+############################
+# Utility Functions
+############################
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+############################
+# Test Functions
+############################
+def test_latency_tracer():
+    import fake_picar
+
+    brakes = []
+    back_wheels = TracedBackWheels(fake_picar.FakeBackWheels(), None)
+
+    def brake():
+        brakes.append(time.monotonic())
+        back_wheels.speed = 0
+
+    tracer = LatencyTracer(budget_ms=50, action=ACTION_BRAKE, on_brake=brake)
+    back_wheels.tracer = tracer
+    front_wheels = TracedFrontWheels(fake_picar.FakeFrontWheels(), tracer)
+    back_wheels.speed = 40
+
+    # on time: one latency per frame, no violation
+    for angle in (90, 95, 100):
+        tracer.begin_frame()
+        time.sleep(0.01)
+        front_wheels.turn(angle)
+        front_wheels.turn(angle)  # second write of the same frame only counts as a command age
+    assert len(tracer.glass_to_actuator) == 3 and len(tracer.command_ages) == 6, tracer.stats()
+    assert tracer.violations == 0 and not brakes, tracer.stats()
+
+    # a write based on an old frame brakes, once
+    frame = tracer.begin_frame()
+    time.sleep(0.06)
+    front_wheels.turn(110, frame)
+    front_wheels.turn(115, frame)
+    assert tracer.violations == 3 and len(brakes) == 1, tracer.stats()  # the brake's own write is late too
+
+    # the brake holds, a later speed command from the drive loop does not restart the wheels
+    back_wheels.speed = 40
+    assert back_wheels.speed == 0, back_wheels.wheels.writes
+    tracer.reset_brake()
+    tracer.begin_frame()  # on an old frame the write would be late, and brake again
+    back_wheels.speed = 30
+    assert back_wheels.speed == 30, back_wheels.wheels.writes
+
+    # the watchdog notices the vision loop stalling
+    tracer.start_watchdog()
+    time.sleep(0.1)
+    tracer.stop()
+    assert tracer.violations > 3, tracer.stats()
+    logging.info('latency tracer stats: %s' % tracer.stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_latency_tracer()
@@ -0,0 +1,171 @@
+"""
+Logging for the per-frame hot path.
+
+The vision code logs from inside loops that run for every frame, and for every line segment in a frame.
+Formatting those messages eagerly ('%s' % ...) costs time even when the level is off, and with the
+level on, the log floods.  A module keeps one RateLimitedLogger:
+
+    _log = RateLimitedLogger(__name__, max_per_second=20)
+
+    if _log.isEnabledFor(logging.DEBUG):  # skips the loop, and whatever the arguments cost, when DEBUG is off
+        for line_segment in line_segments:
+            _log.debug('detected line_segment: %s of length %s', line_segment, length_of_line_segment(line_segment))
+    _log.info('Proposed angle: %s, stabilized angle: %s', new_angle, angle, every_n=20)  # every 20th call only
+
+Arguments are passed through to logging, so they are only formatted if the message is emitted.
+Every level has its own rate: messages over it are dropped, and the next emitted message of that level
+says how many were.  A flood of DEBUG messages never uses up what is left for the warnings and errors.
+
+Usage:
+# per-frame cost of the hot path logging, with DEBUG off and on
+python log_limits.py
+"""
+import logging
+import os
+import time
+
+
+class RateLimitedLogger(object):
+
+    def __init__(self, name, max_per_second=20):
+        self.logger = logging.getLogger(name)
+        self.max_per_second = max_per_second
+        self.tokens = {}  # level -> tokens left in its bucket
+        self.last_refill = {}  # level -> time.monotonic() of the last refill
+        self.suppressed = {}  # level -> messages dropped since the last one emitted
+        self.calls = {}  # message -> number of calls, for every_n
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args, every_n=1):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, msg, args, every_n)
+
+    def info(self, msg, *args, every_n=1):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.log(logging.INFO, msg, args, every_n)
+
+    def warning(self, msg, *args, every_n=1):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.log(logging.WARNING, msg, args, every_n)
+
+    def error(self, msg, *args, every_n=1):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.log(logging.ERROR, msg, args, every_n)
+
+    def log(self, level, msg, args, every_n=1):
+        if every_n > 1:
+            count = self.calls.get(msg, 0)
+            self.calls[msg] = count + 1
+            if count % every_n:
+                return
+        if not self.take_token(level):
+            self.suppressed[level] = self.suppressed.get(level, 0) + 1
+            return
+        suppressed = self.suppressed.get(level)
+        if suppressed:
+            msg = msg + ' (%d messages suppressed)'
+            args = args + (suppressed,)
+            self.suppressed[level] = 0
+        self.logger.log(level, msg, *args)
+
+    def take_token(self, level):
+        """ Token bucket of the level, refilled at max_per_second, holding at most one second's worth """
+        if self.max_per_second is None:
+            return True
+        now = time.monotonic()
+        tokens = self.tokens.get(level, float(self.max_per_second))
+        tokens = min(self.max_per_second, tokens + (now - self.last_refill.get(level, now)) * self.max_per_second)
+        self.last_refill[level] = now
+        if tokens < 1:
+            self.tokens[level] = tokens
+            return False
+        self.tokens[level] = tokens - 1
+        return True
+
+
+############################
+# Test Functions
+############################
+def test_errors_after_debug_burst():
+    """ A burst of DEBUG messages is rate-limited, but does not hide the ERROR that follows it """
+    class Collect(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record)
+
+    logger = logging.getLogger('log_limits.test')
+    handler = Collect()
+    old_level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        log = RateLimitedLogger('log_limits.test', max_per_second=20)
+        for i in range(300):
+            log.debug('segment %d', i)
+        log.error('No lane lines detected, nothing to do.')
+        log.debug('one more segment')
+
+        levels = [record.levelno for record in handler.records]
+        assert levels.count(logging.DEBUG) <= 21, levels  # a second's worth, plus a little refill
+        assert levels.count(logging.ERROR) == 1, levels
+        error = [record for record in handler.records if record.levelno == logging.ERROR][0]
+        assert 'suppressed' not in error.getMessage(), error.getMessage()  # the dropped messages were DEBUG
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(old_level)
+
+
+def benchmark(frames=200, segments_per_frame=300):
+    """
+    Per-frame cost of logging every line segment, the way detect_line_segments did (eager formatting)
+    and does now (guarded, lazy, rate-limited), with DEBUG off and on.
+    """
+    import math
+
+    segments = [[i, 2 * i, i + 17, 2 * i + 40] for i in range(segments_per_frame)]
+
+    def length(line):
+        x1, y1, x2, y2 = line
+        return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+    def eager_frame():
+        for segment in segments:
+            logging.debug('detected line_segment:')
+            logging.debug("%s of length %s" % (segment, length(segment)))
+
+    log = RateLimitedLogger('log_limits.benchmark', max_per_second=20)
+
+    def limited_frame():
+        if log.isEnabledFor(logging.DEBUG):
+            for segment in segments:
+                log.debug('detected line_segment: %s of length %s', segment, length(segment))
+
+    root = logging.getLogger()
+    old_level = root.level
+    old_handlers = root.handlers[:]
+    devnull = open(os.devnull, 'w')
+    root.handlers = [logging.StreamHandler(devnull)]  # format and write everything, to nowhere
+    try:
+        for level_name, level in (('off', logging.INFO), ('on', logging.DEBUG)):
+            root.setLevel(level)
+            for name, frame_function in (('eager', eager_frame), ('guarded, lazy, rate-limited', limited_frame)):
+                start = time.perf_counter()
+                for _ in range(frames):
+                    frame_function()
+                per_frame_ms = (time.perf_counter() - start) / frames * 1000
+                print('DEBUG %-3s %-28s %8.3f ms per frame (%d segments)' %
+                      (level_name, name, per_frame_ms, segments_per_frame))
+    finally:
+        root.handlers = old_handlers
+        root.setLevel(old_level)
+        devnull.close()
+
+
+if __name__ == '__main__':
+    test_errors_after_debug_burst()
+    benchmark()
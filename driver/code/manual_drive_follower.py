@@ -10,41 +10,41 @@ _SHOW_IMAGE = False
 
 class ManualDriveLaneFollower(object):
 
-    def __init__(self, car=None):
+    def __init__(self, car=None, max_key_repeat=3):
         logging.info('Creating a ManualDriveLaneFollower...')
         self.car = car
         self.curr_steering_angle = 90
+        # a held key auto-repeats, and a slow frame can collect a burst of repeats:
+        # only apply this many presses of the same key in a row per frame
+        self.max_key_repeat = max_key_repeat
 
-    def manual_drive(self, frame, input):
+    def manual_drive(self, frame, keys):
         # Main entry point of the lane follower
+        # keys: the keys pressed since the last frame, oldest first, e.g. from KeyboardInput.keys()
+        #       a single key such as 'a' works too
         show_image("orig", frame)
         
         #Following line may be deleted later
         #lane_lines, frame = detect_lane(frame)
-        final_frame = self.steer(frame, input)
+        final_frame = self.steer(frame, keys)
 
         return final_frame
         
         
     #handles img saving as well now
-    def steer(self, frame, input):
+    def steer(self, frame, keys):
         logging.debug('steering...')
         new_steering_angle = self.curr_steering_angle
         #compute new angle
         #new_steering_angle = compute_steering_angle(frame, input)
-        if input == 'a':
-            new_steering_angle = self.curr_steering_angle - 5
-            #steering angle should never go below 0 or above 130
-            if new_steering_angle < 45:
-                new_steering_angle = 45
-        if input == 'd':
-            new_steering_angle = self.curr_steering_angle + 5
-            #steering angle should never go below 0 or above 130
-            if new_steering_angle > 135:
-                new_steering_angle = 135
-        if input == 's':
-            new_steering_angle = 90
-            
+        last_key = None
+        repeats = 0
+        for key in keys:
+            repeats = repeats + 1 if key == last_key else 1
+            last_key = key
+            if repeats > self.max_key_repeat:
+                continue
+            new_steering_angle = steering_angle_for_key(new_steering_angle, key)
           
         #getting rid of turn stabilization for now
         #self.curr_steering_angle = stabilize_steering_angle(self.curr_steering_angle, new_steering_angle)
@@ -66,6 +66,22 @@ class ManualDriveLaneFollower(object):
 
 
 
+def steering_angle_for_key(steering_angle, key):
+    if key == 'a':
+        steering_angle = steering_angle - 5
+        #steering angle should never go below 45 or above 135
+        if steering_angle < 45:
+            steering_angle = 45
+    if key == 'd':
+        steering_angle = steering_angle + 5
+        #steering angle should never go below 45 or above 135
+        if steering_angle > 135:
+            steering_angle = 135
+    if key == 's':
+        steering_angle = 90
+    return steering_angle
+
+
 #needs changes to remove lane lines from calculation
 #getting rid of stabalization for now
 '''def stabilize_steering_angle(curr_steering_angle, new_steering_angle, num_of_lane_lines, max_angle_deviation_two_lines=5, max_angle_deviation_one_lane=1):
@@ -170,6 +186,37 @@ def test_video(video_file):
         cv2.destroyAllWindows()
 
 
+def test_scripted_input():
+    # the capture loop runs at camera rate, while a scripted source types keys in the background
+    from keyboard_input import KeyboardInput, ScriptedKeys
+    import time
+
+    lane_follower = ManualDriveLaneFollower(max_key_repeat=3)
+    keyboard = KeyboardInput(ScriptedKeys(['a', 'a', 'd', 's', 'd', 'd', 'd', 'd', 'd'], interval=0.02))
+    frame = np.zeros((240, 320, 3), np.uint8)
+    frames = 0
+    angles = []
+    start = time.monotonic()
+    while keyboard.thread.is_alive() or frames == 0:
+        lane_follower.manual_drive(frame, keyboard.keys())
+        angles.append(lane_follower.curr_steering_angle)
+        frames += 1
+        time.sleep(0.002)
+    lane_follower.manual_drive(frame, keyboard.keys())
+    logging.info('%d frames in %.2fs while typing, angles: %s' % (frames, time.monotonic() - start, angles))
+
+    # frames kept coming while waiting for keys
+    assert frames > 9, frames
+    assert 80 in angles, angles
+    # every key was applied, 'd' at most max_key_repeat times per frame
+    assert 105 <= lane_follower.curr_steering_angle <= 115, lane_follower.curr_steering_angle
+
+    # a burst of repeats collected by one slow frame is capped
+    lane_follower.curr_steering_angle = 90
+    lane_follower.manual_drive(frame, ['a'] * 10)
+    assert lane_follower.curr_steering_angle == 75, lane_follower.curr_steering_angle
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
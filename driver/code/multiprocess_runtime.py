@@ -0,0 +1,347 @@
+"""
+Optional multi-process driving runtime.
+
+The capture loop (main process) writes every camera frame into a slot of a
+multiprocessing.shared_memory ring.  Lane following, object detection and recording
+each run in their own worker process and read the slots zero-copy, so Keras, the
+Edge TPU, OpenCV and the video encoder are no longer serialized behind one GIL.
+Steering and speed commands come back to the main process over a Queue, and are
+applied to the wheels there.
+
+Usage (benchmark against the single-process loop, no car needed):
+python multiprocess_runtime.py ../data/tmp/video01.avi
+"""
+import cv2
+import logging
+import multiprocessing
+import numpy as np
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+
+class SharedFrameRing(object):
+    """
+    A fixed number of frame slots in one shared memory block.  Each slot carries a
+    reader count, the capture loop only reuses a slot once every reader released it.
+    """
+
+    def __init__(self, num_slots, frame_shape, name=None, refcounts=None):
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        self.owner = name is None
+        size = num_slots * int(np.prod(self.frame_shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.frames = np.ndarray((num_slots,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.refcounts = refcounts if refcounts is not None else multiprocessing.Array('i', num_slots)
+        self.next_slot = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def acquire(self, readers):
+        """ Find a free slot and hand it to `readers` readers, returns None if all slots are in use """
+        with self.refcounts.get_lock():
+            for i in range(self.num_slots):
+                slot = (self.next_slot + i) % self.num_slots
+                if self.refcounts[slot] == 0:
+                    self.refcounts[slot] = readers
+                    self.next_slot = (slot + 1) % self.num_slots
+                    return slot
+        return None
+
+    def release(self, slot):
+        with self.refcounts.get_lock():
+            self.refcounts[slot] -= 1
+
+    def frame(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class MultiProcessRuntime(object):
+    """
+    Runs capture in this process, and lane following, object detection and recording
+    in worker processes that share frames through a SharedFrameRing.
+
+    lane_follower is 'hand_coded' or 'end_to_end'.  Workers that fall behind skip to
+    the newest frame (the recorder never skips).  With drop_when_busy, the capture
+    loop drops a frame when no slot is free instead of waiting for one.
+
+    The ring and the workers are created on the first frame, with its shape, so any
+    camera or video size works.
+    """
+
+    def __init__(self, camera, front_wheels=None, back_wheels=None,
+                 lane_follower='hand_coded', lane_options=None,
+                 detect_objects=False, objects_options=None,
+                 record_path=None, num_slots=8, drop_when_busy=True):
+        logging.info('Creating a MultiProcessRuntime...')
+        self.camera = camera
+        self.front_wheels = front_wheels
+        self.back_wheels = back_wheels
+        self.drop_when_busy = drop_when_busy
+        self.num_slots = num_slots
+        self.ring = None  # created with the first frame's shape, see start()
+        self.command_queue = multiprocessing.Queue()
+
+        self.worker_specs = [(lane_follower, lane_options or {})]
+        if detect_objects:
+            self.worker_specs.append(('objects', objects_options or {}))
+        if record_path is not None:
+            self.worker_specs.append(('recorder', {'path': record_path}))
+        self.workers = []
+
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.latencies = []  # capture to steering command, in seconds
+        self.curr_steering_angle = 90
+        self.speed = 0
+
+    def start(self, frame_shape):
+        self.ring = SharedFrameRing(self.num_slots, frame_shape)
+        for kind, options in self.worker_specs:
+            if kind == 'recorder':
+                options = dict(options, frame_shape=self.ring.frame_shape)
+            frame_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_worker_main, name='%s_worker' % kind,
+                                              args=(kind, options, self.ring.name, self.ring.num_slots,
+                                                    self.ring.frame_shape, self.ring.refcounts,
+                                                    frame_queue, self.command_queue))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, frame_queue))
+        logging.info('Started %d worker processes' % len(self.workers))
+
+    def run(self, speed=0, max_frames=None, running=None):
+        """
+        Capture loop, runs until the camera closes, max_frames have been captured, or running()
+        returns False, e.g. lambda: car.running, which a signal handler clears
+        """
+        self.speed = speed
+        if self.back_wheels is not None:
+            self.back_wheels.speed = speed
+        try:
+            while self.camera.isOpened() and (max_frames is None or self.frames_captured < max_frames):
+                if running is not None and not running():
+                    logging.info('Stopped after %d frames' % self.frames_captured)
+                    break
+                ret, frame = self.camera.read()
+                if not ret:
+                    break
+                capture_time = time.monotonic()
+                if self.ring is None:
+                    self.start(frame.shape)
+                self.submit(frame, capture_time)
+                self.drain_commands()
+        finally:
+            self.stop()
+
+    def submit(self, frame, capture_time):
+        frame_id = self.frames_captured
+        self.frames_captured += 1
+        slot = self.ring.acquire(len(self.workers))
+        while slot is None and not self.drop_when_busy:
+            self.drain_commands(timeout=0.001)
+            slot = self.ring.acquire(len(self.workers))
+        if slot is None:
+            self.frames_dropped += 1
+            return
+        self.ring.frame(slot)[:] = frame
+        for _, frame_queue in self.workers:
+            frame_queue.put((slot, frame_id, capture_time))
+
+    def drain_commands(self, timeout=None):
+        """ Apply all steering and speed commands sent back by the workers """
+        while True:
+            try:
+                if timeout is not None:
+                    command = self.command_queue.get(timeout=timeout)
+                    timeout = None
+                else:
+                    command = self.command_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.apply_command(*command)
+
+    def apply_command(self, kind, frame_id, capture_time, value):
+        if kind == 'steer':
+            self.latencies.append(time.monotonic() - capture_time)
+            self.curr_steering_angle = value
+            if self.front_wheels is not None:
+                self.front_wheels.turn(value)
+        elif kind == 'speed':
+            self.speed = value
+            if self.back_wheels is not None:
+                self.back_wheels.speed = value
+
+    def stop(self):
+        for _, frame_queue in self.workers:
+            frame_queue.put(None)
+        # keep draining while workers finish, a worker blocked on a full pipe would never exit
+        while any(process.is_alive() for process, _ in self.workers):
+            self.drain_commands(timeout=0.05)
+        self.drain_commands()
+        for process, _ in self.workers:
+            process.join()
+        self.workers = []
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        logging.info('Captured %d frames, dropped %d' % (self.frames_captured, self.frames_dropped))
+
+
+############################
+# Worker processes
+############################
+class _LaneWorker(object):
+
+    def __init__(self, kind, options):
+        if kind == 'end_to_end':
+            from end_to_end_lane_follower import EndToEndLaneFollower
+            self.lane_follower = EndToEndLaneFollower(**options)
+        else:
+            from hand_coded_lane_follower import HandCodedLaneFollower
+            self.lane_follower = HandCodedLaneFollower(**options)
+        self.lane_follower.draw_overlay = False
+
+    def process(self, frame):
+        self.lane_follower.follow_lane(frame)
+        return 'steer', self.lane_follower.curr_steering_angle
+
+    def close(self):
+        pass
+
+
+class _ObjectsWorker(object):
+
+    def __init__(self, options):
+        from objects_on_road_processor import ObjectsOnRoadProcessor
+        self.processor = ObjectsOnRoadProcessor(**options)
+        self.processor.draw_overlay = False
+
+    def process(self, frame):
+        # the processor may draw on the frame, and the slot is shared with the other workers
+        self.processor.process_objects_on_road(frame.copy())
+        return 'speed', self.processor.speed
+
+    def close(self):
+        pass
+
+
+class _RecordWorker(object):
+
+    def __init__(self, path, frame_shape):
+        height, width, _ = frame_shape
+        self.video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), 20.0, (width, height))
+
+    def process(self, frame):
+        self.video.write(frame)
+        return None
+
+    def close(self):
+        self.video.release()
+
+
+def _create_worker(kind, options):
+    if kind in ('hand_coded', 'end_to_end'):
+        return _LaneWorker(kind, options)
+    if kind == 'objects':
+        return _ObjectsWorker(options)
+    if kind == 'recorder':
+        return _RecordWorker(**options)
+    raise ValueError('Unknown worker kind: %s' % kind)
+
+
+def _worker_main(kind, options, ring_name, num_slots, frame_shape, refcounts, frame_queue, command_queue):
+    ring = SharedFrameRing(num_slots, frame_shape, name=ring_name, refcounts=refcounts)
+    worker = _create_worker(kind, options)
+    latest_only = kind != 'recorder'
+    try:
+        while True:
+            item = frame_queue.get()
+            # vision workers skip straight to the newest frame, releasing the stale ones
+            while latest_only and item is not None:
+                try:
+                    newer = frame_queue.get_nowait()
+                except queue.Empty:
+                    break
+                ring.release(item[0])
+                item = newer
+            if item is None:
+                break
+
+            slot, frame_id, capture_time = item
+            try:
+                command = worker.process(ring.frame(slot))
+            finally:
+                ring.release(slot)
+            if command is not None:
+                command_queue.put((command[0], frame_id, capture_time, command[1]))
+    finally:
+        worker.close()
+        ring.close()
+
+
+############################
+# Test Functions
+############################
+def benchmark(video_file, max_frames=500):
+    """ Compare per-frame latency and throughput of the single-process loop and the multi-process runtime """
+    from hand_coded_lane_follower import HandCodedLaneFollower
+
+    # single process, same order of work as DeepPiCar.drive: record, then follow lane
+    lane_follower = HandCodedLaneFollower()
+    lane_follower.draw_overlay = False
+    cap = cv2.VideoCapture(video_file)
+    video = None
+    latencies = []
+    start = time.monotonic()
+    while cap.isOpened() and len(latencies) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        capture_time = time.monotonic()
+        if video is None:
+            height, width = frame.shape[:2]
+            video = cv2.VideoWriter('/tmp/benchmark_single.avi', cv2.VideoWriter_fourcc(*'XVID'), 20.0,
+                                    (width, height))
+        video.write(frame)
+        lane_follower.follow_lane(frame)
+        latencies.append(time.monotonic() - capture_time)
+    single_elapsed = time.monotonic() - start
+    cap.release()
+    if video is not None:
+        video.release()
+    print_benchmark('single-process', len(latencies), len(latencies), single_elapsed, latencies)
+
+    cap = cv2.VideoCapture(video_file)
+    runtime = MultiProcessRuntime(cap, record_path='/tmp/benchmark_multi.avi', drop_when_busy=False)
+    start = time.monotonic()
+    runtime.run(max_frames=max_frames)
+    multi_elapsed = time.monotonic() - start
+    cap.release()
+    print_benchmark('multi-process', runtime.frames_captured, len(runtime.latencies), multi_elapsed, runtime.latencies)
+
+
+def print_benchmark(name, frames, steered, elapsed, latencies):
+    if not latencies:
+        print('%-15s frames=%4d steered=%4d, no steering commands, nothing to measure' % (name, frames, steered))
+        return
+    latencies_ms = np.array(latencies) * 1000
+    print('%-15s frames=%4d steered=%4d throughput=%6.1f FPS latency mean=%6.2fms p50=%6.2fms p95=%6.2fms' %
+          (name, frames, steered, frames / elapsed, latencies_ms.mean(),
+           np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 95)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    benchmark(sys.argv[1])
@@ -4,9 +4,12 @@ import datetime
 import time
 import edgetpu.detection.engine
 from PIL import Image
+from log_limits import RateLimitedLogger
+from spans import span
 from traffic_objects import *
 
 _SHOW_IMAGE = False
+_log = RateLimitedLogger(__name__)  # for the per-frame code, see log_limits.py
 
 
 class ObjectsOnRoadProcessor(object):
@@ -32,6 +35,10 @@ class ObjectsOnRoadProcessor(object):
         self.car = car
         self.speed_limit = speed_limit
         self.speed = speed_limit
+        self.objects = []
+        self.draw_overlay = True  # set to False when overlays are rendered offline, see render_overlays.py
+        self.detect_every = 1  # run the detector on every n-th frame only, see quality_governor.py
+        self.frame_count = 0
 
         # initialize TensorFlow models
         with open(label, 'r') as f:
@@ -67,19 +74,24 @@ class ObjectsOnRoadProcessor(object):
 
     def process_objects_on_road(self, frame):
         # Main entry point of the Road Object Handler
-        logging.debug('Processing objects.................................')
+        self.frame_count += 1
+        if self.frame_count % self.detect_every:
+            # skipped frame, the objects and the speed from the last detection still hold
+            return frame
+        _log.debug('Processing objects.................................')
         objects, final_frame = self.detect_objects(frame)
+        self.objects = objects
         self.control_car(objects)
-        logging.debug('Processing objects END..............................')
+        _log.debug('Processing objects END..............................')
 
         return final_frame
 
     def control_car(self, objects):
-        logging.debug('Control car...')
+        _log.debug('Control car...')
         car_state = {"speed": self.speed_limit, "speed_limit": self.speed_limit}
 
         if len(objects) == 0:
-            logging.debug('No objects detected, drive at speed limit of %s.' % self.speed_limit)
+            _log.debug('No objects detected, drive at speed limit of %s.', self.speed_limit)
 
         contain_stop_sign = False
         for obj in objects:
@@ -88,7 +100,7 @@ class ObjectsOnRoadProcessor(object):
             if processor.is_close_by(obj, self.height):
                 processor.set_car_state(car_state)
             else:
-                logging.debug("[%s] object detected, but it is too far, ignoring. " % obj_label)
+                _log.debug("[%s] object detected, but it is too far, ignoring. ", obj_label)
             if obj_label == 'Stop':
                 contain_stop_sign = True
 
@@ -106,7 +118,7 @@ class ObjectsOnRoadProcessor(object):
             self.set_speed(0)
         else:
             self.set_speed(self.speed_limit)
-        logging.debug('Current Speed = %d, New Speed = %d' % (old_speed, self.speed))
+        _log.debug('Current Speed = %d, New Speed = %d', old_speed, self.speed)
 
         if self.speed == 0:
             logging.debug('full stop for 1 seconds')
@@ -116,8 +128,9 @@ class ObjectsOnRoadProcessor(object):
         # Use this setter, so we can test this class without a car attached
         self.speed = speed
         if self.car is not None:
-            logging.debug("Actually setting car speed to %d" % speed)
-            self.car.back_wheels.speed = speed
+            _log.debug("Actually setting car speed to %d", speed)
+            with span('actuation'):
+                self.car.back_wheels.speed = speed
 
 
 
@@ -125,33 +138,39 @@ class ObjectsOnRoadProcessor(object):
     # Frame processing steps
     ############################
     def detect_objects(self, frame):
-        logging.debug('Detecting objects...')
+        _log.debug('Detecting objects...')
 
         # call tpu for inference
-        start_ms = time.time()
-        frame_RGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img_pil = Image.fromarray(frame_RGB)
-        objects = self.engine.DetectWithImage(img_pil, threshold=self.min_confidence, keep_aspect_ratio=True,
-                                         relative_coord=False, top_k=self.num_of_objects)
+        start = time.perf_counter()
+        with span('detection'):
+            frame_RGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            img_pil = Image.fromarray(frame_RGB)
+            objects = self.engine.DetectWithImage(img_pil, threshold=self.min_confidence, keep_aspect_ratio=True,
+                                             relative_coord=False, top_k=self.num_of_objects)
+        elapsed = time.perf_counter() - start  # detection only, drawing is timed as its own span
         if objects:
-            for obj in objects:
-                height = obj.bounding_box[1][1]-obj.bounding_box[0][1]
-                width = obj.bounding_box[1][0]-obj.bounding_box[0][0]
-                logging.debug("%s, %.0f%% w=%.0f h=%.0f" % (self.labels[obj.label_id], obj.score * 100, width, height))
-                box = obj.bounding_box
-                coord_top_left = (int(box[0][0]), int(box[0][1]))
-                coord_bottom_right = (int(box[1][0]), int(box[1][1]))
-                cv2.rectangle(frame, coord_top_left, coord_bottom_right, self.boxColor, self.boxLineWidth)
-                annotate_text = "%s %.0f%%" % (self.labels[obj.label_id], obj.score * 100)
-                coord_top_left = (coord_top_left[0], coord_top_left[1] + 15)
-                cv2.putText(frame, annotate_text, coord_top_left, self.font, self.fontScale, self.boxColor, self.lineType)
+            with span('draw'):
+                for obj in objects:
+                    height = obj.bounding_box[1][1]-obj.bounding_box[0][1]
+                    width = obj.bounding_box[1][0]-obj.bounding_box[0][0]
+                    _log.debug("%s, %.0f%% w=%.0f h=%.0f", self.labels[obj.label_id], obj.score * 100, width, height)
+                    if not self.draw_overlay:
+                        continue
+                    box = obj.bounding_box
+                    coord_top_left = (int(box[0][0]), int(box[0][1]))
+                    coord_bottom_right = (int(box[1][0]), int(box[1][1]))
+                    cv2.rectangle(frame, coord_top_left, coord_bottom_right, self.boxColor, self.boxLineWidth)
+                    annotate_text = "%s %.0f%%" % (self.labels[obj.label_id], obj.score * 100)
+                    coord_top_left = (coord_top_left[0], coord_top_left[1] + 15)
+                    cv2.putText(frame, annotate_text, coord_top_left, self.font, self.fontScale, self.boxColor, self.lineType)
         else:
-            logging.debug('No object detected')
+            _log.debug('No object detected')
 
-        elapsed_ms = time.time() - start_ms
+        if not self.draw_overlay:
+            return objects, frame
 
-        annotate_summary = "%.1f FPS" % (1.0/elapsed_ms)
-        logging.debug(annotate_summary)
+        annotate_summary = "%.1f FPS" % (1.0/elapsed)
+        _log.debug(annotate_summary)
         cv2.putText(frame, annotate_summary, self.bottomLeftCornerOfText, self.font, self.fontScale, self.fontColor, self.lineType)
         #cv2.imshow('Detected Objects', frame)
 
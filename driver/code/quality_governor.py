@@ -0,0 +1,248 @@
+"""
+Thermal and load aware quality governor for the drive loop.
+
+Under sustained load the Pi gets hot and the firmware throttles the CPU clock, and then the frame rate
+of the lane loop collapses, without anything in the logs.  The governor watches
+    CPU temperature  -- /sys/class/thermal/thermal_zone0/temp, millidegrees C
+    CPU frequency    -- /sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq and cpuinfo_max_freq, kHz
+    loop latency     -- the drive loop's processing time per frame, without waiting for the camera, smoothed
+and when any of them crosses its high limit, steps down to the next cheaper QualityLevel: the object
+detector runs less often, no overlays are drawn, lane lines are detected on a downscaled frame, and at
+the lowest level nothing is recorded.  It steps back up one level at a time, once everything has been
+below its low limit (the hysteresis) for hold_s seconds.  Every change is logged with the reason.
+
+Recording is on or off, never every n-th frame: the videos are written at a fixed frame rate, and each
+frame has to match its telemetry record, see the 'recorded' field in telemetry.TELEMETRY_DTYPE.
+
+The drive loop calls update(frame_ms) once per frame, it returns the new QualityLevel on a change,
+and None otherwise.  /sys is read at most every interval_s.  Tests and other boards pass their own source,
+e.g. SysfsSource(root) over fake files, see test_quality_governor().
+"""
+import collections
+import logging
+import os
+import time
+
+# lane_scale -- lane lines are detected on the frame scaled by this
+# objects_every -- the object detector runs on every n-th frame
+# draw_overlay -- draw lane lines, heading and boxes on the frames
+# record -- record the videos, all frames or none, so they keep their frame rate and match the telemetry
+QualityLevel = collections.namedtuple('QualityLevel', ['name', 'lane_scale', 'objects_every', 'draw_overlay',
+                                                       'record'])
+
+QUALITY_LEVELS = [
+    QualityLevel('full', 1.0, 1, True, True),
+    QualityLevel('detector_every_2nd', 1.0, 2, True, True),
+    QualityLevel('no_overlays', 1.0, 2, False, True),
+    QualityLevel('half_resolution', 0.5, 3, False, True),
+    QualityLevel('minimal', 0.5, 5, False, False),
+]
+
+SystemReading = collections.namedtuple('SystemReading', ['temperature_c', 'frequency_mhz', 'max_frequency_mhz'])
+
+
+class SysfsSource(object):
+    """ Reads the CPU temperature and frequency from sysfs under root, None for anything that is not there """
+
+    TEMPERATURE = 'sys/class/thermal/thermal_zone0/temp'
+    FREQUENCY = 'sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'
+    MAX_FREQUENCY = 'sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq'
+
+    def __init__(self, root='/'):
+        self.root = root
+
+    def read_int(self, path):
+        try:
+            with open(os.path.join(self.root, path), 'r') as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read(self):
+        temperature = self.read_int(self.TEMPERATURE)
+        frequency = self.read_int(self.FREQUENCY)
+        max_frequency = self.read_int(self.MAX_FREQUENCY)
+        return SystemReading(temperature / 1000.0 if temperature is not None else None,
+                             frequency / 1000.0 if frequency is not None else None,
+                             max_frequency / 1000.0 if max_frequency is not None else None)
+
+
+class QualityGovernor(object):
+
+    def __init__(self, source=None, levels=QUALITY_LEVELS,
+                 temperature_high_c=75.0, temperature_low_c=68.0,
+                 throttled_ratio=0.9,
+                 frame_high_ms=50.0, frame_low_ms=35.0,
+                 interval_s=1.0, hold_s=5.0, smoothing=0.1):
+        """
+        source -- object with read() returning a SystemReading, defaults to SysfsSource()
+        temperature_high_c, temperature_low_c -- step down above the high limit, up only below the low one
+        throttled_ratio -- the CPU counts as throttled below this fraction of its max frequency while the loop
+                           is busy (the ondemand cpufreq governor also clocks an idle CPU down)
+        frame_high_ms, frame_low_ms -- limits of the smoothed processing time, over 50ms the camera's 20 fps are lost
+        interval_s -- seconds between checks, at most one step down per check
+        hold_s -- seconds everything has to stay below the low limits before a step up
+        smoothing -- weight of a new frame time in the smoothed frame time
+        """
+        self.source = source if source is not None else SysfsSource()
+        self.levels = levels
+        self.temperature_high_c = temperature_high_c
+        self.temperature_low_c = temperature_low_c
+        self.throttled_ratio = throttled_ratio
+        self.frame_high_ms = frame_high_ms
+        self.frame_low_ms = frame_low_ms
+        self.interval_s = interval_s
+        self.hold_s = hold_s
+        self.smoothing = smoothing
+
+        self.index = 0
+        self.frame_ms = None  # smoothed
+        self.last_check = None
+        self.calm_since = None  # when everything went below the low limits
+        self.last_reading = None
+        self.changes = []  # (time, from level name, to level name, reason)
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    def update(self, frame_ms=None, now=None):
+        """ Called once per frame, returns the new QualityLevel if it changed, else None """
+        if frame_ms is not None:
+            if self.frame_ms is None:
+                self.frame_ms = frame_ms
+            else:
+                self.frame_ms += self.smoothing * (frame_ms - self.frame_ms)
+        if now is None:
+            now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.interval_s:
+            return None
+        self.last_check = now
+        reading = self.source.read()
+        self.last_reading = reading
+
+        over = self.over_limits(reading)
+        if over:
+            self.calm_since = None
+            if self.index < len(self.levels) - 1:
+                return self.change(self.index + 1, now, ', '.join(over))
+            return None
+        if not self.under_limits(reading):
+            self.calm_since = None  # between the limits, stay
+            return None
+        if self.calm_since is None:
+            self.calm_since = now
+        if self.index > 0 and now - self.calm_since >= self.hold_s:
+            self.calm_since = now  # hold again before the next step up
+            return self.change(self.index - 1, now, 'below the low limits for %.0fs' % self.hold_s)
+        return None
+
+    def over_limits(self, reading):
+        """ What is over its high limit, as a list of strings """
+        over = []
+        if reading.temperature_c is not None and reading.temperature_c >= self.temperature_high_c:
+            over.append('cpu %.1fC, over %.1fC' % (reading.temperature_c, self.temperature_high_c))
+        if self.throttled(reading):
+            over.append('cpu throttled to %.0fMHz of %.0fMHz' % (reading.frequency_mhz, reading.max_frequency_mhz))
+        if self.frame_ms is not None and self.frame_ms >= self.frame_high_ms:
+            over.append('frame time %.1fms, over %.1fms' % (self.frame_ms, self.frame_high_ms))
+        return over
+
+    def throttled(self, reading):
+        busy = self.frame_ms is None or self.frame_ms >= self.frame_low_ms
+        return bool(busy and reading.frequency_mhz is not None and reading.max_frequency_mhz and
+                    reading.frequency_mhz < self.throttled_ratio * reading.max_frequency_mhz)
+
+    def under_limits(self, reading):
+        if reading.temperature_c is not None and reading.temperature_c >= self.temperature_low_c:
+            return False
+        if self.throttled(reading):
+            return False
+        if self.frame_ms is not None and self.frame_ms >= self.frame_low_ms:
+            return False
+        return True
+
+    def change(self, index, now, reason):
+        old = self.level
+        self.index = index
+        self.changes.append((now, old.name, self.level.name, reason))
+        log = logging.warning if index > self.levels.index(old) else logging.info
+        log('Quality %s -> %s (%s): %s' % (old.name, self.level.name, reason, self.level))
+        return self.level
+
+
+############################
+# Test Functions
+############################
+def test_quality_governor():
+    import shutil
+    import tempfile
+
+    root = tempfile.mkdtemp(prefix='quality_governor_')
+
+    def write(path, value):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('%d\n' % value)
+
+    try:
+        write(SysfsSource.TEMPERATURE, 55000)
+        write(SysfsSource.FREQUENCY, 1400000)
+        write(SysfsSource.MAX_FREQUENCY, 1400000)
+        governor = QualityGovernor(SysfsSource(root), interval_s=1.0, hold_s=5.0)
+        now = 0.0
+
+        # cool and fast, stays at full quality
+        for _ in range(10):
+            assert governor.update(30, now) is None
+            now += 0.5
+        assert governor.level.name == 'full'
+
+        # hot: one step down per check, not per frame
+        write(SysfsSource.TEMPERATURE, 79000)
+        assert governor.update(30, now).name == 'detector_every_2nd'
+        assert governor.update(30, now + 0.1) is None
+        # and throttled, while the loop is busy
+        write(SysfsSource.FREQUENCY, 600000)
+        for _ in range(20):
+            assert governor.update(45, now + 0.5) is None
+        now += 1.0
+        assert governor.update(45, now).name == 'no_overlays'
+        assert 'throttled' in governor.changes[-1][3], governor.changes
+
+        # between the limits: no change either way
+        write(SysfsSource.TEMPERATURE, 70000)
+        write(SysfsSource.FREQUENCY, 1400000)
+        for _ in range(20):
+            now += 1.0
+            assert governor.update(30, now) is None
+
+        # cool again: steps up one level after every hold_s
+        write(SysfsSource.TEMPERATURE, 60000)
+        levels = []
+        for _ in range(15):
+            now += 1.0
+            level = governor.update(30, now)
+            if level is not None:
+                levels.append(level.name)
+        assert levels == ['detector_every_2nd', 'full'], levels
+
+        # a slow loop alone also steps down, and missing sysfs files are ignored
+        governor = QualityGovernor(SysfsSource(os.path.join(root, 'missing')), interval_s=1.0)
+        level = None
+        for i in range(100):
+            level = governor.update(120, i * 0.1) or level
+        assert level is not None and governor.index > 0, governor.changes
+        # at the lowest level recording stops altogether, the levels above record every frame
+        assert not governor.levels[-1].record and all(level.record for level in governor.levels[:-1])
+        logging.info('changes: %s' % governor.changes)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test_quality_governor()
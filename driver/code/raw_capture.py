@@ -0,0 +1,62 @@
+import cv2
+import json
+import logging
+
+
+class RawCaptureRecorder(object):
+    """
+    Records only the original camera frames, plus a compact per-frame telemetry log
+    (one JSON object per line) with everything needed to rebuild the lane and object
+    overlays later, off the car.  See render_overlays.py for the offline renderer.
+    """
+
+    def __init__(self, video_path, telemetry_path, fourcc, fps, frame_size):
+        logging.info('Creating a RawCaptureRecorder, video=%s, telemetry=%s' % (video_path, telemetry_path))
+        self.video = cv2.VideoWriter(video_path, fourcc, fps, frame_size)
+        self.telemetry = open(telemetry_path, 'w')
+        self.frame_index = 0
+
+    def record(self, frame, timestamp, steering_angle, speed, lane_lines=None, objects=None):
+        self.video.write(frame)
+        entry = {
+            'frame': self.frame_index,
+            't': round(timestamp, 4),
+            'angle': int(steering_angle),
+            'speed': int(speed),
+            'lanes': lane_lines_to_list(lane_lines),
+            'objs': objects_to_list(objects),
+        }
+        self.telemetry.write(json.dumps(entry, separators=(',', ':')))
+        self.telemetry.write('\n')
+        self.frame_index += 1
+
+    def release(self):
+        logging.info('Recorded %d raw frames' % self.frame_index)
+        self.video.release()
+        self.telemetry.close()
+
+
+############################
+# Utility Functions
+############################
+def lane_lines_to_list(lane_lines):
+    # lane lines are [[[x1, y1, x2, y2]], ...], see hand_coded_lane_follower.make_points
+    if not lane_lines:
+        return []
+    return [[int(v) for v in line[0]] for line in lane_lines]
+
+
+def objects_to_list(objects):
+    # objects are edge TPU DetectionCandidates, stored as [label_id, score, [x1, y1, x2, y2]]
+    if not objects:
+        return []
+    return [[int(obj.label_id), round(float(obj.score), 3),
+             [int(obj.bounding_box[0][0]), int(obj.bounding_box[0][1]),
+              int(obj.bounding_box[1][0]), int(obj.bounding_box[1][1])]]
+            for obj in objects]
+
+
+def read_telemetry(telemetry_path):
+    """ Load a telemetry log written by RawCaptureRecorder, as a list of dicts, one per frame """
+    with open(telemetry_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
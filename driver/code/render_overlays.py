@@ -0,0 +1,158 @@
+"""
+Rebuild the lane and object overlay videos from a raw capture, on a desktop.
+
+The car records only the original frames plus a telemetry log (see raw_capture.py).
+This script replays both and renders the overlays across a process pool.  The video is decoded
+once, in order, in this process: seeking an XVID video is not frame accurate, so the workers
+get the decoded frames along with their telemetry, a few chunks at a time.
+
+Usage:
+python render_overlays.py ../data/car_video190601_101010.avi ../data/car_telemetry190601_101010.jsonl
+"""
+import argparse
+import collections
+import cv2
+import logging
+import multiprocessing
+import os
+from hand_coded_lane_follower import display_lines, display_heading_line
+from raw_capture import read_telemetry
+
+_CHUNK_SIZE = 64  # frames rendered per worker task
+_FONT = cv2.FONT_HERSHEY_SIMPLEX
+_BOX_COLOR = (0, 0, 255)  # RED, same as ObjectsOnRoadProcessor
+
+
+def render_chunk(args):
+    """ Worker: render lane and object overlays for decoded frames and their telemetry entries """
+    frames, entries, labels = args
+    lane_frames = []
+    objs_frames = []
+    for frame, entry in zip(frames, entries):
+        lane_frames.append(draw_lane_overlay(frame, entry))
+        objs_frames.append(draw_objects_overlay(frame.copy(), entry, labels))
+    return lane_frames, objs_frames
+
+
+def decode_chunks(video_path, entries, chunk_size=_CHUNK_SIZE):
+    """ Yields (frames, entries) of up to chunk_size frames, decoded in order, each frame with its own entry """
+    by_frame = dict((entry['frame'], entry) for entry in entries)
+    last_frame = max(by_frame)
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    chunk_entries = []
+    index = 0
+    try:
+        while index <= last_frame:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            entry = by_frame.get(index)
+            index += 1
+            if entry is None:
+                continue
+            frames.append(frame)
+            chunk_entries.append(entry)
+            if len(frames) == chunk_size:
+                yield frames, chunk_entries
+                frames = []
+                chunk_entries = []
+    finally:
+        cap.release()
+    if frames:
+        yield frames, chunk_entries
+    if index <= last_frame:
+        logging.warning('%s ended at frame %d, the telemetry goes up to frame %d' % (video_path, index, last_frame))
+
+
+def render_overlays(video_path, telemetry_path, output_dir=None, labels=None, processes=None, fps=20.0):
+    entries = read_telemetry(telemetry_path)
+    if not entries:
+        logging.warning('No telemetry in %s, nothing to render' % telemetry_path)
+        return
+    if labels is None:
+        labels = {}
+    if output_dir is None:
+        output_dir = os.path.dirname(video_path)
+    base_name = os.path.splitext(os.path.basename(video_path))[0]
+
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    fourcc = cv2.VideoWriter_fourcc(*'XVID')
+    video_lane = cv2.VideoWriter(os.path.join(output_dir, '%s_lane.avi' % base_name), fourcc, fps, (width, height))
+    video_objs = cv2.VideoWriter(os.path.join(output_dir, '%s_objs.avi' % base_name), fourcc, fps, (width, height))
+
+    logging.info('Rendering %d frames in chunks of %d' % (len(entries), _CHUNK_SIZE))
+    pool = multiprocessing.Pool(processes)
+    max_pending = 2 * (processes or multiprocessing.cpu_count())  # decoded chunks held in memory
+    pending = collections.deque()
+
+    def write_oldest():
+        # oldest first, so the encoders see frames in sequence
+        lane_frames, objs_frames = pending.popleft().get()
+        for frame in lane_frames:
+            video_lane.write(frame)
+        for frame in objs_frames:
+            video_objs.write(frame)
+
+    try:
+        for frames, chunk_entries in decode_chunks(video_path, entries):
+            pending.append(pool.apply_async(render_chunk, ((frames, chunk_entries, labels),)))
+            if len(pending) >= max_pending:
+                write_oldest()
+        while pending:
+            write_oldest()
+    finally:
+        pool.close()
+        pool.join()
+        video_lane.release()
+        video_objs.release()
+    logging.info('Rendered overlays for %s' % video_path)
+
+
+############################
+# Utility Functions
+############################
+def draw_lane_overlay(frame, entry):
+    lane_lines = [[line] for line in entry['lanes']]
+    lane_lines_image = display_lines(frame, lane_lines)
+    return display_heading_line(lane_lines_image, entry['angle'])
+
+
+def draw_objects_overlay(frame, entry, labels):
+    for label_id, score, box in entry['objs']:
+        coord_top_left = (box[0], box[1])
+        coord_bottom_right = (box[2], box[3])
+        cv2.rectangle(frame, coord_top_left, coord_bottom_right, _BOX_COLOR, 1)
+        annotate_text = "%s %.0f%%" % (labels.get(label_id, label_id), score * 100)
+        cv2.putText(frame, annotate_text, (box[0], box[1] + 15), _FONT, 1, _BOX_COLOR, 2)
+    return frame
+
+
+def load_labels(label_path):
+    with open(label_path, 'r') as f:
+        pairs = (l.strip().split(maxsplit=1) for l in f.readlines())
+        return dict((int(k), v) for k, v in pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render lane and object overlays from a raw capture')
+    parser.add_argument('video', help='raw video recorded by the car')
+    parser.add_argument('telemetry', help='telemetry log recorded along with the video')
+    parser.add_argument('--output_dir', help='directory for the overlay videos, defaults to the video directory')
+    parser.add_argument('--labels', help='label file of the object detection model',
+                        default='../../models/object_detection/data/model_result/road_sign_labels.txt')
+    parser.add_argument('--processes', help='number of render processes, defaults to cpu count', type=int)
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels) if os.path.exists(args.labels) else {}
+    render_overlays(args.video, args.telemetry, args.output_dir, labels, args.processes)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -0,0 +1,223 @@
+"""
+Hardware-free replay of the full DeepPiCar drive loop.
+
+DeepPiCar runs unchanged, with the fake_picar backend in place of the picar package,
+and a ReplayCamera that plays back a recorded AVI in place of the car camera.
+Every actuator command is logged, so the complete drive() path can be benchmarked,
+profiled and regression-tested on any Linux box.
+
+Usage:
+python replay_harness.py ../data/tmp/video01.avi --follower hand_coded --commands /tmp/commands.csv
+python replay_harness.py ../data/tmp/video01.avi --realtime --profile /tmp/drive.prof
+python replay_harness.py ../data/tmp/video01.avi --follower hand_coded --memory /tmp/alloc.json
+python replay_harness.py ../data/tmp/video01.avi --realtime --governor --frame_budget 50
+"""
+import argparse
+import cProfile
+import cv2
+import csv
+import logging
+import tempfile
+import time
+import fake_picar
+from deep_pi_car import DeepPiCar
+
+
+class ReplayCamera(object):
+    """
+    Stand-in for cv2.VideoCapture(-1) that replays a recorded video.
+    With realtime=True, read() paces the frames at the video frame rate, like a real camera,
+    otherwise frames are returned as fast as they can be decoded.
+    At the end of the video read() fails like a camera would, with end_of_stream set, so the drive loop
+    can tell a finished replay from a camera error.
+    """
+
+    def __init__(self, video_file, realtime=False, fps=None):
+        logging.info('Replaying %s, realtime=%s' % (video_file, realtime))
+        self.cap = cv2.VideoCapture(video_file)
+        self.realtime = realtime
+        self.fps = fps or self.cap.get(cv2.CAP_PROP_FPS) or 20.0
+        self.frames_read = 0
+        self.start_time = None
+        self.end_of_stream = False
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def set(self, prop, value):
+        # resolution is whatever was recorded
+        logging.debug('ReplayCamera ignores set(%s, %s)' % (prop, value))
+        return False
+
+    def read(self):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        if self.realtime:
+            delay = self.start_time + self.frames_read / self.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        ret, frame = self.cap.read()
+        if not ret:
+            # end of the recording, the drive loop stops once the camera is closed
+            self.end_of_stream = True
+            self.cap.release()
+            return False, None
+        self.frames_read += 1
+        return True, frame
+
+    def release(self):
+        self.cap.release()
+
+
+def replay(video_file, lane_follower_class=None, realtime=False, speed=40, actuator_rate_hz=None,
+           control_rate_hz=None, data_dir=None, memory_profiler=None, frame_budget_ms=None, governor=None):
+    """
+    Drive a simulated car over a recorded video, returns (frames, elapsed seconds, command log).
+    Without an actuator (the default), every command the drive loop issues reaches the fake wheels
+    and is logged.  With one, only the commands the actuator actually writes are logged.
+    With memory_profiler, an alloc_profile.AllocationProfiler, the allocations of the drive loop are profiled.
+    With frame_budget_ms, the drive loop runs with a per-frame budget, and logs its deadline misses at the end.
+    With governor, a quality_governor.QualityGovernor, the drive loop lowers its workload when it gets slow.
+    """
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='deep_pi_car_replay_')
+    fake_picar.reset_command_log()
+    camera = ReplayCamera(video_file, realtime)
+    start = time.monotonic()
+    with DeepPiCar(picar_backend=fake_picar, camera=camera, lane_follower_class=lane_follower_class,
+                   actuator_rate_hz=actuator_rate_hz, control_rate_hz=control_rate_hz,
+                   data_dir=data_dir, memory_profiler=memory_profiler, frame_budget_ms=frame_budget_ms,
+                   governor=governor) as car:
+        car.drive(speed)
+    elapsed = time.monotonic() - start
+    logging.info('Replayed %d frames in %.2fs, %.1f FPS, %d commands, videos in %s' %
+                 (camera.frames_read, elapsed, camera.frames_read / elapsed, len(fake_picar.command_log), data_dir))
+    return camera.frames_read, elapsed, list(fake_picar.command_log)
+
+
+def save_command_log(command_log, path):
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'command', 'value'])
+        writer.writerows(command_log)
+
+
+def lane_follower_class_by_name(name):
+    if name == 'hand_coded':
+        from hand_coded_lane_follower import HandCodedLaneFollower
+        return HandCodedLaneFollower
+    from end_to_end_lane_follower import EndToEndLaneFollower
+    return EndToEndLaneFollower
+
+
+############################
+# Test Functions
+############################
+def test_frame_budget_fallbacks():
+    """ Every degraded path of the hand coded follower runs, and a replay with a budget stays aligned """
+    import os
+    import shutil
+    import numpy as np
+    from frame_budget import FrameBudget
+    from hand_coded_lane_follower import HandCodedLaneFollower
+    from road_scene import RoadScene
+
+    tmp_dir = tempfile.mkdtemp(prefix='deep_pi_car_budget_')
+    try:
+        video_file = os.path.join(tmp_dir, 'synthetic.avi')
+        RoadScene(320, 240, seed=0).write_video(video_file, 40)
+        frames = [frame for frame, _ in RoadScene(320, 240, curvature=0.2, seed=0).stream(3)]
+
+        follower = HandCodedLaneFollower()
+        budget = FrameBudget(budget_ms=1000)
+        follower.frame_budget = budget
+
+        # full detection, overlays drawn
+        budget.start()
+        image = follower.follow_lane(frames[0])
+        assert image is not frames[0] and len(follower.lane_lines) == 2, follower.lane_lines
+        budget.end()
+
+        # the full detection does not fit: lane lines from the downscaled frame, the overlays do not fit either
+        budget.estimates_ms.update({'lane': 5000, 'lane_scaled': 1, 'draw': 5000})
+        budget.start()
+        image = follower.follow_lane(frames[1])
+        assert image is frames[1] and len(follower.lane_lines) == 2, follower.lane_lines
+        budget.end()
+
+        # nothing fits: the steering angle stays
+        angle = follower.curr_steering_angle
+        budget.estimates_ms.update({'lane': 5000, 'lane_scaled': 5000})
+        budget.start()
+        assert follower.follow_lane(frames[2]) is frames[2] and follower.curr_steering_angle == angle
+        budget.end()
+
+        stats = budget.stats()
+        assert stats['fallbacks'] == {'lane->scaled': 1, 'lane->last_angle': 1}, stats
+        assert stats['skips'] == {'draw': 1}, stats
+
+        # a replay over budget: every frame falls back, recording is skipped, and the telemetry says so
+        fake_picar.reset_command_log()
+        camera = ReplayCamera(video_file)
+        with DeepPiCar(picar_backend=fake_picar, camera=camera, lane_follower_class=HandCodedLaneFollower,
+                       actuator_rate_hz=None, data_dir=tmp_dir, frame_budget_ms=1.0) as car:
+            car.drive(40)
+            stats = car.frame_budget.stats()
+            records = car.telemetry.records()
+        assert stats['frames'] == camera.frames_read == len(records), (stats, camera.frames_read)
+        assert stats['fallbacks'].get('lane->last_angle', 0) > 0, stats
+        assert np.count_nonzero(records['recorded']) == stats['frames'] - stats['skips'].get('record', 0), stats
+        logging.info('frame budget replay: %s' % stats)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded video through the DeepPiCar drive loop')
+    parser.add_argument('video', help='recorded video, e.g. ../data/car_video190601_101010.avi')
+    parser.add_argument('--follower', choices=['end_to_end', 'hand_coded'], default='end_to_end')
+    parser.add_argument('--realtime', action='store_true', help='pace frames at the video frame rate')
+    parser.add_argument('--speed', type=int, default=40)
+    parser.add_argument('--actuator_rate', type=float, help='run the threaded actuator at this max rate (Hz)')
+    parser.add_argument('--control_rate', type=float, help='run the fixed-rate steering controller (Hz)')
+    parser.add_argument('--data_dir', help='where the drive loop records its videos, default is a temp dir')
+    parser.add_argument('--commands', help='save the actuator command log to this csv file')
+    parser.add_argument('--profile', help='save cProfile stats of the run to this file')
+    parser.add_argument('--memory', help='profile allocations and GC pauses, save the report to this json file')
+    parser.add_argument('--frame_budget', type=float, help='per-frame budget (ms), skip or degrade work to keep it')
+    parser.add_argument('--governor', action='store_true',
+                        help='lower the workload when the cpu is hot, throttled or the loop is slow')
+    args = parser.parse_args()
+
+    memory_profiler = None
+    if args.memory:
+        from alloc_profile import AllocationProfiler
+        memory_profiler = AllocationProfiler()
+    governor = None
+    if args.governor:
+        from quality_governor import QualityGovernor
+        governor = QualityGovernor()
+
+    def run():
+        return replay(args.video, lane_follower_class_by_name(args.follower), args.realtime, args.speed,
+                      args.actuator_rate, args.control_rate, args.data_dir, memory_profiler, args.frame_budget,
+                      governor)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        _, _, command_log = profiler.runcall(run)
+        profiler.dump_stats(args.profile)
+        logging.info('Saved profile to %s' % args.profile)
+    else:
+        _, _, command_log = run()
+
+    if args.commands:
+        save_command_log(command_log, args.commands)
+    if memory_profiler is not None:
+        memory_profiler.dump(args.memory)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
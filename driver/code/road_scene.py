@@ -0,0 +1,242 @@
+"""
+Synthetic road scenes: blue tape lane lines on a floor, with ground truth, for benchmarks and accuracy tests.
+
+The lane is described from the camera's point of view:
+    curvature -- sideways bend of the lane center at the far end, as a fraction of the frame width, + is right
+    offset    -- lane center at the bottom of the frame, as a fraction of the half width, + is right of the car
+and the frame is made harder with dashed tape, noise, lighting and clutter (objects that are not blue).
+
+render() returns (frame, truth).  truth holds the lane lines in the format of
+hand_coded_lane_follower.make_points, [[x1, y1, x2, y2]] from the bottom to the middle of the frame,
+and the ideal steering angle towards the lane center at the middle of the frame.
+
+A scene keeps its floor and noise buffers, so streaming frames costs about one frame copy, a few polylines
+and two saturating adds.
+
+Usage:
+# write a synthetic drive, with its ground truth next to it (.jsonl)
+python road_scene.py video ../data/synthetic_640x480.avi --size 640x480 --frames 400
+
+# accuracy of the hand coded lane follower on controlled scenes
+python road_scene.py accuracy --size 320x240
+"""
+import argparse
+import json
+import logging
+import math
+import cv2
+import numpy as np
+
+TAPE_COLOR = (200, 90, 10)  # BGR, blue painter's tape
+CLUTTER_COLORS = [(40, 70, 140), (0, 120, 240), (0, 0, 200), (220, 220, 220), (30, 30, 30)]  # none of them blue
+
+
+class RoadScene(object):
+
+    def __init__(self, width=320, height=240, curvature=0.0, offset=0.0, lane_width=0.8, tape_width=0.02,
+                 dash_length=0, noise=0, brightness=1.0, clutter=0, horizon=0.35, seed=None):
+        """
+        lane_width -- distance between the lane lines at the bottom of the frame, as a fraction of the width
+        tape_width -- as a fraction of the width
+        dash_length -- rows of the lane per dash, 0 for solid tape
+        noise -- standard deviation of the per pixel noise, in gray levels
+        brightness -- 1.0 is a normally lit floor
+        clutter -- number of random objects on the floor
+        horizon -- where the lane lines end, as a fraction of the height from the top
+        """
+        self.width = width
+        self.height = height
+        self.curvature = curvature
+        self.offset = offset
+        self.lane_width = lane_width
+        self.tape_px = max(2, int(tape_width * width))
+        self.dash_length = dash_length
+        self.noise = noise
+        self.brightness = brightness
+        self.clutter = clutter
+        self.horizon = int(horizon * height)
+        self.rng = np.random.RandomState(seed)
+
+        # floor: lit from the camera, brighter near the car
+        rows = np.linspace(0.75, 1.0, height, dtype=np.float32)[:, None, None]
+        floor = np.array([110, 115, 120], dtype=np.float32) * brightness * rows
+        self.floor = np.ascontiguousarray(np.broadcast_to(np.clip(floor, 0, 255), (height, width, 3))).astype(np.uint8)
+        self.noise_bank = None
+        self.frame_count = 0
+
+    ############################
+    # Geometry
+    ############################
+    def lane_center(self, y, curvature=None, offset=None):
+        curvature = self.curvature if curvature is None else curvature
+        offset = self.offset if offset is None else offset
+        t = (self.height - y) / float(self.height - self.horizon)  # 0 at the bottom, 1 at the horizon
+        return self.width / 2.0 * (1 + offset) + curvature * self.width * t * t
+
+    def lane_half_width(self, y):
+        t = (self.height - y) / float(self.height - self.horizon)
+        return self.lane_width * self.width / 2.0 * (1 - 0.7 * t)  # perspective, lines converge
+
+    def lane_points(self, curvature=None, offset=None, samples=32):
+        """ (left, right) polylines of the lane lines, int32 arrays of (x, y) from the bottom up """
+        ys = np.linspace(self.height, self.horizon, samples)
+        centers = self.lane_center(ys, curvature, offset)
+        half_widths = self.lane_half_width(ys)
+        left = np.stack([centers - half_widths, ys], axis=1).astype(np.int32)
+        right = np.stack([centers + half_widths, ys], axis=1).astype(np.int32)
+        return left, right
+
+    def truth(self, curvature=None, offset=None):
+        """ Ground truth lane lines (make_points format) and ideal steering angle """
+        ys = np.linspace(self.height, self.height / 2.0, 16)
+        centers = self.lane_center(ys, curvature, offset)
+        half_widths = self.lane_half_width(ys)
+        lane_lines = []
+        for xs in (centers - half_widths, centers + half_widths):
+            slope, intercept = np.polyfit(ys, xs, 1)  # x as a function of y, the lines are close to vertical
+            y1, y2 = self.height, int(self.height / 2)
+            lane_lines.append([[int(slope * y1 + intercept), y1, int(slope * y2 + intercept), y2]])
+        x_offset = self.lane_center(self.height / 2.0, curvature, offset) - self.width / 2.0
+        steering_angle = math.degrees(math.atan(x_offset / (self.height / 2.0))) + 90
+        return {'lane_lines': lane_lines, 'steering_angle': steering_angle}
+
+    ############################
+    # Rendering
+    ############################
+    def render(self, curvature=None, offset=None):
+        """ (frame, truth), curvature and offset default to the scene's """
+        frame = self.floor.copy()
+        self.draw_clutter(frame)
+        for line in self.lane_points(curvature, offset):
+            self.draw_tape(frame, line)
+        if self.noise:
+            self.add_noise(frame)
+        self.frame_count += 1
+        return frame, self.truth(curvature, offset)
+
+    def draw_tape(self, frame, line):
+        if self.dash_length <= 0:
+            cv2.polylines(frame, [line], False, TAPE_COLOR, self.tape_px)
+            return
+        # a dash and a gap of dash_length rows each
+        ys = line[:, 1]
+        dash = ((self.height - ys) // self.dash_length) % 2 == 0
+        for i in range(len(line) - 1):
+            if dash[i]:
+                cv2.line(frame, tuple(int(v) for v in line[i]), tuple(int(v) for v in line[i + 1]), TAPE_COLOR,
+                         self.tape_px)
+
+    def draw_clutter(self, frame):
+        for _ in range(self.clutter):
+            color = CLUTTER_COLORS[self.rng.randint(len(CLUTTER_COLORS))]
+            x, y = self.rng.randint(self.width), self.rng.randint(self.horizon, self.height)
+            size = self.rng.randint(3, max(4, self.width // 12))
+            if self.rng.rand() < 0.5:
+                cv2.rectangle(frame, (x, y), (x + size, y + size // 2), color, -1)
+            else:
+                cv2.circle(frame, (x, y), size // 2, color, -1)
+
+    def add_noise(self, frame, bank_size=4):
+        # |N(0, noise)| added and subtracted with saturation, from a few noise frames made once
+        if self.noise_bank is None:
+            self.noise_bank = []
+            for _ in range(bank_size):
+                noise = self.rng.normal(0, self.noise, frame.shape)
+                self.noise_bank.append((np.clip(noise, 0, 255).astype(np.uint8),
+                                        np.clip(-noise, 0, 255).astype(np.uint8)))
+        positive, negative = self.noise_bank[self.frame_count % len(self.noise_bank)]
+        cv2.add(frame, positive, dst=frame)
+        cv2.subtract(frame, negative, dst=frame)
+
+    ############################
+    # Streams
+    ############################
+    def stream(self, frames, max_curvature=0.3, max_offset=0.2, period=200):
+        """ Yields (frame, truth) of a drive through alternating curves, the car drifting across the lane """
+        for i in range(frames):
+            phase = 2 * math.pi * i / period
+            yield self.render(max_curvature * math.sin(phase), max_offset * math.sin(phase * 0.37))
+
+    def write_video(self, path, frames, fps=20.0, **stream_options):
+        """ Writes the stream as an XVID .avi, and its ground truth as JSON lines to <path without .avi>.jsonl """
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        video = cv2.VideoWriter(path, fourcc, fps, (self.width, self.height))
+        truth_path = path.rsplit('.', 1)[0] + '.jsonl'
+        try:
+            with open(truth_path, 'w') as f:
+                for i, (frame, truth) in enumerate(self.stream(frames, **stream_options)):
+                    video.write(frame)
+                    f.write(json.dumps(dict(truth, frame=i), separators=(',', ':')))
+                    f.write('\n')
+        finally:
+            video.release()
+        logging.info('Wrote %d frames to %s, ground truth to %s' % (frames, path, truth_path))
+        return truth_path
+
+
+############################
+# Test Functions
+############################
+def test_hand_coded_accuracy(width=320, height=240):
+    """ Steering angle error of the hand coded lane follower over a grid of scenes, per difficulty """
+    import hand_coded_lane_follower as hand_coded
+
+    difficulties = [
+        ('clean', {}),
+        ('dashed', {'dash_length': max(4, height // 16)}),
+        ('noisy', {'noise': 20, 'clutter': 10}),
+        ('dim', {'brightness': 0.5, 'noise': 10}),
+    ]
+    results = {}
+    for name, options in difficulties:
+        errors = []
+        misses = 0
+        for curvature in (-0.3, -0.15, 0.0, 0.15, 0.3):
+            for offset in (-0.2, 0.0, 0.2):
+                scene = RoadScene(width, height, curvature, offset, seed=0, **options)
+                frame, truth = scene.render()
+                lane_lines, _ = hand_coded.detect_lane(frame, draw_overlay=False)
+                if len(lane_lines) == 0:
+                    misses += 1
+                    continue
+                angle = hand_coded.compute_steering_angle(frame, lane_lines)
+                errors.append(abs(angle - truth['steering_angle']))
+        results[name] = (float(np.mean(errors)) if errors else float('nan'), max(errors) if errors else 0, misses)
+        logging.info('%-7s mean error %5.1f deg, max %5.1f deg, %d scenes without lane lines' %
+                     ((name,) + results[name]))
+    # on clean scenes the follower should be close to the ideal angle
+    assert results['clean'][0] < 5, results
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic road scenes')
+    subparsers = parser.add_subparsers(dest='command')
+    video = subparsers.add_parser('video', help='write a synthetic drive as .avi, with ground truth')
+    video.add_argument('path')
+    video.add_argument('--frames', type=int, default=400)
+    video.add_argument('--noise', type=float, default=0)
+    video.add_argument('--clutter', type=int, default=0)
+    video.add_argument('--dash_length', type=int, default=0)
+    video.add_argument('--brightness', type=float, default=1.0)
+    accuracy = subparsers.add_parser('accuracy', help='steering accuracy of the hand coded lane follower')
+    for subparser in (video, accuracy):
+        subparser.add_argument('--size', default='320x240', help='WIDTHxHEIGHT')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    width, height = (int(x) for x in args.size.split('x'))
+    if args.command == 'video':
+        scene = RoadScene(width, height, noise=args.noise, clutter=args.clutter, dash_length=args.dash_length,
+                          brightness=args.brightness, seed=0)
+        scene.write_video(args.path, args.frames)
+    else:
+        test_hand_coded_accuracy(width, height)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -1,7 +1,26 @@
+"""
+Label video frames with the steering angle of the hand coded lane follower.
+
+Usage:
+# one video, serially (the .avi extension is implied)
+python save_training_data.py ../data/tmp/video01
+
+# every .avi in a directory, across a process pool, resumable
+python save_training_data.py ../data/fleet/190601 --output_dir ../data/fleet/190601_labeled --processes 4
+"""
+import argparse
+import csv
 import cv2
+import glob
+import logging
+import multiprocessing
+import os
 import sys
+import time
 from hand_coded_lane_follower import HandCodedLaneFollower
 
+_STATE_DIR = '.relabel'  # per-chunk label files, a chunk is done once its file exists
+
 
 def save_image_and_steering_angle(video_file):
     lane_follower = HandCodedLaneFollower()
@@ -10,16 +29,214 @@ def save_image_and_steering_angle(video_file):
     try:
         i = 0
         while cap.isOpened():
-            _, frame = cap.read()
+            ret, frame = cap.read()
+            if not ret:
+                break
             lane_follower.follow_lane(frame)
             cv2.imwrite("%s_%03d_%03d.png" % (video_file, i, lane_follower.curr_steering_angle), frame)
             i += 1
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+    finally:
+        cap.release()
+
+
+def label_frame_range(task):
+    """
+    Worker: label frames [start, end) of one video.
+    The follower first runs over `warmup` frames before start, without saving them, so its
+    stabilized steering angle has settled close to where a serial run would have it.  It is not
+    guaranteed to be identical, see test_relabel_matches_serial().
+    """
+    video_file, start, end, warmup, output_dir = task
+    lane_follower = HandCodedLaneFollower()
+    lane_follower.draw_overlay = False
+    video_name = os.path.splitext(os.path.basename(video_file))[0]
+
+    first = max(0, start - warmup)
+    cap = open_video_at(video_file, first)
+    labels = []
+    try:
+        for i in range(first, end):
+            ret, frame = cap.read()
+            if not ret:
                 break
+            lane_follower.follow_lane(frame)
+            if i < start:
+                continue
+            filename = "%s_%03d_%03d.png" % (video_name, i, lane_follower.curr_steering_angle)
+            cv2.imwrite(os.path.join(output_dir, filename), frame)
+            labels.append((filename, video_name, i, lane_follower.curr_steering_angle))
     finally:
         cap.release()
-        cv2.destroyAllWindows()
+
+    # written in one go, and renamed into place, so a chunk is either fully labeled or not at all
+    state_path = chunk_state_path(output_dir, video_name, start)
+    with open(state_path + '.tmp', 'w') as f:
+        csv.writer(f).writerows(labels)
+    os.rename(state_path + '.tmp', state_path)
+    return end - start, len(labels)
+
+
+def relabel_directory(video_dir, output_dir=None, processes=None, chunk_size=500, warmup=60):
+    """ Label every .avi in video_dir across a process pool, skipping chunks labeled by an earlier run """
+    if output_dir is None:
+        output_dir = video_dir
+    os.makedirs(os.path.join(output_dir, _STATE_DIR), exist_ok=True)
+
+    tasks = []
+    skipped = 0
+    for video_file in sorted(glob.glob(os.path.join(video_dir, '*.avi'))):
+        video_name = os.path.splitext(os.path.basename(video_file))[0]
+        cap = cv2.VideoCapture(video_file)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        for start in range(0, frame_count, chunk_size):
+            if os.path.exists(chunk_state_path(output_dir, video_name, start)):
+                skipped += 1
+                continue
+            tasks.append((video_file, start, min(start + chunk_size, frame_count), warmup, output_dir))
+    total_frames = sum(end - start for _, start, end, _, _ in tasks)
+    logging.info('%d chunks (%d frames) to label, %d chunks already done' % (len(tasks), total_frames, skipped))
+
+    start_time = time.monotonic()
+    done_frames = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, (chunk_frames, labeled) in enumerate(pool.imap_unordered(label_frame_range, tasks)):
+            done_frames += chunk_frames
+            elapsed = time.monotonic() - start_time
+            print('\r%d/%d chunks, %d/%d frames, %.1f frames/s' %
+                  (i + 1, len(tasks), done_frames, total_frames, done_frames / elapsed), end='')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        print()
+
+    merge_labels(output_dir)
+
+
+############################
+# Utility Functions
+############################
+def open_video_at(video_file, frame):
+    """
+    A VideoCapture whose next read() returns frame `frame`.  Seeking an XVID video is not always
+    frame accurate, when the position after the seek is off, the frames are read from the start instead.
+    Some backends report the requested position even when the seek landed elsewhere, so this check only
+    catches some bad seeks; test_relabel_matches_serial() compares decoded frames with a sequential read.
+    """
+    cap = cv2.VideoCapture(video_file)
+    if frame == 0:
+        return cap
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    if position == frame:
+        return cap
+    logging.warning('Seeking %s to frame %d ended at frame %d, reading from the start' % (video_file, frame, position))
+    cap.release()
+    cap = cv2.VideoCapture(video_file)
+    for i in range(frame):
+        if not cap.grab():
+            raise IOError('%s ended at frame %d, before frame %d' % (video_file, i, frame))
+    return cap
+
+
+def chunk_state_path(output_dir, video_name, start):
+    return os.path.join(output_dir, _STATE_DIR, '%s_%06d.csv' % (video_name, start))
+
+
+def merge_labels(output_dir):
+    """ Combine the per-chunk label files into labels.csv, ordered by video and frame """
+    labels = []
+    for path in glob.glob(os.path.join(output_dir, _STATE_DIR, '*.csv')):
+        with open(path, 'r') as f:
+            labels.extend((row[0], row[1], int(row[2]), int(row[3])) for row in csv.reader(f))
+    labels.sort(key=lambda label: (label[1], label[2]))
+    with open(os.path.join(output_dir, 'labels.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'video', 'frame', 'steering_angle'])
+        writer.writerows(labels)
+    logging.info('Wrote %d labels to %s' % (len(labels), os.path.join(output_dir, 'labels.csv')))
+
+
+############################
+# Test Functions
+############################
+def test_relabel_matches_serial(frames=150, chunk_size=40, warmup=20, angle_tolerance=1):
+    """
+    The chunked, parallel labels are of the same frames as a serial run, and their steering angles are within
+    angle_tolerance degrees of the serial ones: the warm-up lets the stabilized angle settle, it does not
+    replay the whole history before the chunk.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+    from road_scene import RoadScene
+
+    video_dir = tempfile.mkdtemp(prefix='save_training_data_')
+    try:
+        video_file = os.path.join(video_dir, 'synthetic.avi')
+        RoadScene(320, 240, seed=0).write_video(video_file, frames)
+
+        # serial run, the reference
+        lane_follower = HandCodedLaneFollower()
+        lane_follower.draw_overlay = False
+        serial = []
+        cap = cv2.VideoCapture(video_file)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            lane_follower.follow_lane(frame)
+            serial.append((frame, lane_follower.curr_steering_angle))
+        cap.release()
+
+        # a seek lands on the frame a sequential read gets there, including frames between key frames
+        for position in (1, warmup, chunk_size - warmup, chunk_size, 2 * chunk_size + 7, len(serial) - 1):
+            cap = open_video_at(video_file, position)
+            ret, frame = cap.read()
+            cap.release()
+            assert ret and np.array_equal(frame, serial[position][0]), 'seek to frame %d is off' % position
+
+        output_dir = os.path.join(video_dir, 'labeled')
+        relabel_directory(video_dir, output_dir, processes=2, chunk_size=chunk_size, warmup=warmup)
+        with open(os.path.join(output_dir, 'labels.csv'), 'r') as f:
+            labels = list(csv.DictReader(f))
+        assert [int(label['frame']) for label in labels] == list(range(len(serial))), labels
+
+        # every chunk starts at the right frame: the saved .png is the decoded frame of the serial run
+        angle_differences = 0
+        for label in labels:
+            frame, angle = serial[int(label['frame'])]
+            saved = cv2.imread(os.path.join(output_dir, label['filename']))
+            assert np.array_equal(saved, frame), 'frame %s differs from the serial run' % label['frame']
+            difference = abs(int(label['steering_angle']) - angle)
+            assert difference <= angle_tolerance, \
+                'frame %s: steering angle %s, %d in the serial run' % (label['frame'], label['steering_angle'], angle)
+            if difference:
+                angle_differences += 1
+        logging.info('%d of %d steering angles differ from the serial run, by at most %d degrees' %
+                     (angle_differences, len(labels), angle_tolerance))
+    finally:
+        shutil.rmtree(video_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Label video frames with the hand coded steering angle')
+    parser.add_argument('video', help='video file without the .avi extension, or a directory of .avi files')
+    parser.add_argument('--output_dir', help='where labeled frames go, defaults to the video directory')
+    parser.add_argument('--processes', type=int, help='number of worker processes, defaults to cpu count')
+    parser.add_argument('--chunk_size', type=int, default=500, help='frames per worker task')
+    parser.add_argument('--warmup', type=int, default=60, help='frames to run before each chunk, to settle stabilization')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.video):
+        relabel_directory(args.video, args.output_dir, args.processes, args.chunk_size, args.warmup)
+    else:
+        save_image_and_steering_angle(args.video)
 
 
 if __name__ == '__main__':
-    save_image_and_steering_angle(sys.argv[1])
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+
+    main()
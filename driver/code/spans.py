@@ -0,0 +1,253 @@
+"""
+Per-stage latency spans, collected into fixed-bucket histograms.
+
+Stages are timed with time.perf_counter_ns() (perf_counter() in ns before Python 3.7), either as a block
+    with span('capture'):
+        ret, frame = camera.read()
+or as a whole function
+    @timed('detect_edges')
+    def detect_edges(frame):
+
+Collection is off by default.  While off, span() returns a shared no-op context manager and timed()
+functions call straight through after one flag check, so the instrumentation can stay in the hot path.
+
+Turn it on with enable(), or by setting DEEP_PI_CAR_SPANS before starting the car:
+    DEEP_PI_CAR_SPANS=1 python deep_pi_car.py                  # p50/p95/p99 per stage logged on exit
+    DEEP_PI_CAR_SPANS=/tmp/spans python deep_pi_car.py         # also dumps /tmp/spans.json and /tmp/spans.csv
+0, false, off, no or an empty value leave it off.
+
+Buckets are fixed, a quarter octave wide (each bound is 2^(1/4) times the previous) from 1us to 16s,
+so percentiles are accurate to about 19% and recording is a bisect and an increment.
+
+Listeners added with add_listener() are told when every span starts and ends, on the thread running it,
+with span_enter(stage) and span_exit(stage), e.g. alloc_profile.AllocationProfiler.
+"""
+import atexit
+import bisect
+import csv
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+# upper bounds of the histogram buckets, in ns; the last bucket catches everything above the last bound
+BUCKET_BOUNDS_NS = [int(1000 * 2 ** (i / 4.0)) for i in range(97)]
+
+try:
+    perf_counter_ns = time.perf_counter_ns
+except AttributeError:  # Python < 3.7, e.g. the 3.5 of Raspbian stretch
+    def perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_listeners = []
+_report_registered = False  # the atexit report, registered once however often enable() is called
+_dump_prefix = None
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def add(self, duration_ns):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_NS, duration_ns)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile (0-100), in ns, capped at the max seen """
+        if self.count == 0:
+            return 0
+        rank = p / 100.0 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                bound = BUCKET_BOUNDS_NS[i] if i < len(BUCKET_BOUNDS_NS) else self.max_ns
+                return min(bound, self.max_ns)
+        return self.max_ns
+
+    def summary(self):
+        """ Milliseconds """
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ns / self.count / 1e6 if self.count else 0.0,
+            'min_ms': (self.min_ns or 0) / 1e6,
+            'max_ms': self.max_ns / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p95_ms': self.percentile(95) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+        }
+
+
+class _Span(object):
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        for listener in _listeners:
+            listener.span_enter(self.stage)
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        record(self.stage, perf_counter_ns() - self.start)
+        for listener in _listeners:
+            listener.span_exit(self.stage)
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage):
+    """ Context manager timing its block as one sample of stage """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(stage)
+
+
+def timed(stage):
+    """ Decorator timing every call of the function as one sample of stage """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(stage, duration_ns):
+    """ Add one sample, safe to call from any thread """
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.add(duration_ns)
+
+
+############################
+# Control and export
+############################
+def enable(dump_prefix=None, report_at_exit=True):
+    """
+    Start collecting.  At exit, log the percentiles and, with dump_prefix, write <dump_prefix>.json and .csv.
+    Called again, the report is still written once, with the last dump_prefix given.
+    """
+    global _enabled, _report_registered, _dump_prefix
+    _enabled = True
+    if dump_prefix:
+        _dump_prefix = dump_prefix
+    if report_at_exit and not _report_registered:
+        atexit.register(_report_at_exit)
+        _report_registered = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_listener(listener):
+    """ listener.span_enter(stage) and listener.span_exit(stage) are called around every span while enabled """
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def summaries():
+    """ {stage: Histogram.summary()} """
+    with _lock:
+        return dict((stage, histogram.summary()) for stage, histogram in _histograms.items())
+
+
+def report():
+    lines = ['%-24s %8s %9s %9s %9s %9s' % ('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+    for stage, summary in sorted(summaries().items()):
+        lines.append('%-24s %8d %9.3f %9.3f %9.3f %9.3f' % (
+            stage, summary['count'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['max_ms']))
+    return '\n'.join(lines)
+
+
+def dump_json(path):
+    """ Summary and non-empty buckets (keyed by upper bound in us, 'inf' for the overflow bucket) per stage """
+    with _lock:
+        stages = {}
+        for stage, histogram in _histograms.items():
+            buckets = {}
+            for i, count in enumerate(histogram.counts):
+                if count:
+                    bound = '%.3f' % (BUCKET_BOUNDS_NS[i] / 1e3) if i < len(BUCKET_BOUNDS_NS) else 'inf'
+                    buckets[bound] = count
+            stages[stage] = dict(histogram.summary(), buckets_us=buckets)
+    with open(path, 'w') as f:
+        json.dump(stages, f, indent=2, sort_keys=True)
+
+
+def dump_csv(path):
+    """ One row per stage and bucket: stage, bucket upper bound in us (empty for overflow), count """
+    with _lock:
+        rows = []
+        for stage in sorted(_histograms):
+            for i, count in enumerate(_histograms[stage].counts):
+                bound = '%.3f' % (BUCKET_BOUNDS_NS[i] / 1e3) if i < len(BUCKET_BOUNDS_NS) else ''
+                rows.append([stage, bound, count])
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stage', 'le_us', 'count'])
+        writer.writerows(rows)
+
+
+def _report_at_exit():
+    dump_prefix = _dump_prefix
+    if not _histograms:
+        return
+    logging.info('Stage latencies:\n%s' % report())
+    if dump_prefix:
+        dump_json(dump_prefix + '.json')
+        dump_csv(dump_prefix + '.csv')
+        logging.info('Wrote stage latency histograms to %s.json and %s.csv' % (dump_prefix, dump_prefix))
+
+
+_env = os.environ.get('DEEP_PI_CAR_SPANS', '').strip()
+if _env.lower() not in ('', '0', 'false', 'off', 'no'):
+    enable(None if _env.lower() in ('1', 'true', 'on', 'yes') else _env)
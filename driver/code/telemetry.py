@@ -0,0 +1,151 @@
+"""
+Per-frame telemetry in a preallocated ring buffer, for debugging a lap after the fact.
+
+Recording a frame is one structured-array row assignment, no allocation and no string formatting,
+so it is cheap enough to leave on while driving.  Once the buffer is full the oldest frames are
+overwritten.  dump() writes the frames in order as a .npy file, which carries its own dtype.
+
+Frames can be left out of the videos (frame budget, quality governor), the recorded field says which
+were written: records[records['recorded'] == 1] are the video frames, in order.
+
+Usage:
+python telemetry.py summary ../data/car_telemetry190601_120000.npy
+python telemetry.py plot ../data/car_telemetry190601_120000.npy --output lap.png
+"""
+import argparse
+import logging
+import numpy as np
+
+TELEMETRY_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # time.time() of the capture
+    ('frame_id', 'i4'),
+    ('proposed_angle', 'i2'),  # steering angle computed from this frame
+    ('steering_angle', 'i2'),  # after stabilization, what the wheels are told
+    ('lane_lines', 'i1'),
+    ('line_segments', 'i2'),  # -1 when the lane follower does not detect segments
+    ('detections', 'i1'),
+    ('speed', 'i2'),
+    ('capture_ms', 'f4'),
+    ('lane_ms', 'f4'),
+    ('objects_ms', 'f4'),
+    ('record_ms', 'f4'),
+    ('frame_ms', 'f4'),  # the whole frame, capture to the next capture
+    ('recorded', 'i1'),  # 1 if the frame was written to the videos
+])
+
+
+class TelemetryRing(object):
+
+    def __init__(self, capacity=36000):
+        """ capacity -- frames kept, the default is 30 minutes at 20 fps, about 1.5MB """
+        self.buffer = np.zeros(capacity, dtype=TELEMETRY_DTYPE)
+        self.capacity = capacity
+        self.next = 0  # slot of the next record
+        self.count = 0  # frames recorded, including overwritten ones
+
+    def record(self, timestamp, frame_id, proposed_angle, steering_angle, lane_lines, line_segments, detections,
+               speed, capture_ms, lane_ms, objects_ms, record_ms, frame_ms, recorded=True):
+        self.buffer[self.next] = (timestamp, frame_id, proposed_angle, steering_angle, lane_lines, line_segments,
+                                  detections, speed, capture_ms, lane_ms, objects_ms, record_ms, frame_ms, recorded)
+        self.next = (self.next + 1) % self.capacity
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def records(self):
+        """ Copy of the recorded frames, oldest first """
+        if self.count < self.capacity:
+            return self.buffer[:self.count].copy()
+        return np.concatenate((self.buffer[self.next:], self.buffer[:self.next]))
+
+    def dump(self, path):
+        records = self.records()
+        np.save(path, records)
+        logging.info('Dumped %d frames of telemetry to %s' % (len(records), path))
+        return path
+
+
+############################
+# Offline analysis
+############################
+def load(path):
+    """ Telemetry records dumped by TelemetryRing.dump() """
+    records = np.load(path)
+    if records.dtype != TELEMETRY_DTYPE:
+        raise ValueError('%s is not a telemetry dump, dtype %s' % (path, records.dtype))
+    return records
+
+
+def summary(records):
+    if len(records) == 0:
+        return 'no frames'
+    duration = records['timestamp'][-1] - records['timestamp'][0]
+    no_lanes = np.count_nonzero(records['lane_lines'] == 0)
+    frame_ms = records['frame_ms']
+    return ('%d frames (%d - %d) over %.1fs, %.1f fps, frame p50 %.1fms p99 %.1fms max %.1fms, '
+            '%d frames without lane lines, %d recorded, steering %d - %d' % (
+                len(records), records['frame_id'][0], records['frame_id'][-1], duration,
+                len(records) / duration if duration > 0 else 0.0,
+                np.percentile(frame_ms, 50), np.percentile(frame_ms, 99), frame_ms.max(),
+                no_lanes, np.count_nonzero(records['recorded']), records['steering_angle'].min(), records['steering_angle'].max()))
+
+
+def plot(records, output_path=None):
+    """ Steering, lane detection and stage latencies over time, shown or saved to output_path """
+    import matplotlib
+    if output_path:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    t = records['timestamp'] - records['timestamp'][0]
+    figure, (steering, lanes, latencies) = plt.subplots(3, 1, sharex=True, figsize=(12, 9))
+
+    steering.plot(t, records['proposed_angle'], '.', markersize=2, label='proposed')
+    steering.plot(t, records['steering_angle'], label='stabilized')
+    steering.set_ylabel('steering angle')
+    steering.legend(loc='upper right')
+
+    lanes.plot(t, records['lane_lines'], label='lane lines')
+    lanes.plot(t, records['detections'], label='detections')
+    segments = lanes.twinx()
+    segments.plot(t, records['line_segments'], color='gray', alpha=0.5, label='line segments')
+    segments.set_ylabel('line segments')
+    lanes.legend(loc='upper right')
+
+    for stage in ('capture_ms', 'lane_ms', 'objects_ms', 'record_ms', 'frame_ms'):
+        latencies.plot(t, records[stage], label=stage[:-3])
+    latencies.set_ylabel('ms')
+    latencies.set_xlabel('seconds')
+    latencies.legend(loc='upper right')
+
+    figure.tight_layout()
+    if output_path:
+        figure.savefig(output_path)
+        logging.info('Saved the plot to %s' % output_path)
+    else:
+        plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telemetry dump tools')
+    subparsers = parser.add_subparsers(dest='command')
+    summary_parser = subparsers.add_parser('summary', help='summarize a telemetry dump')
+    summary_parser.add_argument('path')
+    plot_parser = subparsers.add_parser('plot', help='plot a telemetry dump')
+    plot_parser.add_argument('path')
+    plot_parser.add_argument('--output', help='save the plot to this image instead of showing it')
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        print(summary(load(args.path)))
+    elif args.command == 'plot':
+        plot(load(args.path), args.output)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
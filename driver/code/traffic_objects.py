@@ -41,7 +41,7 @@ class SpeedLimit(TrafficObject):
         self.speed_limit = speed_limit
 
     def set_car_state(self, car_state):
-        logging.debug('speed limit: set limit to %d' % self.speed_limit)
+        logging.debug('speed limit: set limit to %d', self.speed_limit)
         car_state['speed_limit'] = self.speed_limit
 
 
@@ -78,7 +78,7 @@ class StopSign(TrafficObject):
             return
 
     def wait_done(self):
-        logging.debug('stop sign: 3) finished waiting for %d seconds' % self.wait_time_in_sec)
+        logging.debug('stop sign: 3) finished waiting for %d seconds', self.wait_time_in_sec)
         self.in_wait_mode = False
 
     def clear(self):
@@ -0,0 +1,322 @@
+"""
+Train the end to end lane navigation model (lane_navigation.h5) from labeled frames.
+
+Frames come either from a directory of labeled PNGs, <video>_<frame>_<angle>.png as written by
+save_training_data.py and the manual driver, or from a driving log (see driver/code/driving_log.py).
+
+The batch generator streams: a thread pool reads and preprocesses frames, augmentation
+(flip with angle mirroring, brightness, pan, zoom) runs vectorized over the whole batch, the
+steering angle histogram is balanced by sampling, and a background thread keeps a few batches
+ready ahead of the trainer.
+
+Usage:
+# measure the data pipeline alone, in samples per second
+python train_lane_navigation.py --benchmark ../data/images
+
+# the same on synthetic road frames, no recorded data needed
+python train_lane_navigation.py --benchmark
+
+# train
+python train_lane_navigation.py ../data/images --epochs 10
+"""
+import argparse
+import glob
+import logging
+import numpy as np
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../driver/code'))
+from driving_log import DrivingLogReader, parse_png_name
+from end_to_end_lane_follower import img_preprocess  # the exact preprocessing the car runs at inference time
+
+_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/model_result/lane_navigation.h5')
+
+
+class BatchGenerator(object):
+    """
+    Endless iterator of (X, y) batches, X preprocessed for the Nvidia model, y steering angles.
+
+    frame_source is a list of PNG paths, or a DrivingLogReader, and angles their steering angles.
+    Batches are drawn from the frames at `indices` only (default all), e.g. the training split.
+    An error in the prefetch thread, e.g. an unreadable PNG, is raised by the next call to next().
+    """
+
+    def __init__(self, frame_source, angles, indices=None, batch_size=100, augment=True, balance=True,
+                 workers=4, prefetch=4, seed=None):
+        self.frame_source = frame_source
+        self.angles = np.asarray(angles, dtype=np.float32)
+        self.indices = np.arange(len(self.angles)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.augment = augment
+        self.rng = np.random.RandomState(seed)
+        self.weights = balanced_sample_weights(self.angles[self.indices]) if balance else None
+        self.pool = ThreadPool(workers)
+
+        self.batches = queue.Queue(maxsize=prefetch)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='batch_prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            self.batches.put(batch)  # the prefetch thread is gone, raise again on every later call
+            raise batch
+        return batch
+
+    next = __next__  # keras' fit_generator calls next()
+
+    def run(self):
+        try:
+            while self.running:
+                self.batches.put(self.make_batch())
+        except Exception as e:
+            logging.exception('Batch prefetch failed')
+            self.batches.put(e)
+
+    def make_batch(self):
+        indices = self.indices[self.rng.choice(len(self.indices), self.batch_size, p=self.weights)]
+        images = self.load(indices)
+        angles = self.angles[indices].copy()
+        if self.augment:
+            images, angles = augment_batch(images, angles, self.rng)
+        X = np.asarray(self.pool.map(img_preprocess, images), dtype=np.float32)
+        return X, angles
+
+    def load(self, indices):
+        if isinstance(self.frame_source, DrivingLogReader):
+            return self.frame_source.frames(indices)
+        paths = [self.frame_source[i] for i in indices]
+        images = self.pool.map(cv2.imread, paths)
+        unreadable = [path for path, image in zip(paths, images) if image is None]
+        if unreadable:
+            raise IOError('Can not read %d frame(s): %s' % (len(unreadable), ', '.join(sorted(set(unreadable)))))
+        return np.asarray(images)
+
+    def close(self):
+        """ Stop the prefetch thread, then the pool it uses """
+        self.running = False
+        while self.thread.is_alive():
+            try:
+                self.batches.get(timeout=0.1)  # unblock the prefetch thread, it may be putting a batch
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+
+
+############################
+# Augmentation, vectorized per batch
+############################
+def augment_batch(images, angles, rng, max_pan=0.1, max_zoom=1.3, max_brightness=0.3):
+    n, height, width, _ = images.shape
+
+    # random flip, 50% of the images, mirrored steering angle
+    flip = rng.rand(n) < 0.5
+    images[flip] = images[flip, :, ::-1]
+    angles[flip] = 180 - angles[flip]
+
+    # random pan and zoom, as one nearest-neighbor gather for the whole batch
+    zoom = rng.uniform(1, max_zoom, n)[:, None, None]
+    pan_x = rng.uniform(-max_pan, max_pan, n)[:, None, None] * width
+    pan_y = rng.uniform(-max_pan, max_pan, n)[:, None, None] * height
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    src_x = np.clip((xs - width / 2) / zoom + width / 2 - pan_x, 0, width - 1).astype(np.int32)
+    src_y = np.clip((ys - height / 2) / zoom + height / 2 - pan_y, 0, height - 1).astype(np.int32)
+    images = images[np.arange(n)[:, None, None], src_y, src_x]
+
+    # random brightness
+    brightness = rng.uniform(1 - max_brightness, 1 + max_brightness, n).astype(np.float32)
+    images = np.clip(images * brightness[:, None, None, None], 0, 255).astype(np.uint8)
+
+    return images, angles
+
+
+def balanced_sample_weights(angles, bins=25):
+    """ Sampling probabilities that flatten the steering angle histogram """
+    counts, edges = np.histogram(angles, bins=bins, range=(0, 180))
+    bin_index = np.clip(np.digitize(angles, edges) - 1, 0, bins - 1)
+    weights = 1.0 / counts[bin_index]
+    return weights / weights.sum()
+
+
+############################
+# Model and training
+############################
+def nvidia_model():
+    from keras.models import Sequential
+    from keras.layers import Conv2D, Dense, Dropout, Flatten
+    from keras.optimizers import Adam
+
+    model = Sequential(name='Nvidia_Model')
+    # elu = Expenential Linear Unit, similar to leaky Relu
+    model.add(Conv2D(24, (5, 5), strides=(2, 2), input_shape=(66, 200, 3), activation='elu'))
+    model.add(Conv2D(36, (5, 5), strides=(2, 2), activation='elu'))
+    model.add(Conv2D(48, (5, 5), strides=(2, 2), activation='elu'))
+    model.add(Conv2D(64, (3, 3), activation='elu'))
+    model.add(Dropout(0.2))
+    model.add(Conv2D(64, (3, 3), activation='elu'))
+    model.add(Flatten())
+    model.add(Dropout(0.2))
+    model.add(Dense(100, activation='elu'))
+    model.add(Dense(50, activation='elu'))
+    model.add(Dense(10, activation='elu'))
+    model.add(Dense(1))  # output is the steering angle
+    model.compile(loss='mse', optimizer=Adam(lr=1e-3))
+    return model
+
+
+def load_frames(data):
+    """ (frame source, steering angles) of a PNG directory or a driving log directory """
+    if os.path.exists(os.path.join(data, 'meta.json')):
+        reader = DrivingLogReader(data)
+        return reader, reader.index['steering_angle']
+    paths = []
+    angles = []
+    for path in sorted(glob.glob(os.path.join(data, '*.png'))):
+        try:
+            _, _, angle = parse_png_name(path)
+        except ValueError:
+            continue
+        paths.append(path)
+        angles.append(angle)
+    return paths, angles
+
+
+def split_train_valid(num_frames, valid_fraction=0.2, seed=0):
+    """ (train indices, validation indices) """
+    indices = np.random.RandomState(seed).permutation(num_frames)
+    n_valid = int(num_frames * valid_fraction)
+    return indices[n_valid:], indices[:n_valid]
+
+
+def train(data, epochs=10, steps_per_epoch=300, batch_size=100, model_path=_MODEL_PATH, workers=4):
+    from keras.callbacks import ModelCheckpoint
+
+    frame_source, angles = load_frames(data)
+    logging.info('Training on %d frames from %s' % (len(angles), data))
+    train_indices, valid_indices = split_train_valid(len(angles))
+
+    train_batches = BatchGenerator(frame_source, angles, train_indices, batch_size, augment=True, balance=True,
+                                   workers=workers)
+    valid_batches = BatchGenerator(frame_source, angles, valid_indices, batch_size, augment=False, balance=False,
+                                   workers=workers)
+    model = nvidia_model()
+    checkpoint = ModelCheckpoint(model_path, verbose=1, save_best_only=True)
+    try:
+        model.fit_generator(train_batches, steps_per_epoch=steps_per_epoch, epochs=epochs,
+                            validation_data=valid_batches, validation_steps=max(1, steps_per_epoch // 5),
+                            callbacks=[checkpoint], verbose=1)
+    finally:
+        train_batches.close()
+        valid_batches.close()
+    logging.info('Saved the best model to %s' % model_path)
+
+
+############################
+# Test Functions
+############################
+def test_augment_batch():
+    """ Without pan, zoom and brightness changes, a frame is either unchanged, or mirrored with 180 - angle """
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (50, 24, 32, 3)).astype(np.uint8)
+    angles = rng.randint(45, 135, 50).astype(np.float32)
+    augmented, augmented_angles = augment_batch(images.copy(), angles.copy(), np.random.RandomState(1),
+                                                max_pan=0, max_zoom=1, max_brightness=0)
+    flipped = 0
+    for image, angle, augmented_image, augmented_angle in zip(images, angles, augmented, augmented_angles):
+        if np.array_equal(augmented_image, image) and augmented_angle == angle:
+            continue
+        assert np.array_equal(augmented_image, image[:, ::-1]), 'neither the frame nor its mirror image'
+        assert augmented_angle == 180 - angle, (angle, augmented_angle)
+        flipped += 1
+    assert 10 < flipped < 40, flipped  # about half
+
+
+def test_balanced_sample_weights(bins=25):
+    """ Sampled with the weights, every steering angle bin that has frames is equally likely """
+    angles = np.concatenate([np.full(900, 90), np.full(100, 45), np.full(10, 135), np.arange(60, 70)])
+    weights = balanced_sample_weights(angles, bins)
+    assert abs(weights.sum() - 1) < 1e-9, weights.sum()
+    histogram, _ = np.histogram(angles, bins=bins, range=(0, 180), weights=weights)
+    filled = histogram[histogram > 0]
+    assert np.allclose(filled, 1.0 / len(filled)), histogram
+
+
+def write_synthetic_log(log_dir, frames=1000):
+    """ A driving log of synthetic road frames (see driver/code/road_scene.py), labeled with the ideal angle """
+    from driving_log import DrivingLogWriter
+    from road_scene import RoadScene
+
+    scene = RoadScene(320, 240, noise=10, clutter=5, seed=0)
+    with DrivingLogWriter(log_dir, (240, 320, 3)) as writer:
+        for frame, truth in scene.stream(frames):
+            writer.append(frame, int(round(truth['steering_angle'])), source='synthetic')
+
+
+def benchmark_pipeline(data=None, batches=50, batch_size=100, workers=4):
+    """ Samples per second of the data pipeline alone, no model, on synthetic frames without data """
+    import shutil
+    import tempfile
+
+    synthetic_dir = None
+    if data is None:
+        synthetic_dir = tempfile.mkdtemp(prefix='lane_navigation_benchmark_')
+        write_synthetic_log(synthetic_dir)
+        data = synthetic_dir
+    try:
+        frame_source, angles = load_frames(data)
+        generator = BatchGenerator(frame_source, angles, batch_size=batch_size, augment=True, balance=True,
+                                   workers=workers)
+        try:
+            next(generator)  # warm up the pool and the prefetch queue
+            start = time.monotonic()
+            for _ in range(batches):
+                next(generator)
+            elapsed = time.monotonic() - start
+        finally:
+            generator.close()
+    finally:
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir)
+    print('data pipeline: %d batches of %d in %.2fs, %.0f samples/s (%d workers)' %
+          (batches, batch_size, elapsed, batches * batch_size / elapsed, workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the lane navigation model')
+    parser.add_argument('data', nargs='?',
+                        help='directory of labeled PNGs, or a driving log directory, optional with --benchmark')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--steps_per_epoch', type=int, default=300)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--model_path', default=_MODEL_PATH)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='only measure the data pipeline throughput, on synthetic frames without data')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_pipeline(args.data, batch_size=args.batch_size, workers=args.workers)
+    elif args.data is None:
+        parser.error('the training data directory is required')
+    else:
+        train(args.data, args.epochs, args.steps_per_epoch, args.batch_size, args.model_path, args.workers)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    main()
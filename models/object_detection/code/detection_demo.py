@@ -0,0 +1,293 @@
+"""
+Run an Edge TPU object detection model on a camera or a video, and show the detections.
+
+Capture, inference and drawing run on their own threads and hand frame buffers to each other,
+so the camera is read while the previous frame is in the TPU and the one before is being drawn.
+Every stage is timed on its own: capture, preprocess (BGR to RGB to PIL), inference and draw,
+so the inference FPS is not diluted by drawing and display.
+
+Usage:
+# road signs, from the first camera
+python3 code/detection_demo.py --model data/model_result/road_signs_quantized.tflite --labels data/model_result/road_sign_labels.txt
+
+# COCO objects, from a video, without a window, saving the annotated video
+python3 code/detection_demo.py --model data/model_result/mobilenet_ssd_v2_coco_quant_postprocess_edgetpu.tflite \
+    --labels data/model_result/coco_labels.txt --source ../../driver/data/car_video.avi --no_display --output output.avi
+"""
+import argparse
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+
+import cv2
+import numpy as np
+from PIL import Image
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/model_result')
+ROAD_SIGNS_MODEL = os.path.join(_DATA_DIR, 'road_signs_quantized.tflite')
+ROAD_SIGNS_LABELS = os.path.join(_DATA_DIR, 'road_sign_labels.txt')
+COCO_MODEL = os.path.join(_DATA_DIR, 'mobilenet_ssd_v2_coco_quant_postprocess_edgetpu.tflite')
+COCO_LABELS = os.path.join(_DATA_DIR, 'coco_labels.txt')
+
+STAGES = ['capture', 'preprocess', 'inference', 'draw']
+
+
+class StageTimer(object):
+    """ Per stage count, total and max time, updated from several threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = dict((stage, 0) for stage in STAGES)
+        self.total = dict((stage, 0.0) for stage in STAGES)
+        self.max = dict((stage, 0.0) for stage in STAGES)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.count[stage] += 1
+            self.total[stage] += seconds
+            self.max[stage] = max(self.max[stage], seconds)
+
+    def report(self):
+        with self.lock:
+            parts = []
+            for stage in STAGES:
+                mean = self.total[stage] / self.count[stage] if self.count[stage] else 0.0
+                parts.append('%s %.2fms (max %.2fms)' % (stage, mean * 1000, self.max[stage] * 1000))
+            return ', '.join(parts)
+
+
+class DetectionPipeline(object):
+    """
+    capture thread -> inference thread -> draw (caller's thread, since cv2.imshow must run there)
+
+    Frames live in a small pool of preallocated buffers that travel through the stages and come back
+    free once drawn; with 2 buffers capture and inference are double-buffered, the default 3 lets all
+    three stages work at once.  A live camera never waits for a free buffer: if the pipeline is behind,
+    the frame is read into a scratch buffer and dropped, so detections stay on fresh frames.
+    A video file waits instead, so every frame is processed.
+    """
+
+    def __init__(self, engine, labels, camera, is_live, frame_shape, min_confidence=0.20, top_k=5,
+                 num_buffers=3, output_path=None, display=True, fps=20.0):
+        self.engine = engine
+        self.labels = labels
+        self.camera = camera
+        self.is_live = is_live
+        self.min_confidence = min_confidence
+        self.top_k = top_k
+        self.display = display
+        self.timer = StageTimer()
+
+        self.free = queue.Queue()
+        for _ in range(num_buffers):
+            self.free.put(np.empty(frame_shape, dtype=np.uint8))
+        self.scratch = np.empty(frame_shape, dtype=np.uint8)
+        self.captured = queue.Queue()
+        self.detected = queue.Queue()
+        self.running = True
+        self.frames = 0
+        self.dropped = 0
+
+        self.out = None
+        if output_path:
+            fourcc = cv2.VideoWriter_fourcc(*'XVID')
+            self.out = cv2.VideoWriter(output_path, fourcc, fps, (frame_shape[1], frame_shape[0]))
+
+        self.font = cv2.FONT_HERSHEY_SIMPLEX
+        self.font_scale = 1
+        self.font_color = (255, 255, 255)  # white
+        self.box_color = (0, 0, 255)  # red
+        self.box_line_width = 1
+        self.line_type = 2
+
+    def run(self, first_frame=None):
+        """
+        Runs until the source ends, 'q' is pressed or stop() is called, returns the number of frames drawn.
+        first_frame -- a frame already read from the camera, e.g. for its shape, it is processed first
+        """
+        if first_frame is not None:
+            frame = self.free.get()
+            frame[:] = first_frame
+            self.captured.put((frame, time.perf_counter()))
+        threads = [threading.Thread(target=self.capture_loop, name='capture'),
+                   threading.Thread(target=self.inference_loop, name='inference')]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        start = time.perf_counter()
+        last_report = start
+        try:
+            while True:
+                item = self.detected.get()
+                if item is None:
+                    break
+                frame, results, capture_time = item
+                draw_start = time.perf_counter()
+                self.draw(frame, results)
+                quit_pressed = self.show(frame)
+                self.timer.add('draw', time.perf_counter() - draw_start)
+                self.free.put(frame)
+                self.frames += 1
+
+                now = time.perf_counter()
+                if now - last_report >= 1.0:
+                    logging.info('%s: %.1f FPS, %.0fms capture to drawn, %s' % (
+                        datetime.datetime.now(), self.frames / (now - start), (now - capture_time) * 1000,
+                        self.timer.report()))
+                    last_report = now
+                if quit_pressed:
+                    break
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join(timeout=1.0)
+        elapsed = time.perf_counter() - start
+        logging.info('%d frames in %.1fs, %.1f FPS, %d dropped, %s' % (
+            self.frames, elapsed, self.frames / elapsed if elapsed else 0.0, self.dropped, self.timer.report()))
+        return self.frames
+
+    def stop(self):
+        self.running = False
+        # wake up stages blocked on an empty hand-off queue
+        self.free.put(self.scratch)
+        self.captured.put(None)
+
+    def capture_loop(self):
+        try:
+            while self.running:
+                try:
+                    frame = self.free.get(block=not self.is_live)
+                except queue.Empty:
+                    frame = None
+                start = time.perf_counter()
+                if frame is None:
+                    ret, self.scratch = self.camera.read(self.scratch)
+                else:
+                    ret, frame = self.camera.read(frame)  # reads into the buffer, no allocation
+                self.timer.add('capture', time.perf_counter() - start)
+                if not ret:
+                    logging.info('End of source')
+                    break
+                if frame is None:
+                    self.dropped += 1
+                    continue
+                self.captured.put((frame, time.perf_counter()))
+        finally:
+            self.captured.put(None)
+
+    def inference_loop(self):
+        try:
+            while self.running:
+                item = self.captured.get()
+                if item is None:
+                    break
+                frame, capture_time = item
+                start = time.perf_counter()
+                image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                inference_start = time.perf_counter()
+                self.timer.add('preprocess', inference_start - start)
+                try:
+                    results = self.engine.DetectWithImage(image, threshold=self.min_confidence,
+                                                          keep_aspect_ratio=True, relative_coord=False,
+                                                          top_k=self.top_k)
+                except Exception:
+                    # a bad frame should not end the demo
+                    logging.error('Detection failed:\n%s' % traceback.format_exc())
+                    results = []
+                self.timer.add('inference', time.perf_counter() - inference_start)
+                self.detected.put((frame, results, capture_time))
+        finally:
+            self.detected.put(None)
+
+    def draw(self, frame, results):
+        for obj in results:
+            label = self.labels.get(obj.label_id, str(obj.label_id))
+            logging.debug('%s, %.0f%% %s' % (label, obj.score * 100, obj.bounding_box))
+            box = obj.bounding_box
+            coord_top_left = (int(box[0][0]), int(box[0][1]))
+            coord_bottom_right = (int(box[1][0]), int(box[1][1]))
+            cv2.rectangle(frame, coord_top_left, coord_bottom_right, self.box_color, self.box_line_width)
+            annotate_text = '%s, %.0f%%' % (label, obj.score * 100)
+            coord_top_left = (coord_top_left[0], coord_top_left[1] + 15)
+            cv2.putText(frame, annotate_text, coord_top_left, self.font, self.font_scale, self.box_color,
+                        self.line_type)
+
+    def show(self, frame):
+        """ Writes and displays the annotated frame, returns True if 'q' was pressed """
+        if self.out is not None:
+            self.out.write(frame)
+        if not self.display:
+            return False
+        cv2.imshow('Detected Objects', frame)
+        return cv2.waitKey(1) & 0xFF == ord('q')
+
+    def close(self):
+        if self.out is not None:
+            self.out.release()
+        if self.display:
+            cv2.destroyAllWindows()
+
+
+############################
+# Utility Functions
+############################
+def load_labels(path):
+    with open(path, 'r') as f:
+        pairs = (l.strip().split(maxsplit=1) for l in f.readlines() if l.strip())
+        return dict((int(k), v) for k, v in pairs)
+
+
+def open_source(source, width, height):
+    """ (cv2.VideoCapture, is_live) of a camera index or a video file """
+    if source.isdigit():
+        camera = cv2.VideoCapture(int(source))
+        camera.set(3, width)
+        camera.set(4, height)
+        return camera, True
+    return cv2.VideoCapture(source), False
+
+
+def main(default_model=ROAD_SIGNS_MODEL, default_labels=ROAD_SIGNS_LABELS):
+    parser = argparse.ArgumentParser(description='Edge TPU object detection demo')
+    parser.add_argument('--model', default=default_model, help='File path of the Edge TPU tflite model')
+    parser.add_argument('--labels', '--label', default=default_labels, help='File path of the label file')
+    parser.add_argument('--source', default='0', help='camera index, or a video file')
+    parser.add_argument('--width', type=int, default=640, help='camera frame width')
+    parser.add_argument('--height', type=int, default=480, help='camera frame height')
+    parser.add_argument('--min_confidence', type=float, default=0.20)
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--buffers', type=int, default=3, help='frame buffers in flight, at least 2')
+    parser.add_argument('--output', help='write the annotated video here')
+    parser.add_argument('--no_display', action='store_true', help='do not open a window')
+    args = parser.parse_args()
+
+    import edgetpu.detection.engine  # only needed on the Pi, keep --help working elsewhere
+    labels = load_labels(args.labels)
+    engine = edgetpu.detection.engine.DetectionEngine(args.model)
+
+    camera, is_live = open_source(args.source, args.width, args.height)
+    ret, first_frame = camera.read()
+    if not ret:
+        logging.error('Can not read from %s' % args.source)
+        camera.release()
+        return
+    pipeline = DetectionPipeline(engine, labels, camera, is_live, first_frame.shape, args.min_confidence,
+                                 args.top_k, max(2, args.buffers), args.output, not args.no_display)
+    try:
+        pipeline.run(first_frame)  # the frame read for the buffer shape is the first one processed
+    except KeyboardInterrupt:
+        logging.info('Interrupted')
+    finally:
+        camera.release()
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-5s:%(asctime)s: %(message)s')
+
+    main()
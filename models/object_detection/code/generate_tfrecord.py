@@ -6,6 +6,11 @@ python generate_tfrecord.py --label=<LABEL> --csv_input=<PATH_TO_ANNOTATIONS_FOL
 
 # Create test data:
 python generate_tfrecord.py --label=<LABEL> --csv_input=<PATH_TO_ANNOTATIONS_FOLDER>/test_labels.csv  --output_path=<PATH_TO_ANNOTATIONS_FOLDER>/test.record  --label_map <PATH_TO_ANNOTATIONS_FOLDER>/label_map.pbtxt
+
+# Create sharded train data, written by 4 worker processes:
+python generate_tfrecord.py --csv_input=<PATH_TO_ANNOTATIONS_FOLDER>/train_labels.csv --output_path=<PATH_TO_ANNOTATIONS_FOLDER>/train.record --label_map <PATH_TO_ANNOTATIONS_FOLDER>/label_map.pbtxt --num_shards=8 --num_workers=4
+# which writes train.record-00000-of-00008 ... train.record-00007-of-00008,
+# read them in the pipeline config with input_path: "<PATH_TO_ANNOTATIONS_FOLDER>/train.record-?????-of-00008"
 """
 
 from __future__ import division
@@ -14,6 +19,7 @@ from __future__ import absolute_import
 
 import os
 import io
+import multiprocessing
 import pandas as pd
 import tensorflow as tf
 import sys
@@ -22,7 +28,6 @@ sys.path.append("../../models/research")
 
 from PIL import Image
 from object_detection.utils import dataset_util
-from collections import namedtuple, OrderedDict
 
 flags = tf.app.flags
 flags.DEFINE_string("csv_input", "", "Path to the CSV input")
@@ -37,48 +42,90 @@ flags.DEFINE_string(
 # flags.DEFINE_string('label1', '', 'Name of class[1] label')
 # and so on.
 flags.DEFINE_string("img_path", "", "Path to images")
+flags.DEFINE_integer(
+    "num_shards", 1, "Number of TFRecord files, more than 1 appends -NNNNN-of-NNNNN"
+)
+flags.DEFINE_integer(
+    "num_workers", 0, "Number of processes writing shards, 0 for the cpu count"
+)
 FLAGS = flags.FLAGS
 
 
-def split(df, group):
-    data = namedtuple("data", ["filename", "object"])
-    gb = df.groupby(group)
-    return [
-        data(filename, gb.get_group(x))
-        for filename, x in zip(gb.groups.keys(), gb.groups)
-    ]
+def build_image_records(df, label_map):
+    """Turns the annotation rows into one record per image, with vectorized pandas operations.
+
+    Boxes are normalized column-wise and gathered into lists with a single groupby. The image width
+    and height come from the CSV (xml_to_csv.py writes them), images without them are probed later.
+
+    Returns
+    -------
+    list
+        One dict per image: filename, width, height, xmins, xmaxs, ymins, ymaxs, classes_text, classes
+    """
+    df = df.copy()
+    if "width" not in df or "height" not in df:
+        df["width"] = float("nan")
+        df["height"] = float("nan")
+
+    df["label"] = df["class"].map(label_map)
+    missing = df.loc[df["label"].isna(), "class"].unique()
+    assert len(missing) == 0, "class labels: `{}` not found in label_map: {}".format(
+        list(missing), label_map
+    )
+    df["label"] = df["label"].astype(int)
+    # boxes of images with unknown dimensions stay in pixels, see normalize_boxes()
+    width = df["width"].fillna(1)
+    height = df["height"].fillna(1)
+    df["xmin"] = df["xmin"] / width
+    df["xmax"] = df["xmax"] / width
+    df["ymin"] = df["ymin"] / height
+    df["ymax"] = df["ymax"] / height
+
+    grouped = df.groupby("filename", sort=False)
+    sizes = grouped[["width", "height"]].first()
+    boxes = grouped[["xmin", "xmax", "ymin", "ymax", "class", "label"]].agg(list)
+    records = []
+    for filename, (w, h), (xmins, xmaxs, ymins, ymaxs, classes_text, classes) in zip(
+        boxes.index, sizes.itertuples(index=False), boxes.itertuples(index=False)
+    ):
+        records.append(
+            {
+                "filename": filename,
+                "width": None if pd.isna(w) else int(w),
+                "height": None if pd.isna(h) else int(h),
+                "xmins": xmins,
+                "xmaxs": xmaxs,
+                "ymins": ymins,
+                "ymaxs": ymaxs,
+                "classes_text": classes_text,
+                "classes": classes,
+            }
+        )
+    return records
+
+
+def normalize_boxes(record, width, height):
+    for key, size in (
+        ("xmins", width),
+        ("xmaxs", width),
+        ("ymins", height),
+        ("ymaxs", height),
+    ):
+        record[key] = [value / size for value in record[key]]
 
 
-def create_tf_example(group, path, label_map):
-    with tf.gfile.GFile(os.path.join(path, "{}".format(group.filename)), "rb") as fid:
+def create_tf_example(record, path):
+    with tf.gfile.GFile(os.path.join(path, "{}".format(record["filename"])), "rb") as fid:
         encoded_jpg = fid.read()
-    encoded_jpg_io = io.BytesIO(encoded_jpg)
-    image = Image.open(encoded_jpg_io)
-    width, height = image.size
+    width, height = record["width"], record["height"]
+    if width is None or height is None:
+        # Image.open only parses the header, the pixels are never decoded
+        width, height = Image.open(io.BytesIO(encoded_jpg)).size
+        normalize_boxes(record, width, height)
 
-    filename = group.filename.encode("utf8")
+    filename = record["filename"].encode("utf8")
     image_format = b"jpg"
     # check if the image format is matching with your images.
-    xmins = []
-    xmaxs = []
-    ymins = []
-    ymaxs = []
-    classes_text = []
-    classes = []
-
-    for index, row in group.object.iterrows():
-        xmins.append(row["xmin"] / width)
-        xmaxs.append(row["xmax"] / width)
-        ymins.append(row["ymin"] / height)
-        ymaxs.append(row["ymax"] / height)
-        classes_text.append(row["class"].encode("utf8"))
-        class_index = label_map.get(row["class"])
-        assert (
-            class_index is not None
-        ), "class label: `{}` not found in label_map: {}".format(
-            row["class"], label_map
-        )
-        classes.append(class_index)
 
     tf_example = tf.train.Example(
         features=tf.train.Features(
@@ -89,22 +136,39 @@ def create_tf_example(group, path, label_map):
                 "image/source_id": dataset_util.bytes_feature(filename),
                 "image/encoded": dataset_util.bytes_feature(encoded_jpg),
                 "image/format": dataset_util.bytes_feature(image_format),
-                "image/object/bbox/xmin": dataset_util.float_list_feature(xmins),
-                "image/object/bbox/xmax": dataset_util.float_list_feature(xmaxs),
-                "image/object/bbox/ymin": dataset_util.float_list_feature(ymins),
-                "image/object/bbox/ymax": dataset_util.float_list_feature(ymaxs),
+                "image/object/bbox/xmin": dataset_util.float_list_feature(record["xmins"]),
+                "image/object/bbox/xmax": dataset_util.float_list_feature(record["xmaxs"]),
+                "image/object/bbox/ymin": dataset_util.float_list_feature(record["ymins"]),
+                "image/object/bbox/ymax": dataset_util.float_list_feature(record["ymaxs"]),
                 "image/object/class/text": dataset_util.bytes_list_feature(
-                    classes_text
+                    [text.encode("utf8") for text in record["classes_text"]]
                 ),
-                "image/object/class/label": dataset_util.int64_list_feature(classes),
+                "image/object/class/label": dataset_util.int64_list_feature(record["classes"]),
             }
         )
     )
     return tf_example
 
 
+def shard_path(output_path, shard, num_shards):
+    if num_shards == 1:
+        return output_path
+    return "{}-{:05d}-of-{:05d}".format(output_path, shard, num_shards)
+
+
+def write_shard(task):
+    """Worker: writes one TFRecord shard, returns (its path, number of examples)"""
+    output_path, records, path = task
+    writer = tf.python_io.TFRecordWriter(output_path)
+    try:
+        for record in records:
+            writer.write(create_tf_example(record, path).SerializeToString())
+    finally:
+        writer.close()
+    return output_path, len(records)
+
+
 def main(_):
-    writer = tf.python_io.TFRecordWriter(FLAGS.output_path)
     path = os.path.join(os.getcwd(), FLAGS.img_path)
     examples = pd.read_csv(FLAGS.csv_input)
 
@@ -120,12 +184,26 @@ def main(_):
     for k, v in category_index.items():
         label_map[v.get("name")] = v.get("id")
 
-    grouped = split(examples, "filename")
-    for group in grouped:
-        tf_example = create_tf_example(group, path, label_map)
-        writer.write(tf_example.SerializeToString())
+    records = build_image_records(examples, label_map)
+    num_shards = max(1, min(FLAGS.num_shards, len(records)))
+    tasks = [
+        (shard_path(FLAGS.output_path, shard, num_shards), records[shard::num_shards], path)
+        for shard in range(num_shards)
+    ]
 
-    writer.close()
+    if num_shards == 1:
+        results = [write_shard(tasks[0])]
+    else:
+        # spawn, not fork: a forked copy of a process that has imported tensorflow is not safe to use
+        pool = multiprocessing.get_context("spawn").Pool(FLAGS.num_workers or None)
+        try:
+            results = pool.map(write_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    for shard_output_path, count in results:
+        print("Wrote {} examples to `{}`".format(count, shard_output_path))
     output_path = os.path.join(os.getcwd(), FLAGS.output_path)
     print("Successfully created the TFRecords: {}".format(output_path))
 
@@ -5,58 +5,172 @@ python xml_to_csv.py -i [PATH_TO_IMAGES_FOLDER]/train -o [PATH_TO_ANNOTATIONS_FO
 
 # Create test data:
 python xml_to_csv.py -i [PATH_TO_IMAGES_FOLDER]/test -o [PATH_TO_ANNOTATIONS_FOLDER]/test_labels.csv
+
+The .xml files are parsed across a process pool and the rows are streamed to the .csv.
+Parsed rows are cached in [PATH_TO_IMAGES_FOLDER]/.xml_to_csv_cache.json, keyed by file path,
+mtime and size, so a rerun only parses new or modified .xml files. Pass --no_cache to parse everything.
 """
 
 import os
+import csv
 import glob
+import json
 import pandas as pd
 import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
 
+COLUMN_NAMES = [
+    "filename",
+    "width",
+    "height",
+    "class",
+    "xmin",
+    "ymin",
+    "xmax",
+    "ymax",
+]
+CACHE_FILE_NAME = ".xml_to_csv_cache.json"
 
-def xml_to_csv(path):
-    """Iterates through all .xml files (generated by labelImg) in a given directory and combines them in a single Pandas datagrame.
+
+def parse_xml(xml_file):
+    """Parses one .xml file generated by labelImg.
 
     Parameters:
     ----------
-    path : {str}
-        The path containing the .xml files
+    xml_file : {str}
+        The path of the .xml file
     Returns
     -------
-    Pandas DataFrame
-        The produced dataframe
+    list
+        One (filename, width, height, class, xmin, ymin, xmax, ymax) row per object
     """
-    classes_names = []
-    xml_list = []
-    for xml_file in glob.glob(path + "/*.xml"):
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        for member in root.findall("object"):
-            classes_names.append(member[0].text)
-            value = (
-                root.find("filename").text,
-                int(root.find("size")[0].text),
-                int(root.find("size")[1].text),
+    root = ET.parse(xml_file).getroot()
+    filename = root.find("filename").text
+    width = int(root.find("size")[0].text)
+    height = int(root.find("size")[1].text)
+    rows = []
+    for member in root.findall("object"):
+        rows.append(
+            (
+                filename,
+                width,
+                height,
                 member[0].text,
                 int(member[4][0].text),
                 int(member[4][1].text),
                 int(member[4][2].text),
                 int(member[4][3].text),
             )
-            xml_list.append(value)
-    column_name = [
-        "filename",
-        "width",
-        "height",
-        "class",
-        "xmin",
-        "ymin",
-        "xmax",
-        "ymax",
-    ]
-    xml_df = pd.DataFrame(xml_list, columns=column_name)
-    classes_names = list(set(classes_names))
-    classes_names.sort()
+        )
+    return rows
+
+
+def iter_rows(path, processes=None, cache_path=None):
+    """Yields the rows of every .xml file in path, in file name order.
+
+    Files whose path, mtime and size match an entry in the cache are not parsed again,
+    the others are parsed across a process pool. The cache is rewritten at the end with
+    the current files only.
+
+    Parameters:
+    ----------
+    path : {str}
+        The path containing the .xml files
+    processes : {int}
+        Number of worker processes, defaults to the cpu count
+    cache_path : {str}
+        The cache file, None to parse every file
+    """
+    xml_files = sorted(glob.glob(os.path.join(path, "*.xml")))
+    cache = load_cache(cache_path)
+    new_cache = {}
+    stale_files = []
+    for xml_file in xml_files:
+        stat = os.stat(xml_file)
+        entry = cache.get(xml_file)
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            stale_files.append(xml_file)
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size, "rows": None}
+        new_cache[xml_file] = entry
+    print(
+        "{} .xml files, {} cached, {} to parse".format(
+            len(xml_files), len(xml_files) - len(stale_files), len(stale_files)
+        )
+    )
+
+    pool = multiprocessing.Pool(processes) if stale_files else None
+    try:
+        # imap keeps the order of stale_files, so its results line up with the sorted file list
+        parsed = pool.imap(parse_xml, stale_files, chunksize=32) if pool else iter(())
+        for xml_file in xml_files:
+            entry = new_cache[xml_file]
+            if entry["rows"] is None:
+                entry["rows"] = [list(row) for row in next(parsed)]
+            for row in entry["rows"]:
+                yield row
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    save_cache(cache_path, new_cache)
+
+
+def load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        print("Ignoring corrupt cache `{}`".format(cache_path))
+        return {}
+
+
+def save_cache(cache_path, cache):
+    if cache_path is None:
+        return
+    # written next to the cache and renamed into place, so an interrupted run leaves the old cache intact
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def write_csv(path, output_file, processes=None, cache_path=None):
+    """Streams the rows of every .xml file in path to output_file.
+
+    Returns
+    -------
+    list
+        The sorted class names
+    """
+    classes_names = set()
+    count = 0
+    with open(output_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMN_NAMES)
+        for row in iter_rows(path, processes, cache_path):
+            classes_names.add(row[3])
+            writer.writerow(row)
+            count += 1
+    print("Wrote {} annotations to `{}`".format(count, output_file))
+    return sorted(classes_names)
+
+
+def xml_to_csv(path, processes=None):
+    """Iterates through all .xml files (generated by labelImg) in a given directory and combines them in a single Pandas datagrame.
+
+    Parameters:
+    ----------
+    path : {str}
+        The path containing the .xml files
+    Returns
+    -------
+    Pandas DataFrame
+        The produced dataframe
+    """
+    xml_df = pd.DataFrame(list(iter_rows(path, processes)), columns=COLUMN_NAMES)
+    classes_names = sorted(set(xml_df["class"]))
     return xml_df, classes_names
 
 
@@ -82,6 +196,17 @@ def main():
         type=str,
         default="",
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of parser processes, defaults to the cpu count",
+        type=int,
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="Parse every .xml file, ignoring and not writing the cache",
+        action="store_true",
+    )
 
     args = parser.parse_args()
 
@@ -92,8 +217,8 @@ def main():
 
     assert os.path.isdir(args.inputDir)
     os.makedirs(os.path.dirname(args.outputFile), exist_ok=True)
-    xml_df, classes_names = xml_to_csv(args.inputDir)
-    xml_df.to_csv(args.outputFile, index=None)
+    cache_path = None if args.no_cache else os.path.join(args.inputDir, CACHE_FILE_NAME)
+    classes_names = write_csv(args.inputDir, args.outputFile, args.processes, cache_path)
     print("Successfully converted xml to csv.")
     if args.labelMapDir:
         os.makedirs(args.labelMapDir, exist_ok=True)